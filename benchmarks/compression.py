@@ -0,0 +1,208 @@
+"""Benchmark the effective throughput of peer transfers with each compression.
+
+A tracker, a seeding client and one downloading client per compression run
+in this process on the loopback interface. The seeder's per-peer upload rate
+limit simulates a slow link, so the effective throughput of a transfer is its
+file size over the time the fetch took. A warm-up fetch first empties the
+burst of the limit. Each downloader disconnects before the next one starts,
+since it publishes what it fetched: the seeder stays the only holder of the
+sample files, and every transfer goes through its limit.
+
+Usage:
+    python benchmarks/compression.py [--rate KIBS] [--client client1] [--json]
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMPRESSIONS = [None, "zlib", "bz2", "lzma"]
+WARMUP_FILE = "warmup.bin"
+
+
+def free_port():
+    """Get a free TCP port on the loopback interface.
+
+    Returns:
+        int: the port
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_client(FileClient, port, hostname, folder, peer_server_mode="thread"):
+    """Connect a client to the tracker and publish its repository.
+
+    Args:
+        FileClient (type): the client class
+        port (int): the tracker's port
+        hostname (str): the client's hostname
+        folder (str): path to the client's repository folder
+        peer_server_mode (str): "thread" or "asyncio", see FileClient
+
+    Returns:
+        FileClient: the client
+    """
+    client = FileClient(log_callback=lambda message: None, peer_server_mode=peer_server_mode)
+    client.server_host = "127.0.0.1"
+    client.server_port = port
+    client.repository_folder = folder
+    client.start(client.connect_to_server(hostname))
+    client.connect_publish(client.client_socket)
+    return client
+
+
+def wait_published(server, file_names, timeout=60):
+    """Wait until the tracker knows every sample file.
+
+    Args:
+        server (ServerLogic): the tracker
+        file_names (list[str]): the files' names
+        timeout (float): seconds to wait
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        published = set()
+        for data in list(server.clients.values()):
+            published.update(data["files"])
+        if published.issuperset(file_names):
+            return
+        time.sleep(0.05)
+    raise TimeoutError("The sample files were not published")
+
+
+def stop_client(server, client, timeout=10):
+    """Disconnect a client and wait until the tracker forgets its files.
+
+    Args:
+        server (ServerLogic): the tracker
+        client (FileClient): the client
+        timeout (float): seconds to wait
+    """
+    client.close(client.client_socket)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(data["hostname"] != client.hostname for data in list(server.clients.values())):
+            return
+        time.sleep(0.05)
+    raise TimeoutError(f"The tracker still lists {client.hostname}")
+
+
+def fetch(client, file_name, timeout=600):
+    """Fetch a file and wait for its download job to end.
+
+    Args:
+        client (FileClient): the downloading client
+        file_name (str): the file's name
+        timeout (float): seconds to wait
+
+    Returns:
+        float: seconds the fetch took, or None if it failed
+    """
+    started = time.monotonic()
+    client.fetch(client.client_socket, file_name)
+    while time.monotonic() - started < timeout:
+        jobs = [job for job in client.downloads.list() if job.fname == file_name]
+        if jobs and jobs[0].state == "done":
+            return time.monotonic() - started
+        if jobs and jobs[0].state in ("failed", "cancelled"):
+            return None
+        time.sleep(0.01)
+    return None
+
+
+def sample_files(folder, client):
+    """Copy the sample repository of a client and add a generated text file.
+
+    Args:
+        folder (str): path to the seeder's repository folder
+        client (str): the client folder whose repository is copied
+
+    Returns:
+        list[str]: the files' names
+    """
+    os.makedirs(folder)
+    repository = os.path.join(ROOT, client, "repository")
+    for file_name in os.listdir(repository):
+        if os.path.isfile(os.path.join(repository, file_name)):
+            shutil.copy(os.path.join(repository, file_name), folder)
+    with open(os.path.join(folder, "generated.log"), "w") as file:
+        for i in range(50000):
+            file.write(f"{i} GET /files/{i % 97}.bin 200 {i * 7 % 4096} bytes\n")
+    return sorted(os.listdir(folder))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=int, default=512, help="upload rate limit of the seeder, in KiB/s")
+    parser.add_argument("--client", default="client1", help="client folder to benchmark and take the samples from")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(ROOT, "server"))
+    sys.path.insert(0, os.path.join(ROOT, args.client))
+    from client import FileClient
+    from server import ServerLogic
+
+    work = tempfile.mkdtemp(prefix="p2p-bench-")
+    try:
+        port = free_port()
+        server = ServerLogic("127.0.0.1", port, log_callback=lambda message: None,
+                             log_request_callback=lambda message: None)
+        server.start()
+        time.sleep(0.2)
+
+        file_names = sample_files(os.path.join(work, "seeder"), args.client)
+        with open(os.path.join(work, "seeder", WARMUP_FILE), "wb") as file:
+            file.write(os.urandom(2 * args.rate * 1024))
+        seeder = start_client(FileClient, port, "seeder", os.path.join(work, "seeder"))
+        seeder.set_upload_limits(None, args.rate * 1024)
+        wait_published(server, file_names + [WARMUP_FILE])
+
+        os.makedirs(os.path.join(work, "warmup"))
+        warmup = start_client(FileClient, port, "warmup", os.path.join(work, "warmup"))
+        fetch(warmup, WARMUP_FILE)
+        stop_client(server, warmup)
+
+        results = []
+        for compression in COMPRESSIONS:
+            name = compression or "none"
+            folder = os.path.join(work, name)
+            os.makedirs(folder)
+            downloader = start_client(FileClient, port, name, folder)
+            downloader.compressions = [compression] if compression else []
+            for file_name in file_names:
+                size = os.path.getsize(os.path.join(work, "seeder", file_name))
+                elapsed = fetch(downloader, file_name)
+                results.append({
+                    "compression": name,
+                    "file": file_name,
+                    "size": size,
+                    "seconds": elapsed,
+                    "throughput": size / elapsed if elapsed else None,
+                })
+            stop_client(server, downloader)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"rate": args.rate * 1024, "results": results}, indent=2))
+        return
+    print(f"Upload limit {args.rate} KiB/s, effective throughput in KiB/s")
+    print(f"{'file':<40}{'size':>10}" + "".join(f"{name or 'none':>10}" for name in COMPRESSIONS))
+    for file_name in file_names:
+        rows = [result for result in results if result["file"] == file_name]
+        line = f"{file_name[:39]:<40}{rows[0]['size']:>10}"
+        for row in rows:
+            line += f"{row['throughput'] / 1024:>10.0f}" if row["throughput"] else f"{'failed':>10}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
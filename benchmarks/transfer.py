@@ -0,0 +1,214 @@
+"""Benchmark the throughput, CPU time and latency of peer transfers.
+
+A tracker, a seeding client and N downloading clients run in this process
+on the loopback interface. The downloaders fetch the same file from the
+seeder at the same time, through the clients' own upload and download code,
+without compression. The run is repeated for every file size, buffer size
+(the bytes read and sent at a time by an upload and received at a time by a
+download) and number of downloaders.
+
+Usage:
+    python benchmarks/transfer.py [--sizes 64K,4M,64M] [--buffers 1K,16K,64K] [--downloaders 1,4]
+                                  [--server thread|asyncio] [--client client1] [--json FILE]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from compression import ROOT, free_port, start_client, wait_published
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+PATTERN_SIZE = 1024 * 1024  # Bytes of random data repeated to fill the large sample files
+
+
+def parse_size(text):
+    """Parse a number of bytes with an optional K, M or G suffix.
+
+    Args:
+        text (str): e.g. "64K"
+
+    Returns:
+        int: the number of bytes
+    """
+    text = text.strip().upper()
+    unit = text[-1] if text[-1] in UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def format_size(size):
+    """Format a number of bytes with the largest suffix that divides it.
+
+    Args:
+        size (int): the number of bytes
+
+    Returns:
+        str: e.g. "64K"
+    """
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+
+def sample_file(folder, size):
+    """Write a file of random data, a random block repeated for large sizes.
+
+    Args:
+        folder (str): the folder to write to
+        size (int): the file's size
+
+    Returns:
+        str: the file's name
+    """
+    file_name = f"sample-{format_size(size)}.bin"
+    pattern = os.urandom(min(size, PATTERN_SIZE))
+    with open(os.path.join(folder, file_name), "wb") as file:
+        written = 0
+        while written < size:
+            written += file.write(pattern[:size - written])
+    return file_name
+
+
+def run(client_module, port, work, file_name, size, count, timeout=3600):
+    """Fetch a file with fresh downloaders at the same time.
+
+    Args:
+        client_module (module): the client module
+        port (int): the tracker's port
+        work (str): the working folder
+        file_name (str): the file's name
+        size (int): the file's size
+        count (int): the number of downloaders
+        timeout (float): seconds to wait for the downloads
+
+    Returns:
+        dict: the results of the run
+    """
+    downloaders = []
+    for i in range(count):
+        folder = tempfile.mkdtemp(prefix="downloader-", dir=work)
+        downloader = start_client(client_module.FileClient, port, os.path.basename(folder), folder)
+        downloader.compressions = []
+        downloaders.append(downloader)
+
+    cpu = time.process_time()
+    started = time.monotonic()
+    for downloader in downloaders:
+        downloader.fetch(downloader.client_socket, file_name)
+    latencies = []
+    failed = 0
+    deadline = started + timeout
+    pending = list(downloaders)
+    while pending and time.monotonic() < deadline:
+        for downloader in list(pending):
+            jobs = downloader.downloads.list()
+            if jobs and jobs[0].state in ("done", "failed", "cancelled"):
+                pending.remove(downloader)
+                if jobs[0].state == "done":
+                    latencies.append(jobs[0].finished - started)
+                else:
+                    failed += 1
+        time.sleep(0.001)
+    seconds = time.monotonic() - started
+    cpu = time.process_time() - cpu
+    failed += len(pending)
+
+    for downloader in downloaders:
+        downloader.close(downloader.client_socket)
+    transferred = size * len(latencies)
+    return {
+        "seconds": seconds,
+        "bytes": transferred,
+        "throughput": transferred / seconds if seconds > 0 else None,
+        "cpu_seconds": cpu,
+        "cpu_seconds_per_gib": cpu / (transferred / UNITS["G"]) if transferred else None,
+        "latency_mean": statistics.mean(latencies) if latencies else None,
+        "latency_max": max(latencies) if latencies else None,
+        "failed": failed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="64K,4M,64M", help="comma separated file sizes, e.g. 16K,1M,2G")
+    parser.add_argument("--buffers", default="1K,16K,64K", help="comma separated buffer sizes")
+    parser.add_argument("--downloaders", default="1,4", help="comma separated numbers of concurrent downloaders")
+    parser.add_argument("--server", choices=["thread", "asyncio"], default="thread", help="peer server of the seeder")
+    parser.add_argument("--client", default="client1", help="client folder to benchmark")
+    parser.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE, - for stdout")
+    args = parser.parse_args()
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    buffers = [parse_size(size) for size in args.buffers.split(",")]
+    counts = [int(count) for count in args.downloaders.split(",")]
+
+    sys.path.insert(0, os.path.join(ROOT, "server"))
+    sys.path.insert(0, os.path.join(ROOT, args.client))
+    import client as client_module
+    from server import ServerLogic
+
+    work = tempfile.mkdtemp(prefix="p2p-bench-")
+    results = []
+    try:
+        port = free_port()
+        server = ServerLogic("127.0.0.1", port, log_callback=lambda message: None,
+                             log_request_callback=lambda message: None)
+        server.start()
+        time.sleep(0.2)
+
+        seeder_folder = os.path.join(work, "seeder")
+        os.makedirs(seeder_folder)
+        file_names = [sample_file(seeder_folder, size) for size in sizes]
+        seeder = start_client(client_module.FileClient, port, "seeder", seeder_folder, args.server)
+        # The peer server is chosen when the client starts, check it is the one asked for
+        if seeder.peer_server_mode != args.server or (seeder.async_server is not None) != (args.server == "asyncio"):
+            raise RuntimeError(f"The seeder does not run the {args.server} peer server")
+        wait_published(server, file_names)
+
+        for size, file_name in zip(sizes, file_names):
+            for buffer_size in buffers:
+                # The clients read these when they send and receive, ASYNC_CHUNK_SIZE
+                # for the sends of the asyncio peer server
+                client_module.UPLOAD_CHUNK_SIZE = client_module.DOWNLOAD_CHUNK_SIZE = buffer_size
+                client_module.ASYNC_CHUNK_SIZE = buffer_size
+                for count in counts:
+                    result = {"size": size, "buffer": buffer_size, "downloaders": count}
+                    result.update(run(client_module, port, work, file_name, size, count))
+                    results.append(result)
+                    if args.json != "-":
+                        throughput = result["throughput"] or 0
+                        latency = result["latency_mean"] or 0
+                        print(
+                            f"{format_size(size):>6} buffer {format_size(buffer_size):>5} x{count:<3}"
+                            f" {throughput / UNITS['M']:9.1f} MiB/s  cpu {result['cpu_seconds']:7.2f} s"
+                            f"  latency {latency * 1000:9.1f} ms  failed {result['failed']}",
+                            flush=True,
+                        )
+        seeder.close(seeder.client_socket)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if args.json:
+        report = {
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "client": args.client,
+            "server": args.server,
+            "results": results,
+        }
+        if args.json == "-":
+            print(json.dumps(report, indent=2))
+        else:
+            with open(args.json, "w") as file:
+                json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
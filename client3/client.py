@@ -1,549 +1,5161 @@
+import asyncio
+import bz2
+import collections
+import ctypes
+import ctypes.util
+import hashlib
+import heapq
 import json
+import lzma
+import math
+import mmap
+import multiprocessing
 import os
+import queue
+import select
 import socket
+import sqlite3
+import stat
+import struct
 import sys
 import shutil
 import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-class FileClient:
-    def __init__(self, log_callback=None):
-        self.server_host = "localhost"  #Set the server address right here
-        self.server_port = 8888
-        self.lock = threading.Lock()  # To synchronize access to shared data
-        self.hostname = None
-        self.path = None
-        self.stop_threads = False  # Flag to signal threads to terminate
-        self.log_callback = log_callback
-        self.client_socket = None
-        self.server_connected = False
-        self.repository_folder = None
-        self.discovery_array = []  # Array of shared file name
-        self.discover_status = False
+STATE_FOLDER = ".p2p"  # Hidden folder inside the repository for client state
+PARTIAL_SUFFIX = ".part"
+ALIAS_SUFFIX = ".alias"  # Suffix of a repository file alias being created, in the state folder
+OBJECTS_FOLDER = "objects"  # Folder of the files stored by content hash, in the state folder
+FICLONE = 0x40049409  # ioctl sharing the blocks of a file with a copy (reflink), on Linux
+JOURNAL_SUFFIX = ".part.json"
+JOURNAL_INTERVAL = 4 * 1024 * 1024  # Bytes received between journal checkpoints
+PIECE_SIZE = 256 * 1024  # Bytes covered by each piece hash
+METADATA_DB = "metadata.db"  # Database of the repository files' hashes, in the state folder
+HASH_POOL_MIN_BYTES = 64 * 1024 * 1024  # Bytes to hash below which no worker processes are started
+HASH_PROGRESS_INTERVAL = 2.0  # Seconds between progress reports and publishes of the hashed files
+PUBLISH_BATCH_SIZE = 500  # File names announced per publish request
+PUBLISH_WINDOW = 4  # Publish batches sent ahead of the server's acknowledgements
+PUBLISH_ACK_TIMEOUT = 30  # Seconds to wait for the server to acknowledge a publish batch
+PEER_IDLE_TIMEOUT = 60  # Seconds before an idle incoming peer connection is closed
+POOL_IDLE_TIMEOUT = 30  # Seconds before an idle pooled outgoing connection is closed
+PEER_CONNECT_TIMEOUT = 5  # Seconds to open a connection to a peer
+FIRST_BYTE_TIMEOUT = 15  # Seconds to wait for a peer's reply to a download request
+DOWNLOAD_IDLE_TIMEOUT = 30  # Seconds without data from a peer before a download is abandoned
+PIPELINE_DEPTH = 16  # Files requested ahead on one connection by a batch fetch
+MAX_ACTIVE_DOWNLOADS = 4  # Download jobs running at the same time
+MAX_DOWNLOADS_PER_PEER = 2  # Download jobs running at the same time against one peer
+DOWNLOAD_BATCH_SIZE = 64  # Queued jobs for the same peer downloaded over one connection
+MAX_ENDED_JOBS = 100  # Ended download jobs kept for listing, older ones are forgotten
+RATE_WINDOW = 2.0  # Seconds over which transfer rates are averaged
+STREAM_CHUNK_SIZE = 64 * 1024  # Bytes yielded at a time by a streaming fetch
+STREAM_POLL_INTERVAL = 0.05  # Seconds between checks of the download of a streaming fetch
+PEER_SCORE_ALPHA = 0.3  # Weight of a new measurement in the moving averages of the peer scores
+PEER_SCORE_DECAY = 0.9  # Factor applied to the past successes and failures of a peer at each new one
+PEER_DEFAULT_THROUGHPUT = 1024 * 1024  # Bytes per second assumed when no peer was measured yet
+PEER_MIN_SAMPLE = 64 * 1024  # Bytes a download must move to measure the peer's throughput
+TRANSFER_HISTORY_SIZE = 1000  # Finished uploads and downloads kept by the transfer statistics
+STALL_TIME = 1.0  # Seconds without data, outside of the upload rate limits, counted as a stall
+MAX_UPLOAD_SLOTS = 8  # Uploads sending file data at the same time
+UPLOAD_QUEUE_SIZE = 16  # Uploads waiting for a slot before peers are told to retry later
+UPLOAD_QUEUE_TIMEOUT = 5  # Seconds an upload waits for a slot
+MAX_PEER_CONNECTIONS = 64  # Incoming peer connections served at the same time
+MAX_ASYNC_PEER_CONNECTIONS = 1024  # Incoming peer connections served by the asyncio peer server
+ASYNC_CHUNK_SIZE = 256 * 1024  # Bytes handed to sendfile at a time by the asyncio peer server
+UPLOAD_CHUNK_SIZE = 16 * 1024  # Bytes read and sent at a time by an upload
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes received at a time by a download, see benchmarks/transfer.py
+BLOCK_CACHE_SIZE = 64 * 1024 * 1024  # Default bytes of file blocks kept in memory by the upload block cache
+BLOCK_CACHE_BLOCK_SIZE = 256 * 1024  # Bytes in each block of the upload block cache
+MAX_OPEN_FILES = 64  # Repository files kept open for uploads
+COMPRESSION_BLOCK_SIZE = 64 * 1024  # Bytes of a file compressed in each block of a compressed transfer
+COMPRESSION_SAMPLE_SIZE = 64 * 1024  # Bytes of a file compressed to decide whether to compress it
+COMPRESSION_MAX_RATIO = 0.9  # Files whose sample does not compress below this ratio are sent raw
+DELTA_MIN_BLOCK = 2 * 1024  # Smallest block compared by a delta transfer
+DELTA_MAX_BLOCK = 128 * 1024  # Largest block compared by a delta transfer
+DELTA_MAX_SIGNATURES = 128 * 1024  # Blocks of the older copy a delta request may describe
+DELTA_MIN_FILE_SIZE = 1024 * 1024  # Bytes of the local copy below which the whole file is downloaded
+DELTA_MAX_LITERAL_RATIO = 0.5  # Fraction of the file sent as new data after which a delta gives up
+DELTA_READ_SIZE = 1024 * 1024  # Bytes of a file read at a time to encode a delta
+DELTA_CHUNK_SIZE = 64 * 1024  # Bytes of a delta encoded before they are sent
+# Compressions offered for downloads, in order of preference
+COMPRESSIONS = ["zlib", "bz2", "lzma"]
+# Extensions of file formats that are already compressed
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".bz2", ".docx", ".gif", ".gz", ".jpeg", ".jpg", ".mp3", ".mp4", ".pdf",
+    ".png", ".pptx", ".rar", ".webp", ".xlsx", ".xz", ".zip",
+}
+CATALOG_TTL = 30.0  # Seconds the discovered catalog and the fetch results are reused
+DISCOVER_TIMEOUT = 10  # Seconds to wait for the server's catalog
+WATCH_INTERVAL = 1.0  # Seconds between scans of the repository when inotify is not available
+WATCH_BATCH_DELAY = 0.5  # Seconds without changes before the changed files are announced
+
+# inotify events watched in the repository folder, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+
+
+def recv_exact(sock: socket.socket, size: int):
+    """Receive exactly size bytes from a socket.
+
+    Args:
+        sock (socket.socket): the socket to read from
+        size (int): number of bytes to read
+
+    Returns:
+        bytes: the received bytes, or None if the connection was closed early
+    """
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock: socket.socket, message):
+    """Send a JSON message prefixed with its length as an 8-byte big-endian integer.
+
+    Args:
+        sock (socket.socket): the socket to write to
+        message (obj): the message to send
+    """
+    data = json.dumps(message).encode("utf-8", "replace")
+    sock.sendall(len(data).to_bytes(8, "big") + data)
+
+
+def recv_message(sock: socket.socket):
+    """Receive a JSON message sent with send_message.
+
+    Args:
+        sock (socket.socket): the socket to read from
+
+    Returns:
+        obj: the message, or None if the connection was closed
+    """
+    header = recv_exact(sock, 8)
+    if header is None:
+        return None
+    data = recv_exact(sock, int.from_bytes(header, "big"))
+    if data is None:
+        return None
+    return json.loads(data.decode("utf-8", "replace"))
+
+
+def hash_file(file_path, piece_size=PIECE_SIZE, use_mmap=False):
+    """Compute the SHA-256 hash of every piece of a file, and of the whole
+    file, reading it once.
+
+    Args:
+        file_path (str): path to the file
+        piece_size (int): number of bytes in each piece
+        use_mmap (bool): read the file through a memory map, piece by piece.
+            A file truncated while it is mapped kills the process with
+            SIGBUS, so only the hashing worker processes map files.
+
+    Returns:
+        tuple[list[str], str]: the hex digests of the pieces, in order, and
+            the hex digest of the content
+    """
+    pieces = []
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if use_mmap and size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for offset in range(0, len(view), piece_size):
+                    with view[offset:offset + piece_size] as data:
+                        pieces.append(hashlib.sha256(data).hexdigest())
+                        content_hash.update(data)
+            return pieces, content_hash.hexdigest()
+        while True:
+            data = file.read(piece_size)
+            if not data:
+                break
+            pieces.append(hashlib.sha256(data).hexdigest())
+            content_hash.update(data)
+    return pieces, content_hash.hexdigest()
 
-    def log(self, message):     
-        """Log a message to the console or using the Logs tab in the GUI.
+
+def clone_file(source, target, copy=True):
+    """Copy a file as a reflink sharing the blocks of the source where the
+    file system supports it (Btrfs, XFS), else copy its content.
+
+    Args:
+        source (str): path to the file
+        target (str): path to the copy, which must not exist
+        copy (bool): copy the content if no reflink can be made, else make nothing
+
+    Returns:
+        str: "reflink" or "copy", None if nothing was made
+    """
+    if fcntl is not None:
+        with open(source, "rb") as src, open(target, "xb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except OSError:
+                pass
+        os.remove(target)
+    if not copy:
+        return None
+    shutil.copyfile(source, target)
+    return "copy"
+
+
+def link_file(source, target, copy=True):
+    """Create an alias of a file: a hard link, or else a reflink or a copy.
+
+    Args:
+        source (str): path to the file
+        target (str): path to the alias, which must not exist
+        copy (bool): copy the content if no link can be made, else make nothing
+
+    Returns:
+        str: "hardlink", "reflink" or "copy", None if nothing was made
+    """
+    try:
+        os.link(source, target)
+        return "hardlink"
+    except OSError:
+        return clone_file(source, target, copy)
+
+
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 1), zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+}
+
+
+def compress_block(compression, data):
+    """Compress a block of a compressed transfer.
+
+    Args:
+        compression (str): the name of the codec in CODECS
+        data (bytes): the block's content
+
+    Returns:
+        bytes: the compressed block, prefixed with its length as a 4-byte big-endian integer
+    """
+    block = CODECS[compression][0](data)
+    return len(block).to_bytes(4, "big") + block
+
+
+class TransferReader:
+    """Read the content sent after a download reply, raw or in compressed blocks."""
+
+    def __init__(self, sock: socket.socket, compression=None):
+        self.sock = sock
+        self.decompress = CODECS[compression][1] if compression else None
+        self.buffer = memoryview(b"")
+
+    def read(self, size):
+        """Read at most size bytes of content.
 
         Args:
-            message (str): The message to print
+            size (int): maximum number of bytes to read
+
+        Returns:
+            bytes: the content, empty if the connection was closed
         """
-        if self.log_callback:
-            self.log_callback(message)
-        else:
-            print(message)
+        if self.decompress is None:
+            return self.sock.recv(size)
+        if not self.buffer:
+            header = recv_exact(self.sock, 4)
+            block = recv_exact(self.sock, int.from_bytes(header, "big")) if header else None
+            if not block:
+                return b""
+            self.buffer = memoryview(self.decompress(block))
+        data = bytes(self.buffer[:size])
+        self.buffer = self.buffer[size:]
+        return data
 
-    def connect_to_server(self, hostname):      
-        """Connect to the server and set the client's hostname.
+    def read_exact(self, size):
+        """Read exactly size bytes of content.
 
         Args:
-            hostname (str): the client's hostname
+            size (int): number of bytes to read
 
         Returns:
-            tuple[str, int]: the client's address (hostname, port)
+            bytes: the content, or None if the connection was closed before
+        """
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+
+def merkle_root(pieces):
+    """Compute the Merkle root of a list of piece hashes.
+
+    Pairs of nodes are hashed together level by level, an odd node at the
+    end of a level is carried up unchanged.
+
+    Args:
+        pieces (list[str]): the hex digests of the pieces
+
+    Returns:
+        str: the hex digest of the root
+    """
+    if not pieces:
+        return hashlib.sha256(b"").hexdigest()
+    level = [bytes.fromhex(piece) for piece in pieces]
+    while len(level) > 1:
+        next_level = [
+            hashlib.sha256(level[i] + level[i + 1]).digest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+
+def delta_block_size(size):
+    """Choose the block size of a delta transfer for a file, about the
+    square root of its size so the signatures and the delta stay small.
+
+    Args:
+        size (int): number of bytes in the older copy of the file
+
+    Returns:
+        int: the block size
+    """
+    return min(max(math.isqrt(size), DELTA_MIN_BLOCK), DELTA_MAX_BLOCK)
+
+
+def delta_request_error(block_size, signatures):
+    """Check the block size and signatures of a delta request, before the
+    file is compared with them.
+
+    Args:
+        block_size (int): number of bytes in each block of the peer's copy
+        signatures (list): the signatures of the peer's copy
+
+    Returns:
+        str: why the request is rejected, or None if it is valid
+    """
+    if type(block_size) is not int or not DELTA_MIN_BLOCK <= block_size <= DELTA_MAX_BLOCK:
+        return f"The block size must be between {DELTA_MIN_BLOCK} and {DELTA_MAX_BLOCK} bytes"
+    if not isinstance(signatures, list) or len(signatures) > DELTA_MAX_SIGNATURES:
+        return f"At most {DELTA_MAX_SIGNATURES} block signatures are accepted"
+    for signature in signatures:
+        if (
+            not isinstance(signature, list) or len(signature) != 2
+            or type(signature[0]) is not int or not isinstance(signature[1], str)
+        ):
+            return "Invalid block signature"
+    return None
+
+
+def block_hash(data):
+    """Compute the strong hash that confirms a block matched by its rolling checksum.
+
+    Args:
+        data (bytes): the block's content
+
+    Returns:
+        str: the first 16 hex digits of the SHA-256 digest
+    """
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def block_signatures(file_path, block_size):
+    """Compute the signatures of the blocks of a file, sent to a peer to
+    get the changes from this copy of the file to the peer's version.
+
+    Args:
+        file_path (str): path to the file
+        block_size (int): number of bytes in each block
+
+    Returns:
+        list[tuple[int, str]]: the Adler-32 checksum and strong hash of each block, in order
+    """
+    signatures = []
+    with open(file_path, "rb") as file:
+        while True:
+            data = file.read(block_size)
+            if not data:
+                break
+            signatures.append((zlib.adler32(data), block_hash(data)))
+    return signatures
+
+
+class DeltaEncoder:
+    """Encode the records of a delta stream: b"C" with the first block and
+    the number of blocks to copy from the older copy, b"D" with the length
+    and content of new data, and b"E" at the end, as 4-byte big-endian
+    integers, or b"A" if the delta is given up. Copies of consecutive blocks
+    are merged into one record."""
+
+    def __init__(self):
+        self.out = bytearray()
+        self.run = None  # [first block, number of blocks] of the pending copy
+        self.literal = 0  # Bytes of new data encoded
+
+    def copy(self, index):
+        if self.run is not None and self.run[0] + self.run[1] == index:
+            self.run[1] += 1
+            return
+        self.flush()
+        self.run = [index, 1]
+
+    def data(self, data):
+        if data:
+            self.flush()
+            self.out += b"D" + len(data).to_bytes(4, "big") + data
+            self.literal += len(data)
+
+    def flush(self):
+        if self.run is not None:
+            self.out += b"C" + self.run[0].to_bytes(4, "big") + self.run[1].to_bytes(4, "big")
+            self.run = None
+
+    def end(self):
+        self.flush()
+        self.out += b"E"
+
+    def abort(self):
+        self.flush()
+        self.out += b"A"
+
+    def take(self):
+        """Take the records encoded so far.
+
+        Returns:
+            bytes: the records
+        """
+        out = bytes(self.out)
+        self.out = bytearray()
+        return out
+
+
+def delta_stream(file, block_size, signatures, max_literal=None):
+    """Encode a file as the changes from an older copy of it, given the
+    signatures of the copy's blocks. The Adler-32 checksum of the window
+    at every offset of the file is rolled forward byte by byte and looked
+    up in the signatures, the strong hash confirms a match.
+
+    Args:
+        file (file): the file, read with explicit offsets
+        block_size (int): number of bytes in each block of the older copy
+        signatures (list[tuple[int, str]]): the signatures of the older copy
+        max_literal (int): bytes of new data after which the delta is given
+            up with an abort record, None for no limit
+
+    Yields:
+        bytes: the records of the delta stream, see DeltaEncoder, in chunks
+            of about DELTA_CHUNK_SIZE bytes
+    """
+    blocks = {}
+    for index, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+    encoder = DeltaEncoder()
+    buffer = b""
+    read_offset = 0
+    pos = literal = 0  # Window start, and start of the new data not encoded yet
+    eof = False
+    weak = None
+    while True:
+        if not eof and len(buffer) - pos <= block_size:
+            # Keep a whole window and the byte after it in the buffer
+            encoder.data(buffer[literal:pos])
+            data = os.pread(file.fileno(), DELTA_READ_SIZE, read_offset)
+            read_offset += len(data)
+            eof = not data
+            buffer = buffer[pos:] + data
+            pos = literal = 0
+            if max_literal is not None and encoder.literal > max_literal:
+                encoder.abort()
+                yield encoder.take()
+                return
+            if len(encoder.out) >= DELTA_CHUNK_SIZE:
+                yield encoder.take()
+            continue
+        if pos + block_size > len(buffer):
+            # Only the tail of the file is left, it can match the last block
+            tail = buffer[pos:]
+            index = blocks.get(zlib.adler32(tail), {}).get(block_hash(tail)) if tail else None
+            if index is not None:
+                encoder.data(buffer[literal:pos])
+                encoder.copy(index)
+            else:
+                encoder.data(buffer[literal:])
+            encoder.end()
+            yield encoder.take()
+            return
+        if weak is None:
+            weak = zlib.adler32(buffer[pos:pos + block_size])
+        candidates = blocks.get(weak)
+        if candidates is not None:
+            index = candidates.get(block_hash(buffer[pos:pos + block_size]))
+            if index is not None:
+                encoder.data(buffer[literal:pos])
+                encoder.copy(index)
+                pos = literal = pos + block_size
+                weak = None
+                if len(encoder.out) >= DELTA_CHUNK_SIZE:
+                    yield encoder.take()
+                continue
+        if pos + block_size == len(buffer):
+            # End of the file, no byte to roll in
+            pos += 1
+            continue
+        old, new = buffer[pos], buffer[pos + block_size]
+        a = ((weak & 0xFFFF) - old + new) % 65521
+        b = ((weak >> 16) - block_size * old + a - 1) % 65521
+        weak = (b << 16) | a
+        pos += 1
+        if pos - literal >= DELTA_CHUNK_SIZE:
+            encoder.data(buffer[literal:pos])
+            literal = pos
+            if max_literal is not None and encoder.literal > max_literal:
+                # Mostly new data, a plain download is cheaper than rolling on
+                encoder.abort()
+                yield encoder.take()
+                return
+            yield encoder.take()
+
+
+class MetadataStore:
+    """SQLite database of the hashes of the repository files, kept in the
+    state folder so a restart only hashes the files that changed. A file is
+    matched by name, or by inode after a rename, with its size and
+    modification time. The size and modification time of the files in the
+    content-addressed object store are kept too, to detect a changed object."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "name TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, "
+            "content_hash TEXT, piece_size INTEGER, pieces BLOB, root TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_inode ON files (inode)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_root ON files (root)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)")
+        self.db.commit()
+
+    def get(self, name, size, mtime, inode):
+        """Get the hashes of a file if it did not change since they were stored.
+
+        Args:
+            name (str): the file's name in the repository
+            size (int): the file's size
+            mtime (int): the file's modification time in nanoseconds
+            inode (int): the file's inode
+
+        Returns:
+            dict: {"size", "mtime", "inode", "content_hash", "piece_size", "pieces", "root"},
+                or None if the file is unknown or changed
         """
+        query = "SELECT content_hash, piece_size, pieces, root FROM files WHERE size = ? AND mtime = ? AND inode = ?"
         with self.lock:
-            if not self.client_socket:
-                try:
-                    self.client_socket = socket.socket(
-                        socket.AF_INET, socket.SOCK_STREAM
-                    )
-                    self.client_socket.setsockopt(
-                        socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
+            row = self.db.execute(query + " AND name = ?", (size, mtime, inode, name)).fetchone()
+            if row is None:
+                # Renamed since it was hashed, store it under the new name too
+                row = self.db.execute(query + " LIMIT 1", (size, mtime, inode)).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO files SELECT ?, size, mtime, inode, content_hash, piece_size, pieces, root "
+                        "FROM files WHERE size = ? AND mtime = ? AND inode = ? LIMIT 1",
+                        (name, size, mtime, inode),
                     )
-                    self.client_socket.connect((self.server_host, self.server_port))
-                    self.server_connected = True
-                except Exception as e:
-                    self.log(f"Error connect to server: {e}")
-                    self.client_socket = None
-                    return None
+                    self.db.commit()
+        if row is None:
+            return None
+        content_hash, piece_size, pieces, root = row
+        return {
+            "size": size,
+            "mtime": mtime,
+            "inode": inode,
+            "content_hash": content_hash,
+            "piece_size": piece_size,
+            "pieces": [pieces[i:i + 32].hex() for i in range(0, len(pieces), 32)],
+            "root": root,
+        }
 
-        client_address = self.init_hostname(self.client_socket, hostname)
+    def put(self, name, info):
+        """Store the hashes of a file.
 
-        return client_address
+        Args:
+            name (str): the file's name in the repository
+            info (dict): the hashes, as returned by get
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    name,
+                    info["size"],
+                    info["mtime"],
+                    info["inode"],
+                    info["content_hash"],
+                    info["piece_size"],
+                    bytes.fromhex("".join(info["pieces"])),
+                    info["root"],
+                ),
+            )
+            self.db.commit()
 
-    def start(self, client_address):        
-        """Start the client with receiving messages from server
-        and listening for incoming connections from peers.
+    def remove(self, names):
+        """Forget removed files.
 
         Args:
-            client_address (tuple[str, int]): the client's address (hostname, port)
+            names (list[str]): the files' names in the repository
         """
-        self.receive_messages_thread = threading.Thread(
-            target=self.receive_messages, daemon=True, args=(self.client_socket,)
-        )
-        self.receive_messages_thread.start()
+        with self.lock:
+            self.db.executemany("DELETE FROM files WHERE name = ?", [(name,) for name in names])
+            self.db.commit()
 
-        self.listener_thread = threading.Thread(
-            target=self.start_listener, daemon=True, args=(client_address,)
-        )
-        self.listener_thread.start()
+    def prune(self, names):
+        """Forget the files that are not in the repository anymore.
 
-    def receive_messages(self, client_socket: socket.socket):
-        """Receive messages from the server.
+        Args:
+            names (list[str]): the names of the files in the repository
+        """
+        names = set(names)
+        with self.lock:
+            stored = [row[0] for row in self.db.execute("SELECT name FROM files")]
+        self.remove([name for name in stored if name not in names])
+
+    def find(self, root):
+        """Find the files with some content.
 
         Args:
-            client_socket (socket.socket): the client' socket
+            root (str): the Merkle root of the content
+
+        Returns:
+            list[str]: the names of the files last hashed with that root
         """
         with self.lock:
-            while not self.stop_threads and self.server_connected:
-                try:
-                    recvd_data = client_socket.recv(1024).decode("utf-8", "replace")
-                    if not recvd_data:
-                        self.log("Connection closed by the server.")
-                        break
-                    data = json.loads(recvd_data)
+            return [row[0] for row in self.db.execute("SELECT name FROM files WHERE root = ?", (root,))]
 
-                    if data["header"] == "fetch" and data["payload"] is not None:
-                        self.handle_fetch_sources(data)
-                    elif data["header"] == "discover" and data["payload"] is not None:
-                        self.handle_discover_sources(data)
-                    else:
-                        self.log(data["payload"]["message"])
-                except ConnectionResetError:
-                    self.log("Connection closed by the server.")
-                    break
-                except Exception as e:
-                    if self.stop_threads:
-                        break
-                    self.log(f"Error receiving messages: {e}")
-                    break
-            self.server_connected = False
+    def get_object(self, content_hash):
+        """Get the size and modification time of a stored object.
 
-    def start_listener(self, client_address):       
-        """Start the listener socket to accept incoming connections.
+        Args:
+            content_hash (str): the hex digest of the object's content
+
+        Returns:
+            tuple[int, int]: (size, mtime_ns) of the object when it was stored, or None
+        """
+        with self.lock:
+            return self.db.execute("SELECT size, mtime FROM objects WHERE hash = ?", (content_hash,)).fetchone()
+
+    def put_object(self, content_hash, size, mtime):
+        """Record a stored object.
 
         Args:
-            client_address (tuple[str, int]): the client's address (hostname, port)
+            content_hash (str): the hex digest of the object's content
+            size (int): the object's size
+            mtime (int): the object's modification time in nanoseconds
         """
-        self.listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.listener_socket.bind(client_address)
-        self.listener_socket.listen()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)", (content_hash, size, mtime))
+            self.db.commit()
 
-        while not self.stop_threads:
+    def remove_object(self, content_hash):
+        """Forget an object unless a repository file has it as content.
+
+        Args:
+            content_hash (str): the hex digest of the object's content
+
+        Returns:
+            bool: True if the object was forgotten
+        """
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM files WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone():
+                return False
+            self.db.execute("DELETE FROM objects WHERE hash = ?", (content_hash,))
+            self.db.commit()
+        return True
+
+    def prune_objects(self):
+        """Forget the objects that no repository file has as content.
+
+        Returns:
+            list[str]: the hex digests of the forgotten objects
+        """
+        with self.lock:
+            unused = [
+                row[0]
+                for row in self.db.execute(
+                    "SELECT hash FROM objects WHERE hash NOT IN (SELECT content_hash FROM files)"
+                )
+            ]
+            self.db.executemany("DELETE FROM objects WHERE hash = ?", [(content_hash,) for content_hash in unused])
+            self.db.commit()
+        return unused
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class RepositoryHasher(threading.Thread):
+    """Hash repository files in worker processes, one file per task, and
+    publish every file as soon as it is hashed, with progress reports, so
+    the client serves the hashed files while the others are processed."""
+
+    def __init__(self, client, names, workers=None):
+        super().__init__(daemon=True)
+        self.client = client
+        self.names = names
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self):
+        index = self.client.repository_index
+        entries = {name: index.lookup(name) for name in self.names}
+        entries = {name: entry for name, entry in entries.items() if entry is not None}
+        total = sum(entry[0] for entry in entries.values())
+        self.client.log(f"Hashing {len(entries)} files ({total / 2**20:.1f} MiB)...")
+
+        done_files = 0
+        done_bytes = 0
+        batch = []
+        last_report = time.monotonic()
+        for name, entry, result in self.hash_all(entries, total):
+            if result is not None:
+                self.client.store_file_pieces(name, entry, *result)
+                batch.append(name)
+            done_files += 1
+            done_bytes += entry[0]
+            if time.monotonic() - last_report >= HASH_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                self.client.log(
+                    f"Hashed {done_files} of {len(entries)} files "
+                    f"({done_bytes / 2**20:.1f} of {total / 2**20:.1f} MiB)"
+                )
+                self.client.publish_delta(self.client.client_socket, batch, [])
+                batch = []
+        if batch:
+            self.client.publish_delta(self.client.client_socket, batch, [])
+        self.client.log(f"Hashed {done_files} files")
+
+    def hash_all(self, entries, total):
+        """Hash files in worker processes, or in this thread if there is
+        little to hash or processes cannot be started.
+
+        Args:
+            entries (dict): name -> (size, mtime_ns, inode) of the files
+            total (int): number of bytes in the files
+
+        Yields:
+            tuple[str, tuple, tuple[list[str], str]]: the file's name, its
+                index entry and its hashes, None if it could not be read,
+                in the order the files are hashed
+        """
+        pending = dict(entries)
+        if self.workers > 1 and len(entries) > 1 and total >= HASH_POOL_MIN_BYTES:
             try:
-                client_socket, addr = self.listener_socket.accept()
-                threading.Thread(
-                    target=self.handle_client, args=(client_socket, addr)
-                ).start()
+                # Not forked: the client has threads running, which may hold locks
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method)) as pool:
+                    futures = {
+                        pool.submit(hash_file, os.path.join(self.client.repository_folder, name), PIECE_SIZE, True): name
+                        for name in entries
+                    }
+                    for future in as_completed(futures):
+                        name = futures[future]
+                        try:
+                            result = future.result()
+                        except OSError as e:
+                            self.client.log(f"Error hashing {name}: {e}")
+                            result = None
+                        yield name, pending.pop(name), result
+            except Exception as e:
+                # A worker died, e.g. a file was truncated while mapped
+                self.client.log(f"Hashing in worker processes failed, continuing in the client: {e}")
+        for name, entry in pending.items():
+            try:
+                result = hash_file(os.path.join(self.client.repository_folder, name))
             except OSError as e:
-                # Check if the error is due to stopping threads, ignore otherwise
-                if not self.stop_threads:
-                    self.log(f"Error accepting connection: {e}")
-                    break
+                self.client.log(f"Error hashing {name}: {e}")
+                result = None
+            yield name, entry, result
 
-    def handle_client(self, client_socket: socket.socket, client_address):    
-        """Handle an incoming connection.
+
+class RepositoryIndex:
+    """In-memory index of the files in the repository folder, so lookups do
+    not list the folder on every request. The folder is scanned once, then
+    kept up to date file by file: by the client when it adds or replaces a
+    file, and by the RepositoryWatcher for the changes made by others.
+    Lookups never scan the folder. The most recently served files are kept
+    open, to be read with os.pread by concurrent uploads."""
+
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        self.folder = None
+        self.max_open = max_open
+        self.files = {}  # name -> (size, mtime_ns, inode)
+        self.handles = collections.OrderedDict()  # name -> (file, mtime_ns), least recently used first
+        self.scanned = None  # Time of the last scan
+        self.lock = threading.Lock()
+
+    def set_folder(self, folder):
+        """Index another folder.
 
         Args:
-            client_socket (socket.socket): the peer' socket
-            client_address (tuple[str, int]): the peer's address (hostname, port)
+            folder (str): path to the repository folder, or None
         """
-        while not self.stop_threads:
-            raw_data = client_socket.recv(1024).decode("utf-8", "replace")
-            if not raw_data:
-                break
-            data = json.loads(raw_data)
-
-            if data["header"] == "ping":
-                response = {
-                    "header": "ping",
-                    "type": 1,
-                    "payload": {"success": True, "message": "pong"},
-                }
-                client_socket.sendall(json.dumps(response).encode("utf-8", "replace"))
-                client_socket.close()
-                break
-            if data["header"] == "download":
-                self.send_file(client_socket, data["payload"]["fname"])
-                client_socket.close()
-                break
+        with self.lock:
+            self.folder = folder
+            self.files = {}
+            self.handles.clear()
+            self.scanned = None
 
-    def connect_publish(self, client_socket: socket.socket): 
-        """Publish existing file in client's repository on connection.
+    def refresh(self, force=False):
+        """Scan the folder if it was not scanned yet.
+
+        Args:
+            force (bool): scan even if the folder was scanned already
+        """
+        with self.lock:
+            if self.folder is None or (not force and self.scanned is not None):
+                return
+            self.scanned = time.monotonic()
+            folder = self.folder
+
+        files = {}
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file():
+                            file_stat = entry.stat()
+                            files[entry.name] = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+
+        with self.lock:
+            if folder != self.folder:
+                return
+            self.files = files
+            for name, (_, mtime) in list(self.handles.items()):
+                if name not in files or files[name][1] != mtime:
+                    del self.handles[name]
+
+    def update(self, name):
+        """Index a file again, e.g. after the client added or changed it.
+
+        Args:
+            name (str): the file's name in the repository
+
+        Returns:
+            tuple[int, int, int]: (size, mtime_ns, inode), or None if it is not a file
+        """
+        if self.folder is None or name in ("", ".", "..") or os.path.basename(name) != name:
+            return None
+        info = None
+        try:
+            file_stat = os.stat(os.path.join(self.folder, name))
+            if stat.S_ISREG(file_stat.st_mode):
+                info = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+        except OSError:
+            pass
+        with self.lock:
+            if info is None:
+                self.files.pop(name, None)
+                self.handles.pop(name, None)
+            else:
+                self.files[name] = info
+        return info
+
+    def lookup(self, name):
+        """Find a file in the index, without scanning the folder.
+
+        Args:
+            name (str): the file's name in the repository
+
+        Returns:
+            tuple[int, int, int]: (size, mtime_ns, inode), or None if there is no such file
+        """
+        with self.lock:
+            info = self.files.get(name)
+        if info is None:
+            # Maybe added before the watcher noticed it, a stat of this file only
+            info = self.update(name)
+        return info
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def names(self):
+        """List the files in the repository.
+
+        Returns:
+            list[str]: the files' names, sorted
+        """
+        self.refresh()
+        with self.lock:
+            return sorted(self.files)
+
+    def snapshot(self):
+        """Scan the folder and copy the index.
+
+        Returns:
+            dict: name -> (size, mtime_ns, inode)
+        """
+        self.refresh(force=True)
+        with self.lock:
+            return dict(self.files)
+
+    def open(self, name):
+        """Get an open handle of a file, reusing the one of a previous upload
+        while the file is unchanged. Evicted handles are closed once the
+        uploads still using them drop them.
+
+        Args:
+            name (str): the file's name in the repository
+
+        Returns:
+            file: the file opened for reading in binary mode, or None if there is no such file
+        """
+        info = self.lookup(name)
+        if info is None:
+            return None
+        with self.lock:
+            handle = self.handles.get(name)
+            if handle is not None and handle[1] == info[1]:
+                self.handles.move_to_end(name)
+                return handle[0]
+        try:
+            file = open(os.path.join(self.folder, name), "rb", buffering=0)
+        except OSError:
+            self.update(name)
+            return None
+        with self.lock:
+            self.handles[name] = (file, info[1])
+            self.handles.move_to_end(name)
+            while len(self.handles) > self.max_open:
+                self.handles.popitem(last=False)
+        return file
+
+
+class InotifyWatch:
+    """Watch the files of a folder with the Linux inotify API, through ctypes."""
+
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, folder):
+        self.folder = folder
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {folder}")
+
+    def read(self, timeout):
+        """Wait for events.
+
+        Args:
+            timeout (float): seconds to wait
+
+        Returns:
+            tuple[set[str], bool]: the names of the changed files, and whether
+                events were lost and the folder must be scanned
+        """
+        names = set()
+        rescan = False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return names, rescan
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names, rescan
+        offset = 0
+        while offset + 16 <= len(data):
+            _, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF):
+                rescan = True
+            elif name and (not mask & IN_CREATE or self.complete(os.fsdecode(name))):
+                names.add(os.fsdecode(name))
+        return names, rescan
+
+    def complete(self, name):
+        """Tell whether a created entry is complete already. Hard links and
+        symbolic links are, and get no other event; a new file being written
+        is not, it is reported once it is closed.
+
+        Args:
+            name (str): the entry's name in the folder
+
+        Returns:
+            bool: True if the entry is a link, False otherwise
+        """
+        try:
+            entry_stat = os.lstat(os.path.join(self.folder, name))
+        except OSError:
+            return False
+        return stat.S_ISLNK(entry_stat.st_mode) or stat.S_ISREG(entry_stat.st_mode) and entry_stat.st_nlink > 1
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RepositoryWatcher(threading.Thread):
+    """Watch the repository folder, with inotify or by scanning it every
+    interval seconds, and announce the added, changed and removed files to
+    the server in batches once no change happened for batch_delay seconds."""
+
+    def __init__(self, client, interval=WATCH_INTERVAL, batch_delay=WATCH_BATCH_DELAY):
+        super().__init__(daemon=True)
+        self.client = client
+        self.interval = interval
+        self.batch_delay = batch_delay
+        self.published = {}  # name -> (size, mtime_ns) of the announced files
+        self.stopped = threading.Event()
+
+    def run(self):
+        index = self.client.repository_index
+        # The files found at connection are announced by connect_publish
+        self.published = {name: info[:2] for name, info in index.snapshot().items()}
+        try:
+            inotify = InotifyWatch(self.client.repository_folder)
+        except (OSError, AttributeError, TypeError):
+            # Not on Linux, fall back to scanning the folder
+            inotify = None
+
+        pending = set()
+        first_change = None
+        try:
+            while not self.stopped.is_set() and not self.client.stop_threads:
+                timeout = self.batch_delay if pending else self.interval
+                if inotify is not None:
+                    changed, rescan = inotify.read(timeout)
+                    if rescan:
+                        changed |= self.scan()
+                    # Uploads see the change now, the server once the batch is sent
+                    for name in changed:
+                        index.update(name)
+                else:
+                    self.stopped.wait(timeout)
+                    changed = self.scan()
+
+                if changed:
+                    pending |= changed
+                    first_change = first_change or time.monotonic()
+                    # Keep batching while files keep changing, up to interval seconds
+                    if time.monotonic() - first_change < max(self.interval, self.batch_delay):
+                        continue
+                if pending:
+                    self.flush(pending)
+                    pending = set()
+                    first_change = None
+        except Exception as e:
+            self.client.log(f"Error watching the repository: {e}")
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def scan(self):
+        """Compare the folder with the announced files.
+
+        Returns:
+            set[str]: the names of the files added, changed or removed since they were announced
+        """
+        files = self.client.repository_index.snapshot()
+        changed = {name for name, info in files.items() if self.published.get(name) != info[:2]}
+        changed.update(name for name in self.published if name not in files)
+        return changed
+
+    def flush(self, names):
+        """Announce the changed files.
+
+        Args:
+            names (set[str]): the names of the files that changed
+        """
+        added, removed = [], []
+        for name in sorted(names):
+            info = self.client.repository_index.update(name)
+            if info is None:
+                if self.published.pop(name, None) is not None:
+                    removed.append(name)
+            elif self.published.get(name) != info[:2]:
+                self.published[name] = info[:2]
+                added.append(name)
+        if added or removed:
+            self.client.publish_delta(self.client.client_socket, added, removed)
+
+    def stop(self):
+        """Stop watching."""
+        self.stopped.set()
+
+
+class PeerConnectionPool:
+    """Idle keep-alive connections to peers, keyed by peer address."""
+
+    def __init__(self, connect, idle_timeout=POOL_IDLE_TIMEOUT, max_idle_per_peer=4):
+        self.connect = connect  # Function opening a new connection to an address
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_peer = max_idle_per_peer
+        self.idle = {}  # address -> [(socket, time it was released)]
+        self.lock = threading.Lock()
+        self.reaper_thread = None
+
+    def acquire(self, address):
+        """Get a connection to a peer, reusing an idle one when possible.
+
+        Args:
+            address (tuple[str, int]): the peer's address (hostname, port)
+
+        Returns:
+            socket: the socket connected to the peer, or None
+        """
+        with self.lock:
+            connections = self.idle.get(address, [])
+            while connections:
+                sock, released = connections.pop()
+                if time.monotonic() - released < self.idle_timeout and self.is_alive(sock):
+                    return sock
+                sock.close()
+        return self.connect(address)
+
+    def release(self, address, sock):
+        """Give back a connection in a clean state, ready for another request.
+
+        Args:
+            address (tuple[str, int]): the peer's address (hostname, port)
+            sock (socket): the socket connected to the peer
+        """
+        with self.lock:
+            connections = self.idle.setdefault(address, [])
+            if len(connections) >= self.max_idle_per_peer:
+                sock.close()
+                return
+            connections.append((sock, time.monotonic()))
+            if self.reaper_thread is None:
+                self.reaper_thread = threading.Thread(target=self.reap, daemon=True)
+                self.reaper_thread.start()
+
+    def discard(self, sock):
+        """Close a connection that is broken or in an unknown state.
+
+        Args:
+            sock (socket): the socket connected to the peer
+        """
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def reap(self):
+        """Close the connections idle for longer than idle_timeout,
+        until the pool is empty."""
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            with self.lock:
+                now = time.monotonic()
+                for address in list(self.idle):
+                    alive = []
+                    for sock, released in self.idle[address]:
+                        if now - released < self.idle_timeout:
+                            alive.append((sock, released))
+                        else:
+                            sock.close()
+                    if alive:
+                        self.idle[address] = alive
+                    else:
+                        del self.idle[address]
+                if not self.idle:
+                    self.reaper_thread = None
+                    return
+
+    def close_all(self):
+        """Close every idle connection."""
+        with self.lock:
+            for connections in self.idle.values():
+                for sock, _ in connections:
+                    sock.close()
+            self.idle.clear()
+
+    @staticmethod
+    def is_alive(sock):
+        """Check that an idle connection was not closed by the peer.
+
+        An idle connection has nothing to read, so a readable socket means
+        the peer closed it (or sent unexpected data).
+
+        Args:
+            sock (socket): the socket connected to the peer
+
+        Returns:
+            bool: True if the connection can be reused
+        """
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+
+class TokenBucket:
+    """Token bucket holding up to burst bytes, refilled at rate bytes per second."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """Change the refill rate, keeping the tokens already in the bucket.
+
+        Args:
+            rate (float): the new rate in bytes per second
+        """
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.burst = rate
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, amount):
+        """Take tokens for sending amount bytes, going into debt if there are
+        not enough of them.
+
+        Args:
+            amount (int): number of bytes about to be sent
+
+        Returns:
+            float: seconds to wait before sending
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateMeter:
+    """Transfer rate averaged with an exponential decay over RATE_WINDOW seconds."""
+
+    def __init__(self):
+        self.value = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, amount):
+        """Count transferred bytes.
+
+        Args:
+            amount (int): number of bytes transferred
+        """
+        with self.lock:
+            self.decay()
+            self.value += amount
+
+    def rate(self):
+        """Get the current rate.
+
+        Returns:
+            float: bytes per second
+        """
+        with self.lock:
+            self.decay()
+            return self.value / RATE_WINDOW
+
+    def decay(self):
+        now = time.monotonic()
+        self.value *= math.exp(-(now - self.updated) / RATE_WINDOW)
+        self.updated = now
+
+
+class UploadShaper:
+    """Upload rate limits. The global limit is shared fairly by giving every
+    active upload its own bucket refilled at an equal share of the global
+    rate, and every peer host has a bucket for the per-peer limit."""
+
+    def __init__(self, global_rate=None, peer_rate=None):
+        self.global_rate = global_rate  # Bytes per second for all uploads, None for no limit
+        self.peer_rate = peer_rate  # Bytes per second for each peer host, None for no limit
+        self.uploads = {}  # upload id -> {"peer", "bucket", "meter"}
+        self.peer_buckets = {}  # peer host -> TokenBucket
+        self.peer_meters = {}  # peer host -> RateMeter
+        self.meter = RateMeter()
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def set_limits(self, global_rate=None, peer_rate=None):
+        """Change the rate limits.
+
+        Args:
+            global_rate (float): bytes per second for all uploads, None for no limit
+            peer_rate (float): bytes per second for each peer host, None for no limit
+        """
+        with self.lock:
+            self.global_rate = global_rate
+            self.peer_rate = peer_rate
+            self.peer_buckets.clear()
+            self.share_global_rate()
+
+    def start(self, peer):
+        """Register an upload to a peer.
+
+        Args:
+            peer (str): the peer's host
+
+        Returns:
+            int: the upload id to pass to throttle and finish
+        """
+        with self.lock:
+            upload_id = self.next_id
+            self.next_id += 1
+            self.uploads[upload_id] = {"peer": peer, "bucket": None, "meter": RateMeter()}
+            self.peer_meters.setdefault(peer, RateMeter())
+            self.share_global_rate()
+            return upload_id
+
+    def finish(self, upload_id):
+        """Unregister an upload, giving its share of the global rate to the others.
+
+        Args:
+            upload_id (int): the upload id
+        """
+        with self.lock:
+            upload = self.uploads.pop(upload_id, None)
+            if upload and not any(other["peer"] == upload["peer"] for other in self.uploads.values()):
+                self.peer_meters.pop(upload["peer"], None)
+            self.share_global_rate()
+
+    def throttle(self, upload_id, amount):
+        """Account for amount bytes about to be sent by an upload.
+
+        Args:
+            upload_id (int): the upload id
+            amount (int): number of bytes about to be sent
+
+        Returns:
+            float: seconds to wait before sending
+        """
+        with self.lock:
+            upload = self.uploads[upload_id]
+            bucket = upload["bucket"]
+            peer_bucket = None
+            if self.peer_rate:
+                peer_bucket = self.peer_buckets.get(upload["peer"])
+                if peer_bucket is None:
+                    peer_bucket = self.peer_buckets[upload["peer"]] = TokenBucket(self.peer_rate)
+            peer_meter = self.peer_meters.get(upload["peer"])
+        upload["meter"].add(amount)
+        self.meter.add(amount)
+        if peer_meter is not None:
+            peer_meter.add(amount)
+        delay = bucket.reserve(amount) if bucket else 0.0
+        if peer_bucket:
+            delay = max(delay, peer_bucket.reserve(amount))
+        return delay
+
+    def share_global_rate(self):
+        """Give every active upload an equal share of the global rate."""
+        for upload in self.uploads.values():
+            if not self.global_rate:
+                upload["bucket"] = None
+                continue
+            share = self.global_rate / len(self.uploads)
+            if upload["bucket"] is None:
+                upload["bucket"] = TokenBucket(share)
+            else:
+                upload["bucket"].set_rate(share)
+
+    def stats(self):
+        """Get the limits and the current upload rates.
+
+        Returns:
+            dict: {"global_limit", "peer_limit", "active", "rate", "peers"}
+        """
+        with self.lock:
+            peers = {peer: meter.rate() for peer, meter in self.peer_meters.items()}
+            return {
+                "global_limit": self.global_rate,
+                "peer_limit": self.peer_rate,
+                "active": len(self.uploads),
+                "rate": self.meter.rate(),
+                "peers": peers,
+            }
+
+
+class UploadSlots:
+    """Bounded pool of upload slots. Uploads beyond the slots wait in a
+    bounded queue, and are turned away with a retry delay when it is full
+    or the wait times out."""
+
+    def __init__(self, slots=MAX_UPLOAD_SLOTS, queue_size=UPLOAD_QUEUE_SIZE, wait=UPLOAD_QUEUE_TIMEOUT):
+        self.slots = slots
+        self.queue_size = queue_size
+        self.wait = wait
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.average_duration = 1.0  # Seconds, averaged over the recent uploads
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free upload slot.
+
+        Returns:
+            float: the time the slot was taken, to pass to release, or None if
+                the queue is full or the wait timed out
+        """
+        with self.condition:
+            if self.active >= self.slots:
+                if self.waiting >= self.queue_size:
+                    self.rejected += 1
+                    return None
+                self.waiting += 1
+                deadline = time.monotonic() + self.wait
+                while self.active >= self.slots:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                self.waiting -= 1
+                if self.active >= self.slots:
+                    self.rejected += 1
+                    return None
+            self.active += 1
+            return time.monotonic()
+
+    def try_acquire(self):
+        """Take a free upload slot without waiting.
+
+        Returns:
+            float: the time the slot was taken, to pass to release, or None if
+                every slot is taken
+        """
+        with self.condition:
+            if self.active >= self.slots:
+                return None
+            self.active += 1
+            return time.monotonic()
+
+    def enter_queue(self):
+        """Count an upload waiting for a slot on its own, e.g. in an event loop.
+
+        Returns:
+            bool: True if the upload may wait, False if the queue is full
+        """
+        with self.condition:
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            return True
+
+    def leave_queue(self, served):
+        """Stop counting an upload that waited with enter_queue.
+
+        Args:
+            served (bool): whether the upload got a slot
+        """
+        with self.condition:
+            self.waiting -= 1
+            if not served:
+                self.rejected += 1
+
+    def release(self, started):
+        """Free an upload slot.
+
+        Args:
+            started (float): the value returned by acquire
+        """
+        with self.condition:
+            self.active -= 1
+            self.average_duration = 0.8 * self.average_duration + 0.2 * (time.monotonic() - started)
+            self.condition.notify()
+
+    def retry_after(self):
+        """Estimate when a slot will be free for a turned away upload.
+
+        Returns:
+            int: milliseconds to wait before retrying
+        """
+        with self.condition:
+            delay = self.average_duration * (self.waiting + 1) / self.slots
+        return int(min(max(delay, 0.25), 30.0) * 1000)
+
+    def stats(self):
+        """Get the usage of the slots.
+
+        Returns:
+            dict: {"slots", "active", "waiting", "rejected"}
+        """
+        with self.condition:
+            return {
+                "slots": self.slots,
+                "active": self.active,
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+            }
+
+
+class BlockCache:
+    """Bounded LRU cache of file blocks read by the uploads, shared by the
+    upload threads, so a popular file is read from disk once for many peers.
+    Blocks are keyed by the file's name, size, modification time and inode,
+    so a changed file is read again and its old blocks age out."""
+
+    def __init__(self, max_size=BLOCK_CACHE_SIZE, block_size=BLOCK_CACHE_BLOCK_SIZE):
+        self.max_size = max_size
+        self.block_size = block_size
+        self.size = 0
+        self.blocks = collections.OrderedDict()  # (file key, block index) -> bytes, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def read(self, key, file, offset, length):
+        """Read a byte range of a file through the cache.
+
+        Args:
+            key (tuple): identity of the file's version, e.g. (name, size, mtime_ns, inode)
+            file (file): the file, read with explicit offsets on a miss
+            offset (int): first byte of the range
+            length (int): number of bytes to read
+
+        Returns:
+            bytes: the content, shorter than length if the file ends before
+        """
+        data = bytearray()
+        end = offset + length
+        while offset < end:
+            index = offset // self.block_size
+            block = self.block(key, file, index)
+            start = offset - index * self.block_size
+            chunk = block[start:start + end - offset]
+            if not chunk:
+                break
+            data += chunk
+            offset += len(chunk)
+        return bytes(data)
+
+    def block(self, key, file, index):
+        """Get a block of a file, reading it from disk on a miss.
+
+        Args:
+            key (tuple): identity of the file's version
+            file (file): the file
+            index (int): index of the block
+
+        Returns:
+            bytes: the block, shorter than block_size at the end of the file
+        """
+        with self.lock:
+            block = self.blocks.get((key, index))
+            if block is not None:
+                self.blocks.move_to_end((key, index))
+                self.hits += 1
+                return block
+            self.misses += 1
+        block = os.pread(file.fileno(), self.block_size, index * self.block_size)
+        with self.lock:
+            if (key, index) not in self.blocks and len(block) <= self.max_size:
+                self.blocks[(key, index)] = block
+                self.size += len(block)
+                while self.size > self.max_size:
+                    _, evicted = self.blocks.popitem(last=False)
+                    self.size -= len(evicted)
+                    self.evictions += 1
+        return block
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.size = 0
+
+    def stats(self):
+        """Get the usage and hit rate of the cache.
+
+        Returns:
+            dict: {"size", "max_size", "blocks", "hits", "misses", "evictions", "hit_rate"}
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self.size,
+                "max_size": self.max_size,
+                "blocks": len(self.blocks),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+
+class PeerScores:
+    """Measured connect latency, download throughput and failure rate of
+    each peer, used to rank the holders of a file by the time a download
+    from them is expected to take. A peer never measured is assumed as fast
+    as the fastest one known, so new peers get tried."""
+
+    def __init__(self, alpha=PEER_SCORE_ALPHA, decay=PEER_SCORE_DECAY):
+        self.alpha = alpha
+        self.decay = decay
+        self.peers = {}  # address -> {"rtt", "throughput", "successes", "failures"}
+        self.lock = threading.Lock()
+
+    def peer(self, address):
+        return self.peers.setdefault(
+            tuple(address), {"rtt": None, "throughput": None, "successes": 0.0, "failures": 0.0}
+        )
+
+    def average(self, old, new):
+        return new if old is None else (1 - self.alpha) * old + self.alpha * new
+
+    def record_connect(self, address, seconds):
+        """Record the time a connection to a peer took to open.
+
+        Args:
+            address (tuple[str, int]): the peer's address (hostname, port)
+            seconds (float): the connect latency
+        """
+        with self.lock:
+            peer = self.peer(address)
+            peer["rtt"] = self.average(peer["rtt"], seconds)
+
+    def record_download(self, address, size, seconds):
+        """Record a successful download from a peer.
+
+        Args:
+            address (tuple[str, int]): the peer's address (hostname, port)
+            size (int): bytes received
+            seconds (float): time the download took
+        """
+        with self.lock:
+            peer = self.peer(address)
+            if size >= PEER_MIN_SAMPLE and seconds > 0:
+                peer["throughput"] = self.average(peer["throughput"], size / seconds)
+            peer["successes"] = peer["successes"] * self.decay + 1
+            peer["failures"] *= self.decay
+
+    def record_failure(self, address):
+        """Record a failed connection or download.
+
+        Args:
+            address (tuple[str, int]): the peer's address (hostname, port)
+        """
+        with self.lock:
+            peer = self.peer(address)
+            peer["failures"] = peer["failures"] * self.decay + 1
+            peer["successes"] *= self.decay
+
+    def expected_time(self, address, size):
+        """Estimate the time a download from a peer will take, made longer
+        by the share of the peer's recent transfers that failed.
+
+        Args:
+            address (tuple[str, int]): the peer's address (hostname, port)
+            size (int): bytes to download, None if unknown
+
+        Returns:
+            float: the estimate in seconds
+        """
+        with self.lock:
+            peer = self.peers.get(tuple(address))
+            known = [other["throughput"] for other in self.peers.values() if other["throughput"]]
+            default = max(known) if known else PEER_DEFAULT_THROUGHPUT
+            if peer is None:
+                return (size or 0) / default
+            reliability = (peer["successes"] + 1) / (peer["successes"] + peer["failures"] + 2)
+            seconds = (peer["rtt"] or 0) + (size or 0) / (peer["throughput"] or default)
+            return seconds / reliability
+
+    def rank(self, addresses, size):
+        """Sort peers from the fastest expected download to the slowest.
+
+        Args:
+            addresses (list[tuple[str, int]]): the peers' addresses
+            size (int): bytes to download, None if unknown
+
+        Returns:
+            list[tuple[str, int]]: the addresses, sorted
+        """
+        return sorted(addresses, key=lambda address: self.expected_time(address, size))
+
+    def stats(self):
+        """Get the scores of the peers.
+
+        Returns:
+            dict: {"host:port": {"rtt", "throughput", "successes", "failures"}}
+        """
+        with self.lock:
+            return {f"{address[0]}:{address[1]}": dict(peer) for address, peer in self.peers.items()}
+
+
+class Transfer:
+    """Measurements of one upload or download of a file: bytes, time to the
+    first byte of data and stalls, gaps of STALL_TIME seconds or more
+    between two chunks of data."""
+
+    def __init__(self, direction, peer, fname, kind="file", retries=0):
+        self.direction = direction  # "upload" | "download"
+        self.peer = peer  # "host:port"
+        self.fname = fname
+        self.kind = kind  # "file" | "delta" | "range"
+        self.retries = retries  # Earlier attempts of the same download job
+        self.offset = 0  # First byte of the file transferred
+        self.size = None  # Size of the file
+        self.compression = None
+        self.bytes = 0  # Bytes of the file transferred, before compression
+        self.time = time.time()
+        self.started = time.monotonic()
+        self.first_byte = None  # Seconds from the start to the first chunk of data
+        self.last = self.started  # When the last chunk of data moved
+        self.stalls = 0
+        self.stalled = 0.0  # Seconds spent in stalls
+        self.throttled = 0.0  # Seconds waited for the upload rate limits
+        self.duration = None
+        self.success = None
+
+    def data(self, amount):
+        """Count a chunk of data.
+
+        Args:
+            amount (int): bytes of the file in the chunk
+        """
+        now = time.monotonic()
+        if self.first_byte is None:
+            self.first_byte = now - self.started
+        elif now - self.last >= STALL_TIME:
+            self.stalls += 1
+            self.stalled += now - self.last
+        self.last = now
+        self.bytes += amount
+
+    def throttle(self, seconds):
+        """Count a wait for the upload rate limits, which is not a stall.
+
+        Args:
+            seconds (float): the wait
+        """
+        self.throttled += seconds
+        self.last += seconds
+
+    def finish(self, success):
+        """Mark the transfer as ended.
+
+        Args:
+            success (bool): whether the transfer succeeded
+        """
+        now = time.monotonic()
+        if self.first_byte is not None and now - self.last >= STALL_TIME:
+            # Ended by a stall, such as a peer that stopped sending
+            self.stalls += 1
+            self.stalled += now - self.last
+        self.duration = now - self.started
+        self.success = bool(success)
+
+    def describe(self):
+        """Get the measurements of the transfer.
+
+        Returns:
+            dict: {"direction", "peer", "fname", "kind", "time", "offset", "size",
+                "bytes", "compression", "duration", "throughput", "first_byte",
+                "retries", "stalls", "stalled", "throttled", "success"}
+        """
+        duration = self.duration if self.duration is not None else time.monotonic() - self.started
+        return {
+            "direction": self.direction,
+            "peer": self.peer,
+            "fname": self.fname,
+            "kind": self.kind,
+            "time": self.time,
+            "offset": self.offset,
+            "size": self.size,
+            "bytes": self.bytes,
+            "compression": self.compression,
+            "duration": duration,
+            "throughput": self.bytes / duration if duration > 0 else None,
+            "first_byte": self.first_byte,
+            "retries": self.retries,
+            "stalls": self.stalls,
+            "stalled": self.stalled,
+            "throttled": self.throttled,
+            "success": self.success,
+        }
+
+
+def filter_transfers(transfers, direction=None, peer=None):
+    """Select the measurements of some transfers.
+
+    Args:
+        transfers (list[dict]): the measurements, see Transfer.describe
+        direction (str): "upload" or "download" to keep only those
+        peer (str): "host" or "host:port" to keep only the transfers with the peer
+
+    Returns:
+        list[dict]: the measurements kept, in the same order
+    """
+    return [
+        transfer
+        for transfer in transfers
+        if direction in (None, transfer["direction"])
+        and peer in (None, transfer["peer"], transfer["peer"].rsplit(":", 1)[0])
+    ]
+
+
+class TransferStats:
+    """The running uploads and downloads and the last TRANSFER_HISTORY_SIZE
+    finished ones, with totals by direction and by peer."""
+
+    def __init__(self, history_size=TRANSFER_HISTORY_SIZE):
+        self.active = set()
+        self.history = collections.deque(maxlen=history_size)
+        self.lock = threading.Lock()
+
+    def start(self, direction, peer, fname, kind="file", retries=0):
+        """Start measuring a transfer.
+
+        Args:
+            direction (str): "upload" or "download"
+            peer (tuple[str, int]): the peer's address (hostname, port)
+            fname (str): the file's name
+            kind (str): "file", "delta" or "range"
+            retries (int): earlier attempts of the same download job
+
+        Returns:
+            Transfer: the transfer, to count its data and finish
+        """
+        transfer = Transfer(direction, f"{peer[0]}:{peer[1]}", fname, kind, retries)
+        with self.lock:
+            self.active.add(transfer)
+        return transfer
+
+    def finish(self, transfer, success):
+        """End a transfer and keep its measurements.
+
+        Args:
+            transfer (Transfer): the transfer
+            success (bool): whether the transfer succeeded
+        """
+        transfer.finish(success)
+        with self.lock:
+            self.active.discard(transfer)
+            self.history.append(transfer)
+
+    def list(self, direction=None, peer=None):
+        """List the measurements of the transfers, oldest first, running ones last.
+
+        Args:
+            direction (str): "upload" or "download" to list only those
+            peer (str): "host" or "host:port" to list only the transfers with the peer
+
+        Returns:
+            list[dict]: the measurements, see Transfer.describe
+        """
+        with self.lock:
+            transfers = list(self.history) + sorted(self.active, key=lambda transfer: transfer.started)
+        return filter_transfers([transfer.describe() for transfer in transfers], direction, peer)
+
+    def summary(self):
+        """Total the finished transfers by direction and by peer.
+
+        Returns:
+            dict: {"upload": totals, "download": totals, "peers": {"host:port": {"upload": totals,
+                "download": totals}}} where the totals are {"count", "failed", "bytes",
+                "seconds", "throughput", "first_byte", "retries", "stalls"}, with the
+                average time to the first byte
+        """
+        summary = {"upload": self.totals(), "download": self.totals(), "peers": {}}
+        with self.lock:
+            transfers = list(self.history)
+        for transfer in transfers:
+            peer = summary["peers"].setdefault(transfer.peer, {"upload": self.totals(), "download": self.totals()})
+            for totals in (summary[transfer.direction], peer[transfer.direction]):
+                totals["count"] += 1
+                totals["failed"] += not transfer.success
+                totals["bytes"] += transfer.bytes
+                totals["seconds"] += transfer.duration
+                totals["first_byte"] += transfer.first_byte or 0
+                totals["retries"] += transfer.retries
+                totals["stalls"] += transfer.stalls
+        for totals in [summary["upload"], summary["download"]] + [
+            peer[direction] for peer in summary["peers"].values() for direction in ("upload", "download")
+        ]:
+            totals["throughput"] = totals["bytes"] / totals["seconds"] if totals["seconds"] > 0 else None
+            totals["first_byte"] = totals["first_byte"] / totals["count"] if totals["count"] else None
+        return summary
+
+    @staticmethod
+    def totals():
+        return {
+            "count": 0, "failed": 0, "bytes": 0, "seconds": 0.0, "throughput": None,
+            "first_byte": 0.0, "retries": 0, "stalls": 0,
+        }
+
+    def report(self):
+        """Get the measurements of the transfers and their totals.
+
+        Returns:
+            dict: {"time": when the report was made, "summary": see summary,
+                "transfers": see list}
+        """
+        return {"time": time.time(), "summary": self.summary(), "transfers": self.list()}
+
+    def dump(self, path):
+        """Write the measurements of the transfers and their totals to a JSON file.
+
+        Args:
+            path (str): the file's path
+        """
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=2)
+
+
+class DownloadJob:
+    """A queued fetch of one file, with its progress."""
+
+    def __init__(self, job_id, sources, priority=0):
+        self.id = job_id
+        self.fname = sources["fname"]
+        self.root = sources.get("root")
+        self.sources = sources  # Payload of the fetch response from the server
+        self.priority = priority  # Jobs with higher priority run first
+        self.state = "queued"  # queued | active | done | up to date | failed | cancelled
+        self.peer = None
+        # Size published by the holders until the download starts
+        self.size = next((client["size"] for client in sources["available_clients"] if client.get("size")), None)
+        self.bytes_done = 0
+        self.verified = 0  # Bytes at the start of the partial file verified and written to disk
+        self.start_offset = 0  # Bytes already on disk when the transfer started
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self.failed_peers = set()  # Holders a download from failed, the job moves on to the others
+        self.attempts = 0  # Times the job was started, against any holder
+        self.ended = threading.Event()  # Set once the job is done, failed or cancelled
+
+    def finish(self, state):
+        """Mark the job as ended.
+
+        Args:
+            state (str): "done", "up to date", "failed" or "cancelled"
+        """
+        self.state = state
+        self.finished = time.monotonic()
+        self.ended.set()
+
+    def throughput(self):
+        """Get the average download rate of the job.
+
+        Returns:
+            float: bytes per second received since the job started
+        """
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return (self.bytes_done - self.start_offset) / elapsed if elapsed > 0 else 0.0
+
+    def progress(self):
+        """Get the progress of the job.
+
+        Returns:
+            dict: {"id", "fname", "state", "priority", "peer", "bytes", "size", "throughput"}
+        """
+        return {
+            "id": self.id,
+            "fname": self.fname,
+            "state": self.state,
+            "priority": self.priority,
+            "peer": self.peer,
+            "bytes": self.bytes_done,
+            "size": self.size,
+            "throughput": self.throughput(),
+        }
+
+    def describe(self):
+        """Describe the progress of the job on one line.
+
+        Returns:
+            str: the description
+        """
+        line = f"#{self.id} {self.fname} [{self.state}] priority {self.priority}"
+        if self.size:
+            line += f", {self.bytes_done} of {self.size} bytes ({100 * self.bytes_done // self.size}%)"
+        if self.started is not None:
+            line += f", {self.throughput() / 1024:.1f} KiB/s from {self.peer}"
+        return line
+
+
+class FetchRequest:
+    """Pending fetch of one file, answered once the server's response is
+    handled, see FileClient.fetch."""
+
+    def __init__(self, file_name, priority=0):
+        self.fname = file_name
+        self.priority = priority
+        self.job = None  # The queued download job, if any
+        self.result = None  # queued | not found
+        self.answered = threading.Event()
+
+    def answer(self, result, job=None):
+        """Record the outcome of the fetch.
+
+        Args:
+            result (str): "queued" with the job, or "not found"
+            job (DownloadJob): the queued job
+        """
+        self.job = job
+        self.result = result
+        self.answered.set()
+
+    def wait(self, timeout=None):
+        """Wait for the answer to the fetch and for the job it queued to end.
+
+        Args:
+            timeout (float): seconds to wait, None for no limit
+
+        Returns:
+            bool: True if the fetch has ended
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self.answered.wait(timeout):
+            return False
+        if self.job is None:
+            return True
+        return self.job.ended.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def state(self):
+        """Get the state of the fetch.
+
+        Returns:
+            str: "waiting" until the server answers, the job's state if one
+                was queued, else the answer
+        """
+        if not self.answered.is_set():
+            return "waiting"
+        return self.job.state if self.job is not None else self.result
+
+
+class DownloadManager:
+    """Queue of download jobs run by a bounded number of worker threads,
+    with a limit on the jobs running against the same peer."""
+
+    def __init__(self, client, max_active=MAX_ACTIVE_DOWNLOADS, max_per_peer=MAX_DOWNLOADS_PER_PEER,
+                 batch_size=DOWNLOAD_BATCH_SIZE, max_ended=MAX_ENDED_JOBS):
+        self.client = client
+        self.max_active = max_active
+        self.max_per_peer = max_per_peer
+        self.batch_size = batch_size
+        self.max_ended = max_ended
+        self.queue = []  # Heap of (-priority, job id, job)
+        self.jobs = {}  # job id -> job, in the order they were submitted
+        self.peer_active = {}  # address -> jobs batches running against the peer
+        self.busy_until = {}  # address -> time until which the peer turns downloads away
+        self.condition = threading.Condition()
+        self.next_id = 1
+        self.workers = []
+
+    def submit(self, sources, priority=0):
+        """Queue a download job.
+
+        Args:
+            sources (dict): payload of the fetch response for the file
+            priority (int): jobs with higher priority run first
+
+        Returns:
+            DownloadJob: the queued job
+        """
+        with self.condition:
+            self.prune()
+            job = DownloadJob(self.next_id, sources, priority)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (-priority, job.id, job))
+            while len(self.workers) < self.max_active:
+                worker = threading.Thread(target=self.work, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            self.condition.notify_all()
+        return job
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job. A running job stops at its next
+        received chunk and keeps its partial download for a later fetch.
+
+        Args:
+            job_id (int): the job's id
+
+        Returns:
+            bool: True if the job was cancelled, False if it is unknown or already ended
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in ("queued", "active"):
+                return False
+            job.cancelled = True
+            if job.state == "queued":
+                self.end(job, "cancelled")
+        return True
+
+    def end(self, job, state):
+        """Mark a job as ended. An update that did not complete leaves the
+        repository file as it is, so the name stops being replaced.
+
+        Args:
+            job (DownloadJob): the job
+            state (str): "done", "up to date", "failed" or "cancelled"
+        """
+        if state != "done":
+            self.client.updating.discard(job.fname)
+        job.finish(state)
+
+    def set_priority(self, job_id, priority):
+        """Change the priority of a queued job.
+
+        Args:
+            job_id (int): the job's id
+            priority (int): the new priority
+
+        Returns:
+            bool: True if the priority was changed, False if the job is not queued
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job.state != "queued":
+                return False
+            job.priority = priority
+            self.queue = [(-queued.priority, queued.id, queued) for _, _, queued in self.queue]
+            heapq.heapify(self.queue)
+        return True
+
+    def requeue(self, job):
+        """Put a job that could not run back in the queue.
+
+        Args:
+            job (DownloadJob): the job
+        """
+        with self.condition:
+            job.state = "queued"
+            job.peer = None
+            job.started = None
+            heapq.heappush(self.queue, (-job.priority, job.id, job))
+            self.condition.notify_all()
+
+    def mark_busy(self, address, retry_after):
+        """Record that a peer turned a download away.
+
+        Args:
+            address (tuple[str, int]): the peer's address (hostname, port)
+            retry_after (int): milliseconds before the peer should be asked again
+        """
+        with self.condition:
+            self.busy_until[tuple(address)] = time.monotonic() + retry_after / 1000
+
+    def is_busy(self, address):
+        """Check whether a peer asked to be left alone for now.
+
+        Args:
+            address (tuple[str, int]): the peer's address (hostname, port)
+
+        Returns:
+            bool: True if the peer's retry delay has not passed yet
+        """
+        return self.busy_until.get(tuple(address), 0) > time.monotonic()
+
+    def prune(self):
+        """Forget the oldest ended jobs beyond max_ended, with the condition held."""
+        ended = [job_id for job_id, job in self.jobs.items() if job.ended.is_set()]
+        for job_id in ended[:max(len(ended) - self.max_ended, 0)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        """Get a job.
+
+        Args:
+            job_id (int): the job's id
+
+        Returns:
+            DownloadJob: the job, or None if it is unknown or was forgotten
+        """
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        """List the running and queued jobs and the last MAX_ENDED_JOBS ended
+        ones, most recent first.
+
+        Returns:
+            list[DownloadJob]: the jobs
+        """
+        with self.condition:
+            self.prune()
+            return list(reversed(self.jobs.values()))
+
+    def work(self):
+        """Worker thread loop running batches of jobs."""
+        while True:
+            jobs, address = self.next_batch()
+            try:
+                self.client.run_jobs(jobs, address)
+            except Exception as e:
+                self.client.log(f"Error running download jobs: {e}")
+                for job in jobs:
+                    if job.state == "active":
+                        self.end(job, "failed")
+            finally:
+                with self.condition:
+                    self.peer_active[address] -= 1
+                    self.condition.notify_all()
+
+    def next_batch(self):
+        """Wait for the highest priority job that can run, together with the
+        queued jobs of the same priority held by the same peer.
+
+        Returns:
+            tuple[list[DownloadJob], tuple[str, int]]: the jobs and the peer's address
+        """
+        with self.condition:
+            while True:
+                job, address = self.pop_runnable()
+                if job is not None:
+                    break
+                # Wake up when a busy peer may accept downloads again
+                now = time.monotonic()
+                waits = [until - now for until in self.busy_until.values() if until > now]
+                self.condition.wait(min(waits) if waits else None)
+
+            batch = [job]
+            skipped = []
+            while self.queue and len(batch) < self.batch_size and -self.queue[0][0] == job.priority:
+                item = heapq.heappop(self.queue)
+                other = item[2]
+                if other.state != "queued":
+                    continue
+                if address in self.client.source_addresses(other.sources) and address not in other.failed_peers:
+                    batch.append(other)
+                else:
+                    skipped.append(item)
+            for item in skipped:
+                heapq.heappush(self.queue, item)
+
+            for job in batch:
+                job.state = "active"
+                job.peer = address
+                job.started = time.monotonic()
+                job.attempts += 1
+            self.peer_active[address] = self.peer_active.get(address, 0) + 1
+            return batch, address
+
+    def pop_runnable(self):
+        """Pop the highest priority job with a holder below the per-peer
+        limit, and pick the holder expected to be the fastest, see PeerScores.
+
+        Returns:
+            tuple[DownloadJob, tuple[str, int]]: the job and the address, or (None, None)
+        """
+        skipped = []
+        found = (None, None)
+        while self.queue:
+            item = heapq.heappop(self.queue)
+            job = item[2]
+            if job.state != "queued":
+                continue
+            addresses = [
+                address
+                for address in self.client.source_addresses(job.sources)
+                if self.peer_active.get(address, 0) < self.max_per_peer
+                and not self.is_busy(address)
+                and address not in job.failed_peers
+            ]
+            if addresses:
+                # The fastest expected holder, slowed down by the jobs it already serves
+                scores = self.client.peer_scores
+                found = (job, min(
+                    addresses,
+                    key=lambda address: scores.expected_time(address, job.size) * (1 + self.peer_active.get(address, 0)),
+                ))
+                break
+            skipped.append(item)
+        for item in skipped:
+            heapq.heappush(self.queue, item)
+        return found
+
+
+class DownloadStream:
+    """Content of a fetched file, read in order while it downloads, see
+    FileClient.stream. Only the verified pieces at the start of the partial
+    file are read; a newer version downloaded as changes from the local copy
+    is read once it is rebuilt and verified."""
+
+    def __init__(self, client, file_name, chunk_size=STREAM_CHUNK_SIZE):
+        self.client = client
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+        # waiting | downloading | done | up to date | not found | failed | cancelled
+        self.state = "waiting"
+        self.request = None  # The FetchRequest of the file
+        self.offset = 0  # Bytes read so far
+
+    def __iter__(self):
+        return self.chunks()
+
+    def chunks(self):
+        """Fetch the file and read its content.
+
+        Yields:
+            bytes: the next chunk of the content, the state tells whether the
+                content is complete once there are no more
+        """
+        client = self.client
+        self.request = client.fetch(client.client_socket, self.file_name)
+        if not self.request:
+            self.state = "not found"
+            return
+        while not self.request.answered.wait(STREAM_POLL_INTERVAL):
+            if not client.server_connected:
+                self.state = "failed"
+                return
+        job = self.request.job
+        if job is None:
+            self.state = self.request.result
+            return
+
+        self.state = "downloading"
+        part_path = client.state_path("partial", self.file_name + PARTIAL_SUFFIX)
+        while not job.ended.is_set():
+            # Opened for each read only, the download moves the file into
+            # the object store once it is complete
+            yield from self.read(part_path, job.verified)
+            job.ended.wait(STREAM_POLL_INTERVAL)
+        self.state = job.state
+        if job.state in ("done", "up to date"):
+            yield from self.read(os.path.join(client.repository_folder, self.file_name), None)
+
+    def read(self, path, end):
+        """Read the content from the current offset.
+
+        Args:
+            path (str): the file's path, a missing file has nothing to read
+            end (int): offset to read up to, None for the end of the file
+
+        Yields:
+            bytes: the chunks of content
+        """
+        if end is not None and self.offset >= end:
+            return
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with file:
+            file.seek(self.offset)
+            while end is None or self.offset < end:
+                data = file.read(self.chunk_size if end is None else min(self.chunk_size, end - self.offset))
+                if not data:
+                    return
+                self.offset += len(data)
+                yield data
+
+
+class PieceVerifier(threading.Thread):
+    """Worker thread verifying downloaded pieces against their hashes,
+    so hashing overlaps with receiving the next pieces from the network."""
+
+    def __init__(self, pieces, first_piece=0):
+        super().__init__(daemon=True)
+        self.pieces = pieces
+        self.queue = queue.Queue()
+        self.bad_pieces = set()
+        self.verified = first_piece  # Pieces before this index are verified
+        self.done = set()
+
+    def submit(self, index, data):
+        """Queue a received piece for verification.
+
+        Args:
+            index (int): the piece's index
+            data (bytes): the piece's content
+        """
+        self.queue.put((index, data))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            index, data = item
+            if hashlib.sha256(data).hexdigest() == self.pieces[index]:
+                self.done.add(index)
+                while self.verified in self.done:
+                    self.done.discard(self.verified)
+                    self.verified += 1
+            else:
+                self.bad_pieces.add(index)
+
+    def finish(self):
+        """Wait until every queued piece is verified.
+
+        Returns:
+            set[int]: the indexes of the pieces that failed verification
+        """
+        self.queue.put(None)
+        self.join()
+        return self.bad_pieces
+
+
+class AsyncPeerServer:
+    """asyncio server answering peer requests (ping, pieces, download) from
+    one event loop thread, with the same wire format, keep-alive, upload
+    slots and rate limits as the threaded listener of FileClient.
+
+    The loop only moves bytes: whatever reads the disk or the metadata
+    (lookups in the repository index, hashing, reads through the block
+    cache, compression) runs in the default executor."""
+
+    def __init__(self, client):
+        self.client = client
+        self.loop = None
+        self.server = None
+        self.slot_freed = None  # Notified when an upload slot is released
+        self.connections = 0  # Incoming peer connections being served
+
+    def run(self, address):
+        """Serve peers until stop is called.
+
+        Args:
+            address (tuple[str, int]): the address to listen on (hostname, port)
+        """
+        try:
+            asyncio.run(self.serve(address))
+        except Exception as e:
+            if not self.client.stop_threads:
+                self.client.log(f"Error in the peer server: {e}")
+
+    async def serve(self, address):
+        self.loop = asyncio.get_running_loop()
+        self.slot_freed = asyncio.Condition()
+        self.server = await asyncio.start_server(
+            self.handle_client, address[0], address[1], reuse_address=True
+        )
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        """Stop serving, from any thread."""
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def read_message(self, reader):
+        """Receive a JSON message sent with send_message.
+
+        Args:
+            reader (asyncio.StreamReader): the peer's stream
+
+        Returns:
+            obj: the message
+        """
+        header = await reader.readexactly(8)
+        data = await reader.readexactly(int.from_bytes(header, "big"))
+        return json.loads(data.decode("utf-8", "replace"))
+
+    async def write_message(self, writer, message):
+        """Send a JSON message the way send_message does.
+
+        Args:
+            writer (asyncio.StreamWriter): the peer's stream
+            message (obj): the message
+        """
+        data = json.dumps(message).encode()
+        writer.write(len(data).to_bytes(8, "big") + data)
+        await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        """Handle an incoming connection, see FileClient.handle_client.
+
+        Args:
+            reader (asyncio.StreamReader): the peer's stream to read from
+            writer (asyncio.StreamWriter): the peer's stream to write to
+        """
+        client_address = writer.get_extra_info("peername")
+        self.connections += 1
+        try:
+            if self.connections > MAX_ASYNC_PEER_CONNECTIONS:
+                data = await asyncio.wait_for(self.read_message(reader), 1)
+                await self.write_message(writer, self.client.busy_reply(data["header"]))
+                return
+            while not self.client.stop_threads:
+                data = await asyncio.wait_for(self.read_message(reader), PEER_IDLE_TIMEOUT)
+
+                if data["header"] == "ping":
+                    response = {
+                        "header": "ping",
+                        "type": 1,
+                        "payload": {"success": True, "message": "pong"},
+                    }
+                    await self.write_message(writer, response)
+                elif data["header"] == "pieces":
+                    # Hashing a file that is not cached yet would block the loop
+                    reply = await self.loop.run_in_executor(
+                        None, self.client.pieces_reply, data["payload"]["fname"], data["payload"].get("root")
+                    )
+                    await self.write_message(writer, reply)
+                elif data["header"] == "download":
+                    if not await self.send_file(writer, client_address, data["payload"]):
+                        break
+                elif data["header"] == "delta":
+                    if not await self.send_delta(writer, client_address, data["payload"]):
+                        break
+        except (OSError, ValueError, KeyError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Idle timeout, connection reset, malformed request or server shutdown
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def send_file(self, writer, client_address, payload):
+        """Answer a download request, see FileClient.send_file.
+
+        Args:
+            writer (asyncio.StreamWriter): the peer's stream
+            client_address (tuple[str, int]): the peer's address (hostname, port)
+            payload (dict): the payload of the download request
+
+        Returns:
+            bool: True if the file was sent successfully, False otherwise or
+                if the peer was told to retry later
+        """
+        reply, file = await self.loop.run_in_executor(
+            None, self.client.download_reply, payload["fname"], payload.get("offset", 0), payload.get("length"),
+            payload.get("size"), payload.get("compression"), payload.get("root"),
+        )
+        if file is None:
+            await self.write_message(writer, reply)
+            return False
+
+        slot = await self.acquire_slot()
+        if slot is None:
+            await self.write_message(writer, self.client.busy_reply("download"))
+            return False
+        try:
+            await self.write_message(writer, reply)
+            return await self.stream_file(
+                writer, client_address, reply["payload"]["fname"], file, reply["payload"]["offset"], reply["payload"]["length"],
+                reply["payload"]["compression"],
+            )
+        finally:
+            self.client.upload_slots.release(slot)
+            async with self.slot_freed:
+                self.slot_freed.notify()
+
+    async def send_delta(self, writer, client_address, payload):
+        """Answer a delta request, see FileClient.send_delta. The delta is
+        encoded in the default executor.
+
+        Args:
+            writer (asyncio.StreamWriter): the peer's stream
+            client_address (tuple[str, int]): the peer's address (hostname, port)
+            payload (dict): the payload of the delta request
+
+        Returns:
+            bool: True if the delta was sent successfully, False otherwise or
+                if the peer was told to retry later
+        """
+        reply, file = await self.loop.run_in_executor(
+            None, self.client.delta_reply, payload["fname"], payload.get("root"), payload.get("block_size"),
+            payload.get("signatures"),
+        )
+        if file is None:
+            await self.write_message(writer, reply)
+            return False
+
+        slot = await self.acquire_slot()
+        if slot is None:
+            await self.write_message(writer, self.client.busy_reply("delta"))
+            return False
+        upload_id = self.client.upload_shaper.start(client_address[0])
+        transfer = self.client.transfers.start("upload", client_address, payload["fname"], "delta")
+        transfer.size = reply["payload"]["size"]
+        success = False
+        try:
+            await self.write_message(writer, reply)
+            chunks = delta_stream(
+                file, payload["block_size"], payload["signatures"], int(transfer.size * DELTA_MAX_LITERAL_RATIO)
+            )
+            while True:
+                chunk = await self.loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                delay = self.client.upload_shaper.throttle(upload_id, len(chunk))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    transfer.throttle(delay)
+                writer.write(chunk)
+                await writer.drain()
+                transfer.data(len(chunk))
+            success = True
+        except ConnectionError:
+            self.client.log("Connection closed by peer.")
+            return False
+        except Exception as e:
+            self.client.log(f"Error sending delta: {e}")
+            return False
+        finally:
+            self.client.upload_shaper.finish(upload_id)
+            self.client.transfers.finish(transfer, success)
+            self.client.upload_slots.release(slot)
+            async with self.slot_freed:
+                self.slot_freed.notify()
+        return True
+
+    async def acquire_slot(self):
+        """Wait for a free upload slot without blocking the loop.
+
+        Returns:
+            float: the time the slot was taken, or None if the queue is full
+                or the wait timed out
+        """
+        slots = self.client.upload_slots
+        slot = slots.try_acquire()
+        if slot is not None or not slots.enter_queue():
+            return slot
+        deadline = self.loop.time() + slots.wait
+        try:
+            while slot is None:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                async with self.slot_freed:
+                    try:
+                        await asyncio.wait_for(self.slot_freed.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                slot = slots.try_acquire()
+        finally:
+            slots.leave_queue(slot is not None)
+        return slot
+
+    async def stream_file(self, writer, client_address, fname, file, offset, length, compression=None):
+        """Send a byte range of a file with sendfile, or in compressed blocks,
+        within the upload rate limits.
+
+        Args:
+            writer (asyncio.StreamWriter): the peer's stream
+            client_address (tuple[str, int]): the peer's address (hostname, port)
+            fname (str): the file's name on the server
+            file (file): the file, opened by the repository index
+            offset (int): first byte of the range
+            length (int): number of bytes to send
+            compression (str): the codec compressing the blocks, None to send raw bytes
+
+        Returns:
+            bool: True if the range was sent successfully, False otherwise
+        """
+        upload_id = self.client.upload_shaper.start(client_address[0])
+        transfer = await self.loop.run_in_executor(
+            None, self.client.start_upload, client_address, fname, file, offset, compression
+        )
+        sent = 0
+        try:
+            while compression and sent < length:
+                data = await self.loop.run_in_executor(
+                    None, self.client.read_range, fname, file, offset + sent, min(COMPRESSION_BLOCK_SIZE, length - sent)
+                )
+                if not data:
+                    self.client.log(f"File {fname} was truncated while sending it.")
+                    return False
+                block = await self.loop.run_in_executor(None, compress_block, compression, data)
+                delay = self.client.upload_shaper.throttle(upload_id, len(block))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    transfer.throttle(delay)
+                writer.write(block)
+                await writer.drain()
+                sent += len(data)
+                transfer.data(len(data))
+            while sent < length:
+                count = min(ASYNC_CHUNK_SIZE, length - sent)
+                delay = self.client.upload_shaper.throttle(upload_id, count)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    transfer.throttle(delay)
+                if self.client.block_cache is not None:
+                    data = await self.loop.run_in_executor(
+                        None, self.client.read_range, fname, file, offset + sent, count
+                    )
+                    writer.write(data)
+                    await writer.drain()
+                    transfer.data(len(data))
+                    if len(data) < count:
+                        self.client.log(f"File {fname} was truncated while sending it.")
+                        return False
+                    sent += len(data)
+                    continue
+                try:
+                    # Explicit offsets, the handle is shared with other uploads
+                    done = await self.loop.sendfile(writer.transport, file, offset + sent, count, fallback=False)
+                except asyncio.SendfileNotAvailableError:
+                    data = await self.loop.run_in_executor(None, os.pread, file.fileno(), count, offset + sent)
+                    writer.write(data)
+                    await writer.drain()
+                    done = len(data)
+                transfer.data(done)
+                if done < count:
+                    self.client.log(f"File {fname} was truncated while sending it.")
+                    return False
+                sent += done
+        except ConnectionError:
+            self.client.log("Connection closed by peer.")
+            return False
+        except Exception as e:
+            self.client.log(f"Error sending file: {e}")
+            return False
+        finally:
+            self.client.upload_shaper.finish(upload_id)
+            self.client.transfers.finish(transfer, sent == length)
+        return True
+
+
+COMMANDS = {
+    "publish": "publish PATH [NAME]",
+    "fetch": "fetch [-p PRIORITY] NAME...",
+    "jobs": "jobs",
+    "cancel": "cancel JOB",
+    "priority": "priority JOB PRIORITY",
+    "discover": "discover",
+    "stats": "stats [dump FILE | transfers [upload|download] [PEER]]",
+    "limit": "limit KIB/S [PEER_KIB/S]",
+    "cache": "cache MIB",
+    "ttl": "ttl SECONDS",
+    "quit": "quit",
+}  # Usage of the commands of the GUI's command box and of the headless client
+
+
+def parse_command(command_parts):
+    """Parse a command of the GUI's command box or of the headless client,
+    see COMMANDS.
+
+    Args:
+        command_parts (list[str]): the command and its arguments
+
+    Returns:
+        tuple[str, dict]: the command and its arguments by name
+
+    Raises:
+        ValueError: if the command is unknown or an argument is missing or invalid
+    """
+    if not command_parts or command_parts[0] not in COMMANDS:
+        raise ValueError("Not a valid command, the commands are: " + ", ".join(COMMANDS))
+    command, arguments = command_parts[0], command_parts[1:]
+    try:
+        if command == "publish":
+            name = arguments[1] if len(arguments) > 1 else os.path.basename(arguments[0])
+            return command, {"path": arguments[0], "name": name}
+        if command == "fetch":
+            priority = 0
+            if arguments[0] == "-p":
+                priority, arguments = int(arguments[1]), arguments[2:]
+            return command, {"names": [arguments[0]] + arguments[1:], "priority": priority}
+        if command == "cancel":
+            return command, {"job": int(arguments[0])}
+        if command == "priority":
+            return command, {"job": int(arguments[0]), "priority": int(arguments[1])}
+        if command == "stats":
+            if arguments[:1] == ["dump"]:
+                # Measurements of the last transfers as JSON, - for the output
+                return command, {"dump": arguments[1]}
+            if arguments[:1] == ["transfers"]:
+                # Optionally only uploads or downloads, and only those with one peer
+                direction = arguments[1] if len(arguments) > 1 and arguments[1] in ("upload", "download") else None
+                peer = arguments[-1] if len(arguments) > (2 if direction else 1) else None
+                return command, {"transfers": True, "direction": direction, "peer": peer}
+            return command, {}
+        if command == "limit":
+            # Upload limits in KiB/s, 0 for no limit
+            global_rate = float(arguments[0]) * 1024 or None
+            peer_rate = float(arguments[1]) * 1024 or None if len(arguments) > 1 else None
+            return command, {"global_rate": global_rate, "peer_rate": peer_rate}
+        if command == "cache":
+            # Upload block cache size in MiB, 0 to disable it
+            return command, {"size": int(float(arguments[0]) * 1024 * 1024)}
+        if command == "ttl":
+            # Seconds the catalog and fetch results are reused, 0 to always ask the server
+            return command, {"ttl": float(arguments[0])}
+    except IndexError:
+        raise ValueError(f"Missing argument, usage: {COMMANDS[command]}") from None
+    except ValueError:
+        raise ValueError(f"Invalid number, usage: {COMMANDS[command]}") from None
+    return command, {}
+
+
+class FileClient:
+    def __init__(self, log_callback=None, peer_server_mode="thread"):
+        self.server_host = "localhost"  #Set the server address right here
+        self.server_port = 8888
+        self.lock = threading.Lock()  # To synchronize access to shared data
+        self.hostname = None
+        self.path = None
+        self.stop_threads = False  # Flag to signal threads to terminate
+        self.log_callback = log_callback
+        self.client_socket = None
+        self.server_connected = False
+        self.repository_index = RepositoryIndex()
+        self.repository_folder = None
+        self.discovery_array = []  # Array of shared file name
+        self.catalog_names = set()  # Names of the cached catalog, discovery_array is sorted from it when needed
+        self.catalog_sorted = True  # Whether discovery_array holds every name of catalog_names
+        self.catalog_lock = threading.Lock()
+        self.catalog_ttl = CATALOG_TTL  # 0 to discover the catalog before every operation
+        self.catalog_time = None  # When the catalog was received, None if it is out of date
+        self.catalog_received = threading.Event()
+        self.discover_lock = threading.Lock()  # Held by the catalog call waiting for a discover response
+        self.fetch_cache = {}  # (time received, fetch response payload) by file name
+        self.file_pieces = {}  # Piece hashes of repository files, by file name
+        self.metadata = None  # MetadataStore of the repository, opened on first use
+        self.metadata_lock = threading.Lock()
+        self.publish_acks = threading.Condition()
+        self.publish_sent = 0  # Publish batches sent
+        self.publish_acked = 0  # Publish batches acknowledged by the server
+        self.download_pieces = {}  # Piece hashes of files being downloaded
+        self.bad_pieces = {}  # Indexes of downloaded pieces that failed verification
+        self.updating = set()  # Repository files being replaced by a newer version
+        self.peer_pool = PeerConnectionPool(self.p2p_connect)
+        self.peer_scores = PeerScores()
+        self.transfers = TransferStats()
+        self.send_lock = threading.Lock()  # One request at a time on the server socket
+        self.downloads = DownloadManager(self)
+        self.fetch_requests = {}  # Pending FetchRequests, lists by file name
+        self.fetch_lock = threading.Lock()
+        self.upload_shaper = UploadShaper()
+        self.upload_slots = UploadSlots()
+        self.block_cache = None  # BlockCache of the uploads, see set_block_cache
+        self.peer_connections = 0  # Incoming peer connections being served
+        self.peer_connections_lock = threading.Lock()
+        self.peer_server_mode = peer_server_mode  # "thread": a thread per peer connection, "asyncio": one event loop
+        self.async_server = None
+        self.watcher = None
+        self.compressions = list(COMPRESSIONS)  # Compressions offered for downloads, empty to disable
+
+    @property
+    def repository_folder(self):
+        """str: path to the client's repository folder"""
+        return self.repository_index.folder
+
+    @repository_folder.setter
+    def repository_folder(self, folder):
+        self.repository_index.set_folder(folder)
+
+    def log(self, message):     
+        """Log a message to the console or using the Logs tab in the GUI.
+
+        Args:
+            message (str): The message to print
+        """
+        if self.log_callback:
+            self.log_callback(message)
+        else:
+            print(message)
+
+    def connect_to_server(self, hostname):      
+        """Connect to the server and set the client's hostname.
+
+        Args:
+            hostname (str): the client's hostname
+
+        Returns:
+            tuple[str, int]: the client's address (hostname, port)
+        """
+        with self.lock:
+            if not self.client_socket:
+                try:
+                    self.client_socket = socket.socket(
+                        socket.AF_INET, socket.SOCK_STREAM
+                    )
+                    self.client_socket.setsockopt(
+                        socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
+                    )
+                    self.client_socket.connect((self.server_host, self.server_port))
+                    self.server_connected = True
+                except Exception as e:
+                    self.log(f"Error connect to server: {e}")
+                    self.client_socket = None
+                    return None
+
+        client_address = self.init_hostname(self.client_socket, hostname)
+
+        return client_address
+
+    def start(self, client_address):        
+        """Start the client with receiving messages from server
+        and listening for incoming connections from peers.
+
+        Args:
+            client_address (tuple[str, int]): the client's address (hostname, port)
+        """
+        self.receive_messages_thread = threading.Thread(
+            target=self.receive_messages, daemon=True, args=(self.client_socket,)
+        )
+        self.receive_messages_thread.start()
+
+        if self.peer_server_mode == "asyncio":
+            self.async_server = AsyncPeerServer(self)
+            listener = self.async_server.run
+        else:
+            listener = self.start_listener
+        self.listener_thread = threading.Thread(
+            target=listener, daemon=True, args=(client_address,)
+        )
+        self.listener_thread.start()
+
+    def receive_messages(self, client_socket: socket.socket):
+        """Receive messages from the server.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+        """
+        with self.lock:
+            while not self.stop_threads and self.server_connected:
+                try:
+                    data = recv_message(client_socket)
+                    if data is None:
+                        if not self.stop_threads:
+                            self.log("Connection closed by the server.")
+                        break
+
+                    if data["header"] == "fetch" and data["payload"] is not None:
+                        self.cache_sources(data["payload"])
+                        if isinstance(data["payload"]["fname"], list):
+                            self.handle_batch_fetch_sources(data)
+                        else:
+                            self.handle_fetch_sources(data)
+                    elif data["header"] == "discover" and data["payload"] is not None:
+                        self.handle_discover_sources(data)
+                    elif data["header"] == "publish" and "batch" in data["payload"]:
+                        self.handle_publish_ack(data)
+                    elif data["header"] == "catalog":
+                        self.handle_catalog_update(data)
+                    else:
+                        self.log(data["payload"]["message"])
+                except ConnectionResetError:
+                    self.log("Connection closed by the server.")
+                    break
+                except Exception as e:
+                    if self.stop_threads:
+                        break
+                    self.log(f"Error receiving messages: {e}")
+                    break
+            self.server_connected = False
+            with self.publish_acks:
+                self.publish_acks.notify_all()
+
+    def start_listener(self, client_address):       
+        """Start the listener socket to accept incoming connections.
+
+        Args:
+            client_address (tuple[str, int]): the client's address (hostname, port)
+        """
+        self.listener_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener_socket.bind(client_address)
+        self.listener_socket.listen()
+
+        while not self.stop_threads:
+            try:
+                client_socket, addr = self.listener_socket.accept()
+                with self.peer_connections_lock:
+                    admitted = self.peer_connections < MAX_PEER_CONNECTIONS
+                    if admitted:
+                        self.peer_connections += 1
+                if admitted:
+                    threading.Thread(target=self.handle_client, args=(client_socket, addr)).start()
+                else:
+                    self.reject_client(client_socket)
+            except OSError as e:
+                # Check if the error is due to stopping threads, ignore otherwise
+                if not self.stop_threads:
+                    self.log(f"Error accepting connection: {e}")
+                    break
+
+    def handle_client(self, client_socket: socket.socket, client_address):    
+        """Handle an incoming connection. The connection is kept open for
+        more requests until the peer closes it or it stays idle for
+        PEER_IDLE_TIMEOUT seconds.
+
+        Args:
+            client_socket (socket.socket): the peer' socket
+            client_address (tuple[str, int]): the peer's address (hostname, port)
+        """
+        client_socket.settimeout(PEER_IDLE_TIMEOUT)
+        try:
+            while not self.stop_threads:
+                data = recv_message(client_socket)
+                if data is None:
+                    break
+
+                if data["header"] == "ping":
+                    response = {
+                        "header": "ping",
+                        "type": 1,
+                        "payload": {"success": True, "message": "pong"},
+                    }
+                    send_message(client_socket, response)
+                elif data["header"] == "pieces":
+                    self.send_pieces(client_socket, data["payload"]["fname"], data["payload"].get("root"))
+                elif data["header"] == "download":
+                    payload = data["payload"]
+                    sent = self.send_file(
+                        client_socket,
+                        client_address,
+                        payload["fname"],
+                        payload.get("offset", 0),
+                        payload.get("length"),
+                        payload.get("size"),
+                        payload.get("compression"),
+                        payload.get("root"),
+                    )
+                    if not sent:
+                        break
+                elif data["header"] == "delta":
+                    if not self.send_delta(client_socket, client_address, data["payload"]):
+                        break
+        except (OSError, ValueError):
+            # Idle timeout, connection reset or malformed request
+            pass
+        finally:
+            client_socket.close()
+            with self.peer_connections_lock:
+                self.peer_connections -= 1
+
+    def reject_client(self, client_socket: socket.socket):
+        """Turn a connection beyond MAX_PEER_CONNECTIONS away with a busy
+        reply, then close it.
+
+        Runs on the listener thread, so it does not wait for the request: the
+        reply is written without blocking, and dropped if it does not fit in
+        the socket's send buffer.
+
+        Args:
+            client_socket (socket.socket): the peer' socket
+        """
+        data = json.dumps(self.busy_reply(None)).encode("utf-8")
+        try:
+            client_socket.setblocking(False)
+            client_socket.send(len(data).to_bytes(8, "big") + data)
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+
+    def busy_reply(self, header):
+        """Build the reply turning a request away while the client is busy uploading.
+
+        Args:
+            header (str): the header of the request
+
+        Returns:
+            dict: the reply
+        """
+        retry_after = self.upload_slots.retry_after()
+        return {
+            "header": header,
+            "type": 1,
+            "payload": {
+                "success": False,
+                "busy": True,
+                "retry_after": retry_after,
+                "message": f"Busy, retry after {retry_after} ms",
+                "length": None,
+            },
+        }
+
+    def connect_publish(self, client_socket: socket.socket): 
+        """Publish existing file in client's repository on connection.
+
+        Args:
+            client_socket (socket.socket): the peer' socket
+            
+        Returns:
+            bool: True if the file was published successfully, False otherwise
+        """   
+        if self.server_connected is False:
+            self.log("Not connected to server.")
+            return False
+        self.repository_index.refresh(force=True)
+        files = self.repository_index.names()
+        try:
+            self.metadata_store().prune(files)
+            # Objects no repository file has as content
+            for content_hash in self.metadata_store().prune_objects():
+                path = self.state_path(OBJECTS_FOLDER, content_hash)
+                if os.path.lexists(path):
+                    os.remove(path)
+        except sqlite3.Error as e:
+            self.log(f"Error reading the metadata database: {e}")
+        # Announce the files hashed before now, the others once they are hashed
+        files_in_repository = [file for file in files if self.get_file_pieces(file, hash_missing=False)]
+        hashed = set(files_in_repository)
+        unhashed = [file for file in files if file not in hashed]
+        if unhashed:
+            RepositoryHasher(self, unhashed).start()
+
+        try:
+            return self.publish_files(client_socket, files_in_repository)
+        except Exception as e:
+            self.log(f"Error publish files to server: {e}")
+            return False
+
+    def publish_files(self, client_socket: socket.socket, file_names):
+        """Publish files in batches of PUBLISH_BATCH_SIZE names, keeping at
+        most PUBLISH_WINDOW batches waiting for the server's acknowledgement,
+        so a large repository is announced without holding up the server.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+            file_names (list[str]): the names of the files in the repository
+
+        Returns:
+            bool: True if every batch was sent, False if the server stopped
+                acknowledging them
+        """
+        for start in range(0, len(file_names), PUBLISH_BATCH_SIZE):
+            names = file_names[start:start + PUBLISH_BATCH_SIZE]
+            meta = {name: self.file_meta(name) for name in names}
+            names = [name for name in names if meta[name] is not None]
+            with self.publish_acks:
+                deadline = time.monotonic() + PUBLISH_ACK_TIMEOUT
+                while self.publish_sent - self.publish_acked >= PUBLISH_WINDOW:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.server_connected:
+                        self.log("The server did not acknowledge the published files.")
+                        return False
+                    self.publish_acks.wait(remaining)
+                batch = self.publish_sent
+                self.publish_sent += 1
+            request = {
+                "header": "publish",
+                "type": 0,
+                "payload": {
+                    "fname": names,
+                    "meta": {name: meta[name] for name in names},
+                    "batch": batch,
+                },
+            }
+            self.send_request(client_socket, request)
+        return True
+
+    def handle_publish_ack(self, data):
+        """Handle the server's acknowledgement of a publish batch.
+
+        Args:
+            data (dict): the publish response
+        """
+        with self.publish_acks:
+            self.publish_acked = max(self.publish_acked, data["payload"]["batch"] + 1)
+            self.publish_acks.notify_all()
+
+    def watch_repository(self):
+        """Start announcing the files added, changed or removed in the
+        repository folder after connect_publish."""
+        if self.watcher is None:
+            self.watcher = RepositoryWatcher(self)
+            self.watcher.start()
+
+    def publish_delta(self, client_socket: socket.socket, added, removed):
+        """Announce the files added or changed and the files removed since
+        the last announcement, without publishing the whole repository again.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+            added (list[str]): the names of the files added or changed
+            removed (list[str]): the names of the files removed
+
+        Returns:
+            bool: True if the changes were sent successfully, False otherwise
+        """
+        if self.server_connected is False:
+            return False
+        for file_name in removed:
+            self.file_pieces.pop(file_name, None)
+        try:
+            self.metadata_store().remove(removed)
+        except sqlite3.Error as e:
+            self.log(f"Error updating the metadata database: {e}")
+        try:
+            if added:
+                if not self.publish_files(client_socket, added):
+                    return False
+                self.log(f"Published {len(added)} new or changed files")
+            for start in range(0, len(removed), PUBLISH_BATCH_SIZE):
+                self.send_request(client_socket, {
+                    "header": "unpublish",
+                    "type": 0,
+                    "payload": {"fname": removed[start:start + PUBLISH_BATCH_SIZE]},
+                })
+            if removed:
+                self.log(f"Unpublished {len(removed)} removed files")
+        except Exception as e:
+            self.log(f"Error publish changes to server: {e}")
+            return False
+        return True
+
+    def is_file_in_folder(self, file_name, folder_path):    
+        # Helper function    
+        file_path = os.path.join(folder_path, file_name)
+        return os.path.isfile(file_path)
+
+    def publish(self, client_socket: socket.socket, file_path, file_name: str):     
+        """Publish a file aliased as file_name to the server.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+            file_path (str): path to local file on the client's machine
+            file_name (str): name of the file uploaded to client's repository and on the server
+
+        Returns:
+            bool: True if the file was published successfully, False otherwise
+        """
+        # call discover function
+        if file_path != self.repository_folder:
+            if file_name in (self.catalog(self.client_socket) or []):
+                self.log("File already existed in the repository\nSend 'discover' command for existing file names.")   
+                return False
+
+            if self.server_connected is False:
+                self.log("Not connected to server.")
+                return False
+
+            if not os.path.exists(file_path):
+                self.log(f"File does not exist.")
+                return False
+
+            if self.is_file_in_folder(file_name, self.repository_folder):
+                self.log(f"File name '{file_name}' already exists in local repository.")
+                return False
+            
+            uploaded_file_path = os.path.join(self.repository_folder, file_name)
+
+            try:
+                # Stored once by content, the repository file is an alias of it
+                pieces, content_hash = hash_file(file_path)
+                self.store_content(file_path, file_name, pieces, content_hash)
+                self.log(f'File uploaded to repository: {uploaded_file_path}')
+            except Exception as e:
+                self.log(f'Error uploading file: {e}')
+        
+        request = {
+            "header": "publish",
+            "type": 0,
+            "payload": {
+                "fname": [file_name],
+                "meta": {file_name: self.file_meta(file_name)},
+            },
+        }
+
+        try:
+            self.send_request(client_socket, request)
+        except Exception as e:
+            self.log(f"Error publish file to server: {e}")
+            return False
+        
+        return True
+
+    def fetch(self, client_socket: socket.socket, file_name: str, priority=0, root=None):
+        """Fetch a file from the server into the client's directory.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+            file_name (str): the file's name on the server to fetch
+            priority (int): priority of the download job, higher runs first
+            root (str): Merkle root of the content to fetch, from any client
+                holding it under any name, the file is saved as file_name
+        Return:
+            FetchRequest: the pending fetch, answered once the server's
+                response is handled, or False if the fetch was not sent
+        """
+        if self.server_connected is False:
+            self.log("Not connected to server.")
+            return False
+
+        if file_name in self.repository_index:
+            # Only the changes are downloaded if the server has a newer version
+            self.log(f"Checking for a newer version of {file_name}...")
+        elif root is None:
+            if file_name not in (self.catalog(self.client_socket) or []):
+                self.log("No other clients with the file found!")
+                return False
+
+        request = self.add_fetch_request(file_name, priority)
+        sources_data = self.cached_sources(file_name)
+        if sources_data is not None and root in (None, sources_data.get("root")):
+            self.handle_fetch_sources({"payload": sources_data})
+            return request
+        command = {"header": "fetch", "type": 0, "payload": {"fname": file_name, "root": root}}
+        try:
+            self.send_request(client_socket, command)
+        except Exception as e:
+            self.log(f"Error fetch file: {e}")
+            self.pop_fetch_requests(file_name)
+            return False
+        return request
+
+    def fetch_many(self, client_socket: socket.socket, file_names, priority=0):
+        """Fetch several files, looking up all of their sources with one request to the server.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+            file_names (list[str]): the files' names on the server to fetch
+            priority (int): priority of the download jobs, higher runs first
+        Return:
+            list[FetchRequest]: the pending fetches, one per file, or False
+                if the fetch request was not sent
+        """
+        if self.server_connected is False:
+            self.log("Not connected to server.")
+            return False
+
+        file_names = list(dict.fromkeys(file_names))
+        if not file_names:
+            return False
+
+        requests = [self.add_fetch_request(file_name, priority) for file_name in file_names]
+        cached = {file_name: self.cached_sources(file_name) for file_name in file_names}
+        file_names = [file_name for file_name in file_names if cached[file_name] is None]
+        if len(file_names) < len(cached):
+            files = [sources_data for sources_data in cached.values() if sources_data is not None]
+            self.handle_batch_fetch_sources({"payload": {"files": files}})
+        if not file_names:
+            return requests
+
+        command = {"header": "fetch", "type": 0, "payload": {"fname": file_names}}
+        try:
+            self.send_request(client_socket, command)
+        except Exception as e:
+            self.log(f"Error fetch files: {e}")
+            for file_name in file_names:
+                self.pop_fetch_requests(file_name)
+            return False
+        return requests
+
+    def add_fetch_request(self, file_name, priority):
+        """Record a fetch waiting for the server's response.
+
+        Args:
+            file_name (str): the file's name on the server
+            priority (int): priority of the download job
+
+        Returns:
+            FetchRequest: the pending fetch
+        """
+        request = FetchRequest(file_name, priority)
+        with self.fetch_lock:
+            self.fetch_requests.setdefault(file_name, []).append(request)
+        return request
+
+    def pop_fetch_requests(self, file_name):
+        """Take the fetches of a file answered by a response from the server.
+
+        Args:
+            file_name (str): the file's name on the server
+
+        Returns:
+            tuple[list[FetchRequest], int]: the pending fetches, and the
+                highest of their priorities, 0 if there are none
+        """
+        with self.fetch_lock:
+            requests = self.fetch_requests.pop(file_name, [])
+        return requests, max((request.priority for request in requests), default=0)
+
+    def stream(self, file_name: str, chunk_size=STREAM_CHUNK_SIZE):
+        """Fetch a file and read its content in order while it downloads.
+        The file is saved into the repository as by fetch.
+
+        Args:
+            file_name (str): the file's name on the server to fetch
+            chunk_size (int): bytes read at a time
+
+        Returns:
+            DownloadStream: iterable of the content's chunks, its state tells
+                whether the content was complete once the iteration ends
+        """
+        return DownloadStream(self, file_name, chunk_size)
+
+    def send_request(self, client_socket: socket.socket, request):
+        """Send a request to the server, one sender at a time.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+            request (obj): the request to send
+        """
+        with self.send_lock:
+            send_message(client_socket, request)
+
+    def discover(self, client_socket: socket.socket):
+        """Discover all existed files from server file lists
+
+        Args:
+            client_socket (socket.socket): the client' socket
+        Return:
+            bool: True if the file names list was discovered successfully, False otherwise
+        """
+        if self.server_connected is False:
+            self.log("Not connected to server.")
+            return False
+
+        command = {"header": "discover", "type": 0, "payload": {}}
+        try:
+            self.send_request(client_socket, command)
+        except Exception as e:
+            self.log(f"Error discover shared files: {e}")
+            return False
+        return True
+
+    def catalog(self, client_socket: socket.socket):
+        """Get the names of the files shared by the other clients, from the
+        last discover response if it is younger than catalog_ttl seconds and
+        the server did not report a removed file since, else from a new
+        discover request. One discover request is in flight at a time, the
+        callers waiting for it share its response.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+
+        Returns:
+            list[str]: the file names, or None if the server did not send them
+        """
+        requested = time.monotonic()
+        received = self.catalog_time
+        if received is None or requested - received >= self.catalog_ttl:
+            with self.discover_lock:
+                # Answered meanwhile if another caller's request was in flight
+                received = self.catalog_time
+                if received is None or requested - received >= self.catalog_ttl:
+                    self.catalog_received.clear()
+                    if not self.discover(client_socket):
+                        return None
+                    if not self.catalog_received.wait(DISCOVER_TIMEOUT):
+                        self.log("The server did not send the shared files.")
+                        return None
+        with self.catalog_lock:
+            if not self.catalog_sorted:
+                # Sorted once per read, not once per notification
+                self.discovery_array = sorted(self.catalog_names)
+                self.catalog_sorted = True
+            return self.discovery_array
+
+    def cached_sources(self, file_name):
+        """Get the sources of a file from a recent fetch response.
+
+        Args:
+            file_name (str): the file's name on the server
+
+        Returns:
+            dict: the payload of the fetch response for the file, or None if
+                there is none younger than catalog_ttl seconds
+        """
+        cached = self.fetch_cache.get(file_name)
+        if cached is None or time.monotonic() - cached[0] >= self.catalog_ttl:
+            return None
+        return cached[1]
+
+    def cache_sources(self, payload):
+        """Remember the sources of the files found by a fetch response.
+
+        Args:
+            payload (dict): the payload of the fetch response
+        """
+        now = time.monotonic()
+        for sources_data in payload.get("files", [payload]):
+            if sources_data["success"]:
+                self.fetch_cache[sources_data["fname"]] = (now, sources_data)
+
+    def handle_catalog_update(self, data):
+        """Handle the server's notification that other clients published or
+        removed files: published names join the cached catalog, a removed
+        name makes the catalog out of date, and the cached sources of the
+        files are dropped.
+
+        Args:
+            data (obj): notification from the server
+        """
+        published = data["payload"].get("published", [])
+        removed = data["payload"].get("removed", [])
+        for file_name in published + removed:
+            self.fetch_cache.pop(file_name, None)
+        if removed:
+            self.catalog_time = None
+        elif published and self.catalog_time is not None:
+            with self.catalog_lock:
+                self.catalog_names.update(published)
+                self.catalog_sorted = False
+    
+    def send_file(self, client_socket: socket.socket, client_address, fname: str, offset=0, length=None, size=None,
+                  compression=None, root=None):
+        """Send a file, or a byte range of it, to a peer, once an upload slot
+        is free and within the upload rate limits.
+
+        Args:
+            client_socket (socket.socket): the peer's socket
+            client_address (tuple[str, int]): the peer's address (hostname, port)
+            fname (str): the file's name on the server
+            offset (int): first byte of the requested range
+            length (int): number of bytes requested, None for the rest of the file
+            size (int): file size the peer expects, the range is reset to the
+                whole file if the local copy has a different size
+            compression (list[str]): the codecs the peer accepts, in order of preference
+            root (str): Merkle root of the requested content, see resolve_name
+
+        Returns:
+            bool: True if the file was sent successfully, False otherwise or
+                if the peer was told to retry later
+        """
+        reply, file = self.download_reply(fname, offset, length, size, compression, root)
+        if file is None:
+            send_message(client_socket, reply)
+            return False
+
+        # File found and accessible, wait for an upload slot
+        slot = self.upload_slots.acquire()
+        if slot is None:
+            send_message(client_socket, self.busy_reply("download"))
+            return False
+        try:
+            send_message(client_socket, reply)
+            return self.stream_file(
+                client_socket, client_address, reply["payload"]["fname"], file, reply["payload"]["offset"],
+                reply["payload"]["length"],
+                reply["payload"]["compression"],
+            )
+        finally:
+            self.upload_slots.release(slot)
+
+    def download_reply(self, fname, offset=0, length=None, size=None, compression=None, root=None):
+        """Build the reply to a download request.
+
+        Args:
+            fname (str): the file's name on the server
+            offset (int): first byte of the requested range
+            length (int): number of bytes requested, None for the rest of the file
+            size (int): file size the peer expects
+            compression (list[str]): the codecs the peer accepts, in order of preference
+            root (str): Merkle root of the requested content, see resolve_name
+
+        Returns:
+            tuple[dict, file]: the reply, with the file sent and the range, and
+                the open file, None if it is not available
+        """
+        fname = self.resolve_name(fname, root)
+        info = self.repository_index.lookup(fname)
+        file = self.repository_index.open(fname) if info is not None else None
+        if file is None:
+            # File not found or not accessible
+            reply = {
+                "header": "download",
+                "type": 1,
+                "payload": {
+                    "success": False,
+                    "message": f"The file you requested {fname} is not available",
+                    "length": None,
+                },
+            }
+            return reply, None
+
+        file_size = info[0]
+        if size is not None and size != file_size:
+            # The peer resumes a different version of the file, send it all
+            offset, length = 0, None
+        offset = min(max(int(offset or 0), 0), file_size)
+        if length is None or offset + length > file_size:
+            length = file_size - offset
+        reply = {
+            "header": "download",
+            "type": 1,
+            "payload": {
+                "success": True,
+                "message": f"{fname} is available",
+                "fname": fname,
+                "length": length,
+                "offset": offset,
+                "size": file_size,
+                "compression": self.choose_compression(fname, file, offset, length, compression),
+                "block_size": COMPRESSION_BLOCK_SIZE,
+            },
+        }
+        return reply, file
+
+    def choose_compression(self, fname, file, offset, length, accepted):
+        """Choose how to compress a download: not at all for an already
+        compressed format or a sample of the range that does not compress
+        well, else with the first codec the peer accepts.
+
+        Args:
+            fname (str): the file's name on the server
+            file (file): the file, opened by the repository index
+            offset (int): first byte of the range
+            length (int): number of bytes in the range
+            accepted (list[str]): the codecs the peer accepts, in order of preference
+
+        Returns:
+            str: the codec, or None to send raw bytes
+        """
+        codecs = [codec for codec in accepted or [] if codec in CODECS]
+        if not codecs or not length or os.path.splitext(fname)[1].lower() in COMPRESSED_EXTENSIONS:
+            return None
+        sample = os.pread(file.fileno(), min(COMPRESSION_SAMPLE_SIZE, length), offset)
+        if len(CODECS["zlib"][0](sample)) > COMPRESSION_MAX_RATIO * len(sample):
+            return None
+        return codecs[0]
+
+    def stream_file(self, client_socket: socket.socket, client_address, fname, file, offset, length,
+                    compression=None):
+        """Send a byte range of a file within the upload rate limits, raw or
+        in compressed blocks of COMPRESSION_BLOCK_SIZE bytes.
+
+        Args:
+            client_socket (socket.socket): the peer's socket
+            client_address (tuple[str, int]): the peer's address (hostname, port)
+            fname (str): the file's name on the server
+            file (file): the file, opened by the repository index
+            offset (int): first byte of the range
+            length (int): number of bytes to send
+            compression (str): the codec compressing the blocks, None to send raw bytes
+
+        Returns:
+            bool: True if the range was sent successfully, False otherwise
+        """
+        upload_id = self.upload_shaper.start(client_address[0])
+        transfer = self.start_upload(client_address, fname, file, offset, compression)
+        chunk_size = COMPRESSION_BLOCK_SIZE if compression else UPLOAD_CHUNK_SIZE
+        sent = 0
+        try:
+            while sent < length:
+                data = self.read_range(fname, file, offset + sent, min(chunk_size, length - sent))
+                if not data:
+                    self.log(f"File {fname} was truncated while sending it.")
+                    return False
+                size = len(data)
+                if compression:
+                    data = compress_block(compression, data)
+                delay = self.upload_shaper.throttle(upload_id, len(data))
+                if delay > 0:
+                    time.sleep(delay)
+                    transfer.throttle(delay)
+                client_socket.sendall(data)
+                sent += size
+                transfer.data(size)
+        except ConnectionResetError:
+            self.log("Connection closed by peer.")
+            return False
+        except Exception as e:
+            self.log(f"Error sending file: {e}")
+            return False
+        finally:
+            self.upload_shaper.finish(upload_id)
+            self.transfers.finish(transfer, sent == length)
+        return True
+
+    def send_delta(self, client_socket: socket.socket, client_address, payload):
+        """Send a peer the changes from its older copy of a file to the
+        repository's version, see delta_stream, once an upload slot is free
+        and within the upload rate limits.
+
+        Args:
+            client_socket (socket.socket): the peer's socket
+            client_address (tuple[str, int]): the peer's address (hostname, port)
+            payload (dict): the payload of the delta request, with the file's
+                name, the block size and the signatures of the peer's copy
+
+        Returns:
+            bool: True if the delta was sent successfully, False otherwise or
+                if the peer was told to retry later
+        """
+        reply, file = self.delta_reply(
+            payload["fname"], payload.get("root"), payload.get("block_size"), payload.get("signatures")
+        )
+        if file is None:
+            send_message(client_socket, reply)
+            return False
+
+        slot = self.upload_slots.acquire()
+        if slot is None:
+            send_message(client_socket, self.busy_reply("delta"))
+            return False
+        upload_id = self.upload_shaper.start(client_address[0])
+        transfer = self.transfers.start("upload", client_address, payload["fname"], "delta")
+        transfer.size = reply["payload"]["size"]
+        success = False
+        try:
+            send_message(client_socket, reply)
+            max_literal = int(transfer.size * DELTA_MAX_LITERAL_RATIO)
+            for chunk in delta_stream(file, payload["block_size"], payload["signatures"], max_literal):
+                delay = self.upload_shaper.throttle(upload_id, len(chunk))
+                if delay > 0:
+                    time.sleep(delay)
+                    transfer.throttle(delay)
+                client_socket.sendall(chunk)
+                transfer.data(len(chunk))
+            success = True
+        except ConnectionResetError:
+            self.log("Connection closed by peer.")
+            return False
+        except Exception as e:
+            self.log(f"Error sending delta: {e}")
+            return False
+        finally:
+            self.upload_shaper.finish(upload_id)
+            self.upload_slots.release(slot)
+            self.transfers.finish(transfer, success)
+        return True
+
+    def delta_reply(self, fname, root=None, block_size=None, signatures=None):
+        """Build the reply to a delta request.
+
+        Args:
+            fname (str): the file's name on the server
+            root (str): Merkle root of the requested content, see resolve_name
+            block_size (int): number of bytes in each block of the peer's copy
+            signatures (list): the signatures of the peer's copy
+
+        Returns:
+            tuple[dict, file]: the reply and the open file, None if it is not
+                available or the request is invalid
+        """
+        error = delta_request_error(block_size, signatures)
+        if error is not None:
+            reply = {"header": "delta", "type": 1, "payload": {"success": False, "message": error}}
+            return reply, None
+        fname = self.resolve_name(fname, root)
+        info = self.repository_index.lookup(fname)
+        file = self.repository_index.open(fname) if info is not None else None
+        if file is None:
+            reply = {
+                "header": "delta",
+                "type": 1,
+                "payload": {"success": False, "message": f"The file you requested {fname} is not available"},
+            }
+            return reply, None
+        reply = {
+            "header": "delta",
+            "type": 1,
+            "payload": {"success": True, "message": f"{fname} is available", "size": info[0]},
+        }
+        return reply, file
+
+    def read_range(self, fname, file, offset, length):
+        """Read a byte range of a repository file for an upload, through the
+        block cache if it is enabled.
+
+        Args:
+            fname (str): the file's name in the repository
+            file (file): the file, opened by the repository index
+            offset (int): first byte of the range
+            length (int): number of bytes to read
+
+        Returns:
+            bytes: the content, shorter than length if the file ends before
+        """
+        cache = self.block_cache
+        info = self.repository_index.lookup(fname) if cache is not None else None
+        if info is None:
+            # Explicit offsets, the handle is shared with other uploads
+            return os.pread(file.fileno(), length, offset)
+        return cache.read((fname,) + info, file, offset, length)
+
+    def start_upload(self, client_address, fname, file, offset, compression=None):
+        """Start measuring the upload of a file, see TransferStats.
+
+        Args:
+            client_address (tuple[str, int]): the peer's address (hostname, port)
+            fname (str): the file's name on the server
+            file (file): the file, opened by the repository index
+            offset (int): first byte of the range sent
+            compression (str): the codec compressing the blocks, None for raw bytes
+
+        Returns:
+            Transfer: the transfer
+        """
+        transfer = self.transfers.start("upload", client_address, fname)
+        transfer.offset = offset
+        transfer.size = os.fstat(file.fileno()).st_size
+        transfer.compression = compression
+        return transfer
+
+    def set_block_cache(self, max_size=BLOCK_CACHE_SIZE):
+        """Enable or disable the in-memory cache of the blocks read by uploads.
+
+        Args:
+            max_size (int): bytes of blocks kept in memory, None or 0 to disable the cache
+        """
+        self.block_cache = BlockCache(max_size) if max_size else None
+
+    def set_upload_limits(self, global_rate=None, peer_rate=None):
+        """Limit the upload rate of the client.
+
+        Args:
+            global_rate (float): bytes per second for all uploads, None for no limit
+            peer_rate (float): bytes per second for each peer host, None for no limit
+        """
+        self.upload_shaper.set_limits(global_rate, peer_rate)
+
+    def stats(self):
+        """Get the client's transfer statistics.
+
+        Returns:
+            dict: {"uploads": upload limits, rates and block cache usage,
+                "downloads": progress of the download jobs, "peers": scores of the peers,
+                "transfers": totals of the finished transfers, see TransferStats.summary}
+        """
+        return {
+            "uploads": dict(
+                self.upload_shaper.stats(),
+                slots=self.upload_slots.stats(),
+                cache=self.block_cache.stats() if self.block_cache is not None else None,
+            ),
+            "downloads": [job.progress() for job in self.downloads.list()],
+            "peers": self.peer_scores.stats(),
+            "transfers": self.transfers.summary(),
+        }
+
+    def dump_stats(self, path):
+        """Write the measurements of the last uploads and downloads and their
+        totals to a JSON file, see TransferStats.dump.
+
+        Args:
+            path (str): the file's path
+        """
+        self.transfers.dump(path)
+
+    def run_command(self, command, arguments):
+        """Run a command of the GUI's command box or of the headless client,
+        except quit.
+
+        Args:
+            command (str): the command, see parse_command
+            arguments (dict): its arguments, see parse_command
+
+        Returns:
+            tuple[bool, str]: whether the command succeeded, and its output, None if it has none
+        """
+        if command == "publish":
+            return self.publish(self.client_socket, arguments["path"], arguments["name"]), None
+        if command == "fetch":
+            if len(arguments["names"]) > 1:
+                return bool(self.fetch_many(self.client_socket, arguments["names"], arguments["priority"])), None
+            return bool(self.fetch(self.client_socket, arguments["names"][0], arguments["priority"])), None
+        if command == "jobs":
+            return True, "\n".join(job.describe() for job in self.downloads.list()) or None
+        if command == "cancel":
+            if not self.downloads.cancel(arguments["job"]):
+                return False, f"No running or queued job #{arguments['job']}."
+        elif command == "priority":
+            if not self.downloads.set_priority(arguments["job"], arguments["priority"]):
+                return False, f"No queued job #{arguments['job']}."
+        elif command == "discover":
+            names = self.catalog(self.client_socket)
+            return names is not None, "\n".join(names or []) or None
+        elif command == "stats":
+            if arguments.get("dump") == "-":
+                return True, json.dumps(self.transfers.report(), indent=2)
+            if "dump" in arguments:
+                self.dump_stats(arguments["dump"])
+                return True, f"Transfer statistics written to {arguments['dump']}."
+            if arguments.get("transfers"):
+                return True, json.dumps(self.transfers.list(arguments["direction"], arguments["peer"]), indent=2)
+            return True, json.dumps(self.stats(), indent=2)
+        elif command == "limit":
+            self.set_upload_limits(arguments["global_rate"], arguments["peer_rate"])
+        elif command == "cache":
+            self.set_block_cache(arguments["size"])
+        elif command == "ttl":
+            self.catalog_ttl = arguments["ttl"]
+        return True, None
+
+    def init_hostname(self, client_socket: socket.socket, hostname: str):       
+        """Send the client's hostname to the server and receive the client's address.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+            hostname (str): the client's hostname
+
+        Returns:
+            tuple[str, int]: the client's address (hostname, port)
+        """
+        self.hostname = hostname
+        self.send_hostname(client_socket)
+        data = recv_message(client_socket)
+        if not data:
+            return None
+
+        if data["payload"]["success"] is False:
+            self.log(data["payload"]["message"])
+            return None
+        address = data["payload"]["address"]
+        address = (address[0], int(address[1]))
+        return address
+
+    def handle_fetch_sources(self, data):
+        """Handle the fetch response from the server by queueing a download job.
+
+        Args:
+            data (obj): response from the server
+        """
+        sources_data = data["payload"]
+        fname = sources_data["fname"]
+        requests, priority = self.pop_fetch_requests(fname)
+        if not sources_data["success"]:
+            self.log("No other clients with the file found!")
+            for request in requests:
+                request.answer("not found")
+            return
+        job = self.downloads.submit(sources_data, priority)
+        for request in requests:
+            request.answer("queued", job)
+        self.log(f"Fetch of {fname} queued as job #{job.id}.")
+
+    def handle_batch_fetch_sources(self, data):
+        """Handle the response from the server to a batch fetch by queueing
+        a download job for every file found.
+
+        Args:
+            data (obj): response from the server
+        """
+        queued = 0
+        for sources_data in data["payload"]["files"]:
+            fname = sources_data["fname"]
+            requests, priority = self.pop_fetch_requests(fname)
+            if not sources_data["success"]:
+                self.log(f"No other clients with the file {fname} found!")
+                for request in requests:
+                    request.answer("not found")
+                continue
+            job = self.downloads.submit(sources_data, priority)
+            for request in requests:
+                request.answer("queued", job)
+            queued += 1
+        self.log(f"Fetch of {queued} files queued.")
+
+    def is_up_to_date(self, sources_data):
+        """Check whether the repository already has the published version of a fetched file.
+
+        Args:
+            sources_data (obj): the payload of the fetch response for the file
+
+        Returns:
+            bool: True if the local copy has the published Merkle root
+        """
+        fname = sources_data["fname"]
+        if fname not in self.repository_index or sources_data.get("root") is None:
+            return False
+        entry = self.get_file_pieces(fname)
+        return entry is not None and entry["root"] == sources_data["root"]
+
+    def fetch_locally(self, job):
+        """End a download job without downloading if the repository already
+        has the published version, or a local file has its content. Run by
+        the download workers, as it may hash a repository file.
+
+        Args:
+            job (DownloadJob): the job
+
+        Returns:
+            bool: True if the job was ended, "up to date" or "done"
+        """
+        if self.is_up_to_date(job.sources):
+            self.log(f"File {job.fname} is up to date.")
+            self.downloads.end(job, "up to date")
+            return True
+        if self.link_content(job.fname, job.root):
+            self.downloads.end(job, "done")
+            return True
+        return False
+
+    def run_jobs(self, jobs, address):
+        """Run download jobs against one peer. Several jobs are downloaded
+        over one pipelined connection, the jobs that fail there are then
+        repaired or retried one by one.
+
+        Args:
+            jobs (list[DownloadJob]): the jobs, all of them held by the peer
+            address (tuple[str, int]): the peer's address (hostname, port)
+        """
+        jobs = [job for job in jobs if not self.fetch_locally(job)]
+        if not jobs:
+            return
+        started = time.monotonic()
+        received = 0
+        failed = [job.fname for job in jobs]
+        # Updates of repository files are downloaded one by one, as deltas
+        new_jobs = [job for job in jobs if job.fname not in self.repository_index]
+        if len(new_jobs) > 1:
+            target_socket = self.peer_pool.acquire(address)
+            if target_socket:
+                files = [(job.fname, job.root) for job in new_jobs]
+                failed, reusable = self.download_files(
+                    target_socket, files, {job.fname: job for job in new_jobs}
+                )
+                if reusable:
+                    self.peer_pool.release(address, target_socket)
+                else:
+                    self.peer_pool.discard(target_socket)
+
+        for job in jobs:
+            if job.fname not in failed:
+                fetch_status = True
+            elif job.cancelled:
+                self.downloads.end(job, "cancelled")
+                self.log(f"Fetch of {job.fname} cancelled.")
+                continue
+            elif self.bad_pieces.get(job.fname):
+                # Download only the corrupted pieces again, from other holders first
+                addresses = self.source_addresses(job.sources)
+                addresses.remove(address)
+                addresses = self.peer_scores.rank(addresses, job.size)
+                fetch_status = self.repair_pieces(job.fname, addresses + [address])
+            elif not self.downloads.is_busy(address):
+                fetch_status = self.download_from_peer(job, address)
+            else:
+                fetch_status = False
+
+            if fetch_status is True:
+                self.downloads.end(job, "done")
+                received += job.bytes_done - job.start_offset
+                self.log(f"Fetch of {job.fname} successfully!")
+            elif job.cancelled:
+                self.downloads.end(job, "cancelled")
+                self.log(f"Fetch of {job.fname} cancelled.")
+            elif self.downloads.is_busy(address):
+                # The peer turned the download away, wait for it or use another holder
+                self.downloads.requeue(job)
+                self.log(f"Peer {address} is busy, fetch of {job.fname} queued again.")
+            else:
+                self.peer_scores.record_failure(address)
+                job.failed_peers.add(address)
+                if any(other not in job.failed_peers for other in self.source_addresses(job.sources)):
+                    # Resume from the bytes already received, from another holder
+                    self.downloads.requeue(job)
+                    self.log(f"Fetch of {job.fname} from {address} failed, trying another holder.")
+                    continue
+                # Keep the partial download, the next fetch resumes from it
+                self.downloads.end(job, "failed")
+                self.fetch_cache.pop(job.fname, None)
+                self.log(f"Fetch of {job.fname} failed! Fetch the file again to resume the download.")
+        if received:
+            self.peer_scores.record_download(address, received, time.monotonic() - started)
+
+    def download_from_peer(self, job, address):
+        """Download the file of a job from one peer.
+
+        Args:
+            job (DownloadJob): the job
+            address (tuple[str, int]): the peer's address (hostname, port)
+
+        Returns:
+            bool: True if the file was downloaded successfully, False otherwise
+        """
+        target_socket = self.peer_pool.acquire(address)
+        if not target_socket:
+            return False
+        try:
+            fetch_status = self.download_file(target_socket, job.fname, job.root, job)
+        except Exception as e:
+            self.log(f"Error downloading file: {e}")
+            fetch_status = False
+        if fetch_status is True or self.bad_pieces.get(job.fname):
+            # The whole file was received, the connection is ready for reuse
+            self.peer_pool.release(address, target_socket)
+        else:
+            self.peer_pool.discard(target_socket)
+        if fetch_status is False and self.bad_pieces.get(job.fname):
+            # Download only the corrupted pieces again, from other holders first
+            addresses = self.source_addresses(job.sources)
+            addresses.remove(address)
+            addresses = self.peer_scores.rank(addresses, job.size)
+            fetch_status = self.repair_pieces(job.fname, addresses + [address])
+        return fetch_status
+
+    def source_addresses(self, sources_data):
+        """List the addresses of the clients holding the published version of a file.
+
+        Args:
+            sources_data (obj): the payload of the fetch response for the file
+
+        Returns:
+            list[tuple[str, int]]: the addresses (hostname, port)
+        """
+        root = sources_data.get("root")
+        return [
+            (client["address"][0], int(client["address"][1]))
+            for client in sources_data["available_clients"]
+            if client.get("root") in (None, root)
+        ]
+
+    def handle_discover_sources(self, data):
+        """Handle the discover response from the server.
+
+        Args:
+            data (obj): response from the server
+        """
+        sources_data = data["payload"]
+        with self.catalog_lock:
+            self.discovery_array = sources_data["fname"][0]
+            self.catalog_names = set(self.discovery_array)
+            self.catalog_sorted = True
+        self.catalog_time = time.monotonic() if sources_data["success"] else None
+        self.catalog_received.set()
+        if not sources_data["success"]:
+            self.log("Can not file fetch lists!")
+            return 
+        
+        
+    def quit(self, client_socket: socket.socket):       
+        """Quit the client.
+
+        Args:
+            client_socket (socket): the client' socket
+        """
+        self.close(client_socket)
+        print("Client connection closed. Exiting.")
+        sys.exit(0)
+
+    def close(self, client_socket: socket.socket):
+        """Stop the client's threads and close its connections and files,
+        without exiting.
+
+        Args:
+            client_socket (socket): the client' socket
+        """
+        self.stop_threads = True
+        if self.watcher is not None:
+            self.watcher.stop()
+        try:
+            # Wakes the thread reading the socket, close alone would not end the connection
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client_socket.close()
+        self.peer_pool.close_all()
+        if hasattr(self, "listener_socket"):
+            self.listener_socket.close()
+        if self.async_server is not None:
+            self.async_server.stop()
+        if self.metadata is not None:
+            self.metadata.close()
+
+    def send_hostname(self, client_socket: socket.socket):      
+        """Send the client's hostname to the server.
+
+        Args:
+            client_socket (socket.socket): the client' socket
+        """
+        command = {
+            "header": "sethost",
+            "type": 0,
+            "payload": {
+                "hostname": self.hostname,
+            },
+        }
+        self.send_request(client_socket, command)
+
+    def p2p_connect(self, target_address):
+        """Connect to a peer.
+
+        Args:
+            target_address (tuple[str, int]): the peer's address (hostname, port)
+
+        Returns:
+            socket: the socket connected to the peer
+        """
+        started = time.monotonic()
+        try:
+            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            target_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            target_socket.settimeout(PEER_CONNECT_TIMEOUT)
+            target_socket.connect(target_address)
+        except Exception as e:
+            self.log(f"Error connecting to {target_address}: {e}")
+            self.peer_scores.record_failure(target_address)
+            return None
+        self.peer_scores.record_connect(target_address, time.monotonic() - started)
+        return target_socket
+
+    def download_file(self, target_socket: socket.socket, file_name, root=None, job=None):
+        """Download a file from a peer.
+
+        The data is written to a ``.part`` file in the client's state folder
+        while a PieceVerifier checks every piece against the peer's piece
+        hashes. A small journal records how many bytes are verified and on
+        disk, so an interrupted download resumes from that offset, from any
+        peer that holds the same version of the file. A newer version of a
+        repository file is downloaded as the changes from the local copy
+        first, see download_delta. A peer that does not answer within
+        FIRST_BYTE_TIMEOUT seconds, or stops sending for DOWNLOAD_IDLE_TIMEOUT
+        seconds, fails the download, and the job moves on to another holder.
+
+        Args:
+            target_socket (socket.socket): the peer's socket
+            file_name (str): the file's name on the peer
+            root (str): Merkle root of the file published on the server, if known
+            job (DownloadJob): the job to report progress to and check for cancellation
+
+        Returns:
+            bool: True if the file was downloaded successfully, False otherwise
+        """
+        entry = self.repository_index.lookup(file_name)
+        if entry is not None:
+            # Replace the older copy
+            self.updating.add(file_name)
+        if entry is not None and self.delta_worthwhile(entry[0], job.size if job is not None else None):
+            transfer = self.start_download(target_socket, file_name, "delta", job)
+            status = False
+            try:
+                status = self.download_delta(target_socket, file_name, root, job, transfer)
+            finally:
+                self.transfers.finish(transfer, status)
+            if status is not None:
+                return status
+        self.request_download(target_socket, file_name, root)
+        transfer = self.start_download(target_socket, file_name, "file", job)
+        status = False
+        try:
+            status = self.receive_download(target_socket, file_name, root, job, transfer)
+        finally:
+            self.transfers.finish(transfer, status)
+        return status
+
+    def start_download(self, target_socket: socket.socket, file_name, kind="file", job=None):
+        """Start measuring the download of a file, see TransferStats.
+
+        Args:
+            target_socket (socket.socket): the peer's socket
+            file_name (str): the file's name on the peer
+            kind (str): "file", "delta" or "range"
+            job (DownloadJob): the job of the download, its earlier attempts are counted as retries
+
+        Returns:
+            Transfer: the transfer
+        """
+        retries = max(job.attempts - 1, 0) if job is not None else 0
+        return self.transfers.start("download", target_socket.getpeername(), file_name, kind, retries)
+
+    def delta_worthwhile(self, local_size, size=None):
+        """Tell whether a local copy of a file is worth downloading the
+        changes from, rather than the whole file.
+
+        Args:
+            local_size (int): number of bytes in the local copy
+            size (int): number of bytes in the new version, None if unknown
+
+        Returns:
+            bool: False if the copy is small, or so much smaller than the new
+                version that the peer would give the delta up anyway
+        """
+        if local_size < DELTA_MIN_FILE_SIZE:
+            return False
+        if math.ceil(local_size / delta_block_size(local_size)) > DELTA_MAX_SIGNATURES:
+            return False
+        return size is None or size - local_size <= size * DELTA_MAX_LITERAL_RATIO
+
+    def download_delta(self, target_socket: socket.socket, file_name, root=None, job=None, transfer=None):
+        """Download a newer version of a repository file as the changes from
+        the local copy. The signatures of the copy's blocks are sent to the
+        peer, which answers with the blocks to copy and the new data, see
+        delta_stream. The new version is rebuilt in the ``.part`` file and
+        checked against the peer's piece hashes.
+
+        Args:
+            target_socket (socket.socket): the peer's socket
+            file_name (str): the file's name on the peer and in the repository
+            root (str): Merkle root of the file published on the server, if known
+            job (DownloadJob): the job to report progress to and check for cancellation
+            transfer (Transfer): the measurements to count the received data in
+
+        Returns:
+            bool: True if the file was downloaded successfully, False otherwise,
+                None if the peer gave the delta up or the rebuilt file is
+                invalid, and the whole file must be downloaded
+        """
+        basis_path = os.path.join(self.repository_folder, file_name)
+        entry = self.repository_index.lookup(file_name)
+        if entry is None:
+            return None
+        block_size = delta_block_size(entry[0])
+        signatures = block_signatures(basis_path, block_size)
+        send_message(target_socket, {"header": "pieces", "type": 0, "payload": {"fname": file_name, "root": root}})
+        data = {
+            "header": "delta",
+            "type": 0,
+            "payload": {
+                "fname": file_name,
+                "root": root,
+                "block_size": block_size,
+                "signatures": signatures,
+            },
+        }
+        send_message(target_socket, data)
+
+        target_socket.settimeout(FIRST_BYTE_TIMEOUT)
+        pieces_data = recv_message(target_socket)
+        if pieces_data is None:
+            self.log("Connection closed by peer.")
+            return False
+        info = pieces_data["payload"]
+        if info.get("busy"):
+            self.downloads.mark_busy(target_socket.getpeername(), info["retry_after"])
+            return False
+        if info["success"] is False:
+            self.log(info["message"])
+            return False
+        if root is not None and merkle_root(info["pieces"]) != root:
+            self.log(f"Piece hashes of {file_name} from peer do not match the published file.")
+            return False
+
+        data = recv_message(target_socket)
+        if data is None:
+            self.log("Connection closed by peer.")
+            return False
+        if data["payload"].get("busy"):
+            self.downloads.mark_busy(target_socket.getpeername(), data["payload"]["retry_after"])
+            return False
+        if data["payload"]["success"] is False:
+            self.log(data["payload"]["message"])
+            return False
+        target_socket.settimeout(DOWNLOAD_IDLE_TIMEOUT)
+        size = data["payload"]["size"]
+        if size != info["size"]:
+            self.log(f"File {file_name} changed on peer during download.")
+            return False
+        if job is not None:
+            if job.cancelled:
+                return False
+            job.size = size
+            job.bytes_done = job.start_offset = job.verified = 0
+        if transfer is not None:
+            transfer.size = size
+
+        # The partial file is overwritten, a journal would resume from it
+        self.remove_journal(file_name)
+        part_path = self.state_path("partial", file_name + PARTIAL_SUFFIX)
+        self.log(f"Downloading the changes of {file_name} from {target_socket.getpeername()}...")
+        received = 0
+        with open(basis_path, "rb") as basis, open(part_path, "wb") as file:
+            while True:
+                kind = recv_exact(target_socket, 1)
+                if kind == b"C":
+                    header = recv_exact(target_socket, 8)
+                    if header is None:
+                        self.log("Connection closed by peer.")
+                        return False
+                    first, count = int.from_bytes(header[:4], "big"), int.from_bytes(header[4:], "big")
+                    if first + count > len(signatures):
+                        self.log(f"Invalid delta of {file_name} from peer.")
+                        return False
+                    for index in range(first, first + count):
+                        file.write(os.pread(basis.fileno(), block_size, index * block_size))
+                    if transfer is not None:
+                        transfer.data(0)
+                elif kind == b"D":
+                    header = recv_exact(target_socket, 4)
+                    length = int.from_bytes(header, "big") if header else 0
+                    while length > 0:
+                        chunk = target_socket.recv(min(length, UPLOAD_CHUNK_SIZE))
+                        if not chunk:
+                            break
+                        file.write(chunk)
+                        length -= len(chunk)
+                        received += len(chunk)
+                        if transfer is not None:
+                            transfer.data(len(chunk))
+                    if header is None or length > 0:
+                        self.log("Connection closed by peer.")
+                        return False
+                elif kind == b"E":
+                    break
+                elif kind == b"A":
+                    self.log(f"{file_name} changed too much for a delta, downloading the whole file.")
+                    return None
+                else:
+                    self.log("Connection closed by peer." if kind is None else f"Invalid delta of {file_name} from peer.")
+                    return False
+                if job is not None:
+                    job.bytes_done = file.tell()
+                    if job.cancelled:
+                        return False
+
+        pieces, _ = hash_file(part_path, info["piece_size"])
+        if pieces != info["pieces"]:
+            self.log(f"The changes of {file_name} do not rebuild the peer's version, downloading the whole file.")
+            return None
+        self.log(f"Received {received} bytes of changes for the {size} bytes of {file_name}.")
+        self.finish_download(file_name)
+        return True
+
+    def download_files(self, target_socket: socket.socket, files, jobs=None):
+        """Download several files from a peer over one connection.
+
+        The requests for up to PIPELINE_DEPTH files are sent ahead of the
+        file being received, so the peer streams the files back to back.
+
+        Args:
+            target_socket (socket.socket): the peer's socket
+            files (list[tuple[str, str]]): the (file name, Merkle root) of each file
+            jobs (dict): the DownloadJob of each file, by file name
+
+        Returns:
+            tuple[list[str], bool]: the names of the files that were not downloaded,
+                and whether the connection can be reused
+        """
+        pending = list(files)
+        roots = dict(files)
+        in_flight = []
+        failed = []
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < PIPELINE_DEPTH:
+                    file_name, root = pending.pop(0)
+                    self.request_download(target_socket, file_name, root)
+                    in_flight.append(file_name)
+                file_name = in_flight.pop(0)
+                job = (jobs or {}).get(file_name)
+                transfer = self.start_download(target_socket, file_name, "file", job)
+                received = False
+                try:
+                    received = self.receive_download(target_socket, file_name, roots[file_name], job, transfer)
+                finally:
+                    self.transfers.finish(transfer, received)
+                if received:
+                    continue
+                failed.append(file_name)
+                if not self.bad_pieces.get(file_name):
+                    # The rest of the stream cannot be trusted any more
+                    return failed + in_flight + [name for name, _ in pending], False
+        except Exception as e:
+            self.log(f"Error downloading files: {e}")
+            return failed + in_flight + [name for name, _ in pending], False
+        return failed, True
+
+    def request_download(self, target_socket: socket.socket, file_name, root=None):
+        """Send the pieces and download requests for a file to a peer,
+        resuming from the journal of a partial download.
+
+        Args:
+            target_socket (socket.socket): the peer's socket
+            file_name (str): the file's name on the peer
+            root (str): Merkle root of the file published on the server, if known
+        """
+        part_path = self.state_path("partial", file_name + PARTIAL_SUFFIX)
+        offset = 0
+        size = None
+        journal = self.load_journal(file_name)
+        if journal and root in (None, journal.get("root")) and os.path.isfile(part_path):
+            offset = min(journal["offset"], os.path.getsize(part_path))
+            offset -= offset % journal.get("piece_size", PIECE_SIZE)
+            size = journal["size"]
+
+        data = {
+            "header": "pieces",
+            "type": 0,
+            "payload": {
+                "fname": file_name,
+                "root": root,
+            },
+        }
+        send_message(target_socket, data)
+        data = {
+            "header": "download",
+            "type": 0,
+            "payload": {
+                "fname": file_name,
+                "root": root,
+                "offset": offset,
+                "size": size,
+                "compression": self.compressions,
+            },
+        }
+        send_message(target_socket, data)
+
+    def receive_download(self, target_socket: socket.socket, file_name, root=None, job=None, transfer=None):
+        """Receive a file requested with request_download.
+
+        Args:
+            target_socket (socket.socket): the peer's socket
+            file_name (str): the file's name on the peer
+            root (str): Merkle root of the file published on the server, if known
+            job (DownloadJob): the job to report progress to and check for cancellation
+            transfer (Transfer): the measurements to count the received data in
+
+        Returns:
+            bool: True if the file was downloaded successfully, False otherwise
+        """
+        target_socket.settimeout(FIRST_BYTE_TIMEOUT)
+        pieces_data = recv_message(target_socket)
+        if pieces_data is None:
+            self.log("Connection closed by peer.")
+            return False
+        info = pieces_data["payload"]
+        if info.get("busy"):
+            self.downloads.mark_busy(target_socket.getpeername(), info["retry_after"])
+            return False
+        if info["success"] is False:
+            self.log(info["message"])
+            return False
+        pieces_root = merkle_root(info["pieces"])
+        if root is not None and pieces_root != root:
+            self.log(f"Piece hashes of {file_name} from peer do not match the published file.")
+            return False
+        self.download_pieces[file_name] = info
+        piece_size = info["piece_size"]
+
+        data = recv_message(target_socket)
+        if data is None:
+            self.log("Connection closed by peer.")
+            return False
+        if data["payload"].get("busy"):
+            self.downloads.mark_busy(target_socket.getpeername(), data["payload"]["retry_after"])
+            return False
+        if data["payload"]["success"] is False:
+            self.log(data["payload"]["message"])
+            return False
+        target_socket.settimeout(DOWNLOAD_IDLE_TIMEOUT)
+        length = data["payload"]["length"]
+        offset = data["payload"].get("offset", 0)
+        size = data["payload"].get("size", offset + length)
+        end = offset + length
+        if size != info["size"]:
+            self.log(f"File {file_name} changed on peer during download.")
+            return False
+        if job is not None:
+            if job.cancelled:
+                return False
+            job.size = size
+            job.bytes_done = job.start_offset = offset
+        if transfer is not None:
+            transfer.offset = offset
+            transfer.size = size
+            transfer.compression = data["payload"].get("compression")
+
+        part_path = self.state_path("partial", file_name + PARTIAL_SUFFIX)
+        bad_prefix = set()
+        if offset > 0:
+            journal = self.load_journal(file_name)
+            if journal is None or journal.get("root") != pieces_root:
+                # The partial file is from another version, check its pieces again
+                bad_prefix = set(range(offset // piece_size))
+            self.log(f"Resuming {file_name} from byte {offset} of {size}...")
+        if job is not None:
+            job.verified = 0 if bad_prefix else offset
+        self.log(f"Downloading file from {target_socket.getpeername()}...")
+        verifier = PieceVerifier(info["pieces"], offset // piece_size)
+        verifier.start()
+        piece_index = offset // piece_size
+        piece = bytearray()
+        reader = TransferReader(target_socket, data["payload"].get("compression"))
+        with open(part_path, "r+b" if os.path.exists(part_path) else "wb") as file:
+            file.truncate(offset)
+            file.seek(offset)
+            checkpoint = offset
+            try:
+                while offset < end:
+                    recved = reader.read(
+                        min(DOWNLOAD_CHUNK_SIZE, end - offset, piece_size - len(piece))
+                    )
+
+                    if not recved:
+                        self.log("Connection closed by peer.")
+                        return False
+
+                    file.write(recved)
+                    offset += len(recved)
+                    piece += recved
+                    if transfer is not None:
+                        transfer.data(len(recved))
+                    if job is not None:
+                        job.bytes_done = offset
+                        if job.cancelled:
+                            return False
+                    if len(piece) >= piece_size or offset == end:
+                        verifier.submit(piece_index, bytes(piece))
+                        piece_index += 1
+                        piece = bytearray()
+                    if job is not None and not bad_prefix and verifier.verified * piece_size > job.verified:
+                        # Make the verified pieces readable by a streaming fetch
+                        file.flush()
+                        job.verified = min(verifier.verified * piece_size, size)
+                    if offset - checkpoint >= JOURNAL_INTERVAL and not bad_prefix:
+                        self.save_journal(
+                            file, file_name, size, verifier.verified * piece_size, pieces_root, piece_size
+                        )
+                        checkpoint = offset
+                        self.log(f"Received {offset} of {size} bytes...")
+
+            except ConnectionResetError:
+                self.log("Connection closed by peer.")
+                return False
+            except Exception as e:
+                self.log(f"Error receiving file: {e}")
+                return False
+            finally:
+                bad_pieces = verifier.finish() | bad_prefix
+                if offset < end or bad_pieces:
+                    verified = 0 if bad_prefix else min(verifier.verified * piece_size, size)
+                    self.save_journal(file, file_name, size, verified, pieces_root, piece_size)
+
+        if bad_pieces:
+            self.log(f"{len(bad_pieces)} pieces of {file_name} failed verification.")
+            self.bad_pieces[file_name] = bad_pieces
+            return False
+
+        self.finish_download(file_name)
+        return True
+
+    def download_range(self, target_socket: socket.socket, file_name, offset, length, size, root=None):
+        """Download a byte range of a file from a peer.
+
+        Args:
+            target_socket (socket.socket): the peer's socket
+            file_name (str): the file's name on the peer
+            offset (int): first byte of the range
+            length (int): number of bytes in the range
+            size (int): the expected size of the file
+            root (str): Merkle root of the file, if known
+
+        Returns:
+            bytes: the content of the range, or None if it could not be downloaded
+        """
+        data = {
+            "header": "download",
+            "type": 0,
+            "payload": {
+                "fname": file_name,
+                "root": root,
+                "offset": offset,
+                "length": length,
+                "size": size,
+            },
+        }
+        send_message(target_socket, data)
+
+        transfer = self.start_download(target_socket, file_name, "range")
+        transfer.offset = offset
+        transfer.size = size
+        content = None
+        try:
+            target_socket.settimeout(FIRST_BYTE_TIMEOUT)
+            data = recv_message(target_socket)
+            if data is None or data["payload"]["success"] is False:
+                return None
+            target_socket.settimeout(DOWNLOAD_IDLE_TIMEOUT)
+            payload = data["payload"]
+            transfer.compression = payload.get("compression")
+            content = TransferReader(target_socket, payload.get("compression")).read_exact(payload["length"])
+            if content is not None:
+                transfer.data(len(content))
+            if payload["offset"] != offset or payload["length"] != length:
+                content = None
+            return content
+        finally:
+            self.transfers.finish(transfer, content is not None)
+
+    def repair_pieces(self, file_name, addresses):
+        """Download again the pieces of a file that failed verification.
+
+        Args:
+            file_name (str): the file's name on the server
+            addresses (list[tuple[str, int]]): the peers to try, in order
+
+        Returns:
+            bool: True if every piece was repaired and the download finished, False otherwise
+        """
+        info = self.download_pieces[file_name]
+        bad_pieces = self.bad_pieces[file_name]
+        piece_size = info["piece_size"]
+        part_path = self.state_path("partial", file_name + PARTIAL_SUFFIX)
+
+        for address in addresses:
+            target_socket = self.peer_pool.acquire(address)
+            if target_socket is None:
+                continue
+            for index in sorted(bad_pieces):
+                offset = index * piece_size
+                length = min(piece_size, info["size"] - offset)
+                try:
+                    data = self.download_range(
+                        target_socket, file_name, offset, length, info["size"], info.get("root")
+                    )
+                except Exception as e:
+                    self.log(f"Error receiving piece {index} of {file_name}: {e}")
+                    data = None
+                if data is None or hashlib.sha256(data).hexdigest() != info["pieces"][index]:
+                    self.log(f"Piece {index} of {file_name} from {address} is invalid.")
+                    self.peer_pool.discard(target_socket)
+                    target_socket = None
+                    break
+
+                with open(part_path, "r+b") as file:
+                    file.seek(offset)
+                    file.write(data)
+                bad_pieces.discard(index)
+            if target_socket is not None:
+                self.peer_pool.release(address, target_socket)
+            if not bad_pieces:
+                break
+
+        if bad_pieces:
+            self.log(f"{len(bad_pieces)} pieces of {file_name} could not be repaired.")
+            return False
+        del self.bad_pieces[file_name]
+        self.log(f"Repaired all pieces of {file_name}.")
+        self.finish_download(file_name)
+        return True
+
+    def finish_download(self, file_name):
+        """Move a completed download into the repository and publish it.
+
+        Args:
+            file_name (str): the file's name on the server
+        """
+        part_path = self.state_path("partial", file_name + PARTIAL_SUFFIX)
+        pieces, content_hash = hash_file(part_path)
+        fname = file_name
+        if file_name in self.updating:
+            self.updating.discard(file_name)
+        elif os.path.isfile(os.path.join(self.repository_folder, fname)):
+            existing = self.get_file_pieces(fname)
+            if existing is not None and existing["content_hash"] == content_hash:
+                # A file with the same content appeared under the name meanwhile
+                fname = None
+            else:
+                root, ext = os.path.splitext(fname)
+                fname = root + "_copy" + ext
+        if fname is None:
+            os.remove(part_path)
+        else:
+            self.store_content(part_path, fname, pieces, content_hash, move=True)
+        self.remove_journal(file_name)
+        self.download_pieces.pop(file_name, None)
+
+        self.log("Download completed!")
+        self.log(f"Publish file {fname or file_name} to server")
+        self.publish(self.client_socket, self.repository_folder, fname or file_name)
+
+    def get_file_pieces(self, file_name, hash_missing=True):
+        """Get the piece hashes of a repository file, from memory or from the
+        metadata database, hashing it again only when its size, modification
+        time or inode changed.
+
+        Args:
+            file_name (str): the file's name in the repository
+            hash_missing (bool): hash the file if its hashes are not known
+
+        Returns:
+            dict: {"size", "mtime", "inode", "content_hash", "piece_size", "pieces", "root"},
+                or None if the file is missing, or not hashed and hash_missing is False
+        """
+        entry = self.repository_index.lookup(file_name)
+        if entry is None:
+            return None
+        info = self.file_pieces.get(file_name)
+        if info is not None and (info["size"], info["mtime"], info["inode"]) == entry:
+            return info
+
+        info = None
+        try:
+            info = self.metadata_store().get(file_name, *entry)
+        except sqlite3.Error as e:
+            self.log(f"Error reading the metadata database: {e}")
+        if info is None:
+            if not hash_missing:
+                return None
+            pieces, content_hash = hash_file(os.path.join(self.repository_folder, file_name))
+            return self.store_file_pieces(file_name, entry, pieces, content_hash)
+        self.file_pieces[file_name] = info
+        return info
+
+    def store_file_pieces(self, file_name, entry, pieces, content_hash):
+        """Remember the hashes of a repository file, in memory and in the metadata database.
 
         Args:
-            client_socket (socket.socket): the peer' socket
-            
+            file_name (str): the file's name in the repository
+            entry (tuple[int, int, int]): (size, mtime_ns, inode) of the hashed file
+            pieces (list[str]): the hex digests of the pieces
+            content_hash (str): the hex digest of the content
+
         Returns:
-            bool: True if the file was published successfully, False otherwise
-        """   
-        if self.server_connected is False:
-            self.log("Not connected to server.")
-            return False
-        files_in_repository = [file for file in os.listdir(self.repository_folder) if os.path.isfile(os.path.join(self.repository_folder, file))]
-        request = json.dumps(
-            {
-                "header": "publish",
-                "type": 0,
-                "payload": {"fname": files_in_repository},
-            }
-        )
-        
+            dict: {"size", "mtime", "inode", "content_hash", "piece_size", "pieces", "root"}
+        """
+        info = {
+            "size": entry[0],
+            "mtime": entry[1],
+            "inode": entry[2],
+            "content_hash": content_hash,
+            "piece_size": PIECE_SIZE,
+            "pieces": pieces,
+            "root": merkle_root(pieces),
+        }
         try:
-            client_socket.sendall(request.encode("utf-8", "replace"))
-        except Exception as e:
-            self.log(f"Error publish files to server: {e}")
-            return False
+            self.metadata_store().put(file_name, info)
+        except sqlite3.Error as e:
+            self.log(f"Error updating the metadata database: {e}")
+        self.file_pieces[file_name] = info
+        return info
 
-        return True
-        
-    def is_file_in_folder(self, file_name, folder_path):    
-        # Helper function    
-        file_path = os.path.join(folder_path, file_name)
-        return os.path.isfile(file_path)
+    def metadata_store(self):
+        """Get the metadata database of the repository, opening it on first use.
 
-    def publish(self, client_socket: socket.socket, file_path, file_name: str):     
-        """Publish a file aliased as file_name to the server.
+        Returns:
+            MetadataStore: the database
+        """
+        path = os.path.join(self.repository_folder, STATE_FOLDER, METADATA_DB)
+        with self.metadata_lock:
+            if self.metadata is None or self.metadata.path != path:
+                self.metadata = MetadataStore(self.state_path(METADATA_DB))
+            return self.metadata
+
+    def file_meta(self, file_name):
+        """Get the metadata of a repository file announced to the server.
 
         Args:
-            client_socket (socket.socket): the client' socket
-            file_path (str): path to local file on the client's machine
-            file_name (str): name of the file uploaded to client's repository and on the server
+            file_name (str): the file's name in the repository
 
         Returns:
-            bool: True if the file was published successfully, False otherwise
+            dict: {"size", "root"}, or None if the file is missing
         """
-        # call discover function
-        if file_path != self.repository_folder:
-            discover_status = self.discover(self.client_socket)
-            if discover_status:
-                while not self.discover_status:
-                    pass
-            self.discover_status = False
-            if file_name in self.discovery_array:
-                self.log("File already existed in the repository\nSend 'discover' command for existing file names.")   
-                return False
+        info = self.get_file_pieces(file_name)
+        if info is None:
+            return None
+        return {"size": info["size"], "root": info["root"]}
 
-            if self.server_connected is False:
-                self.log("Not connected to server.")
-                return False
+    def stored_object(self, content_hash):
+        """Get the file storing some content in the object store, if it is
+        there and did not change since it was stored.
 
-            if not os.path.exists(file_path):
-                self.log(f"File does not exist.")
-                return False
+        Args:
+            content_hash (str): the hex digest of the content
 
-            if self.is_file_in_folder(file_name, self.repository_folder):
-                self.log(f"File name '{file_name}' already exists in local repository.")
-                return False
-            
-            uploaded_file_path = os.path.join(self.repository_folder, file_name)
+        Returns:
+            str: path to the object, or None
+        """
+        path = self.state_path(OBJECTS_FOLDER, content_hash)
+        try:
+            known = self.metadata_store().get_object(content_hash)
+        except sqlite3.Error as e:
+            self.log(f"Error reading the metadata database: {e}")
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if known is not None and (st.st_size, st.st_mtime_ns) == tuple(known):
+            return path
+        os.remove(path)
+        return None
 
-            try:
-                shutil.copy(file_path, uploaded_file_path)
-                self.log(f'File uploaded to repository: {uploaded_file_path}')
-            except Exception as e:
-                self.log(f'Error uploading file: {e}')
-        
-        request = json.dumps(
-            {
-                "header": "publish",
-                "type": 0,
-                "payload": {"fname": [file_name]},
-            }
-        )
+    def add_object(self, source, content_hash):
+        """Store the content of a repository file in the object store, as a
+        hard link or reflink to the file. The file itself is left as it is,
+        and a content that cannot be linked is not stored: the repository
+        file stays its only copy. An object that changes with its file is
+        dropped by stored_object.
+
+        Args:
+            source (str): path to the repository file
+            content_hash (str): the hex digest of the file's content
 
+        Returns:
+            str: path to the object, or None if no link could be made
+        """
+        path = self.state_path(OBJECTS_FOLDER, content_hash)
+        if os.path.lexists(path):
+            os.remove(path)
+        if link_file(source, path, copy=False) is None:
+            return None
+        st = os.stat(path)
         try:
-            client_socket.sendall(request.encode("utf-8", "replace"))
-        except Exception as e:
-            self.log(f"Error publish file to server: {e}")
-            return False
-        
-        return True
+            self.metadata_store().put_object(content_hash, st.st_size, st.st_mtime_ns)
+        except sqlite3.Error as e:
+            self.log(f"Error updating the metadata database: {e}")
+        return path
 
-    def fetch(self, client_socket: socket.socket, file_name: str):
-        """Fetch a file from the server into the client's directory.
+    def alias_object(self, path, file_name):
+        """Make a repository file an alias of an object, replacing the file if
+        it exists. The alias is a reflink or a copy, never a hard link: the
+        object may be a hard link to another repository file, and editing
+        one of them in place must not change the other.
 
         Args:
-            client_socket (socket.socket): the client' socket
-            file_name (str): the file's name on the server to fetch
-        Return:
-            bool: True if the file was fetched successfully, False otherwise
+            path (str): path to the object
+            file_name (str): the file's name in the repository
+
+        Returns:
+            str: how the alias was made, "reflink" or "copy"
         """
-        if self.server_connected is False:
-            self.log("Not connected to server.")
-            return False
+        temp_path = self.state_path("partial", file_name + ALIAS_SUFFIX)
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        method = clone_file(path, temp_path)
+        os.replace(temp_path, os.path.join(self.repository_folder, file_name))
+        self.repository_index.update(file_name)
+        return method
 
-        files = os.listdir(self.repository_folder)
-        if file_name in files:
-            self.log("File existing in repository")
-            return False
-        
-        discover_status = self.discover(self.client_socket)
-        if discover_status:
-            while not self.discover_status:
-                pass
-        self.discover_status = False
+    def store_content(self, source, file_name, pieces, content_hash, move=False):
+        """Put a file into the repository through the object store. Content
+        that is already stored is only aliased, not stored again; new content
+        is put in the repository, then linked into the store if possible.
 
-        if file_name not in self.discovery_array:
-            self.log("No other clients with the file found!")
-            return False
+        Args:
+            source (str): path to the file
+            file_name (str): the file's name in the repository
+            pieces (list[str]): the hex digests of the file's pieces
+            content_hash (str): the hex digest of the file's content
+            move (bool): the file may be moved into the repository instead of cloned
+
+        Returns:
+            str: how the repository file was made, "reflink", "copy" or "move"
+        """
+        # The content of the version being replaced, if it is known
+        replaced = self.get_file_pieces(file_name, hash_missing=False)
+        path = self.stored_object(content_hash)
+        if path is not None:
+            method = self.alias_object(path, file_name)
+            if move:
+                os.remove(source)
+        else:
+            target = os.path.join(self.repository_folder, file_name)
+            if move:
+                os.replace(source, target)
+                method = "move"
+            else:
+                temp_path = self.state_path("partial", file_name + ALIAS_SUFFIX)
+                if os.path.lexists(temp_path):
+                    os.remove(temp_path)
+                method = clone_file(source, temp_path)
+                os.replace(temp_path, target)
+            self.repository_index.update(file_name)
+            self.add_object(target, content_hash)
+        self.store_file_pieces(file_name, self.repository_index.lookup(file_name), pieces, content_hash)
+        if replaced is not None and replaced["content_hash"] != content_hash:
+            self.release_object(replaced["content_hash"])
+        return method
+
+    def release_object(self, content_hash):
+        """Drop an object from the store once no repository file has it as
+        content, so replacing a file does not keep its previous version.
 
-        command = {"header": "fetch", "type": 0, "payload": {"fname": file_name}}
-        request = json.dumps(command)
+        Args:
+            content_hash (str): the hex digest of the object's content
+        """
+        path = self.state_path(OBJECTS_FOLDER, content_hash)
         try:
-            client_socket.sendall(request.encode("utf-8", "replace"))
-        except Exception as e:
-            self.log(f"Error fetch file: {e}")
-            return False
-        return True
+            if os.lstat(path).st_nlink > 1:
+                # Still a hard link to a repository file
+                return
+        except OSError:
+            pass
+        try:
+            if not self.metadata_store().remove_object(content_hash):
+                return
+        except sqlite3.Error as e:
+            self.log(f"Error updating the metadata database: {e}")
+            return
+        if os.path.lexists(path):
+            os.remove(path)
 
-    def discover(self, client_socket: socket.socket):
-        """Discover all existed files from server file lists
+    def link_content(self, file_name, root):
+        """Add a fetched file to the repository from a local file with the
+        same content instead of downloading it, and publish it.
 
         Args:
-            client_socket (socket.socket): the client' socket
-        Return:
-            bool: True if the file names list was discovered successfully, False otherwise
+            file_name (str): the fetched file's name
+            root (str): Merkle root of the published content
+
+        Returns:
+            bool: True if a local file had the content, False otherwise
         """
-        if self.server_connected is False:
-            self.log("Not connected to server.")
+        if root is None:
             return False
-
-        command = {"header": "discover", "type": 0, "payload": {}}
-        request = json.dumps(command)
         try:
-            client_socket.sendall(request.encode("utf-8", "replace"))
-        except Exception as e:
-            self.log(f"Error discover shared files: {e}")
+            names = self.metadata_store().find(root)
+        except sqlite3.Error as e:
+            self.log(f"Error reading the metadata database: {e}")
             return False
-        return True
-    
-    def send_file(self, client_socket: socket.socket, fname: str):
-        """Send a file to a peer.
+        for name in names:
+            info = self.get_file_pieces(name, hash_missing=False)
+            if name == file_name or info is None or info["root"] != root:
+                continue
+            source = os.path.join(self.repository_folder, name)
+            if self.stored_object(info["content_hash"]) is None:
+                # Share the local file's content through the store, if it can be linked
+                self.add_object(source, info["content_hash"])
+            method = self.store_content(source, file_name, info["pieces"], info["content_hash"])
+            self.log(f"File {file_name} has the content of {name}, added as a {method} without downloading it.")
+            self.publish(self.client_socket, self.repository_folder, file_name)
+            return True
+        return False
+
+    def send_pieces(self, client_socket: socket.socket, fname: str, root=None):
+        """Send the piece hashes of a file to a peer.
 
         Args:
             client_socket (socket.socket): the peer's socket
             fname (str): the file's name on the server
+            root (str): Merkle root of the requested content, see resolve_name
+        """
+        send_message(client_socket, self.pieces_reply(fname, root))
+
+    def pieces_reply(self, fname: str, root=None):
+        """Build the reply to a pieces request.
+
+        Args:
+            fname (str): the file's name on the server
+            root (str): Merkle root of the requested content, see resolve_name
 
         Returns:
-            bool: True if the file was sent successfully, False otherwise
+            dict: the reply
         """
-        found_file_path = None
-        local_files = os.listdir(self.repository_folder)
-        for file_info in local_files:
-            if file_info == fname:
-                found_file_path = os.path.join(self.repository_folder, fname)
-                break
-
-        if found_file_path is None or not os.path.exists(found_file_path) or not os.path.isfile(found_file_path):
-            # File not found or not accessible
+        fname = self.resolve_name(fname, root)
+        info = self.get_file_pieces(fname)
+        if info is None:
             reply = {
-                "header": "download",
+                "header": "pieces",
                 "type": 1,
                 "payload": {
                     "success": False,
                     "message": f"The file you requested {fname} is not available",
-                    "length": None,
                 },
             }
-            client_socket.sendall(json.dumps(reply).encode("utf-8", "replace"))
         else:
-            # File found and accessible
-            length = os.path.getsize(found_file_path)
             reply = {
-                "header": "download",
+                "header": "pieces",
                 "type": 1,
                 "payload": {
                     "success": True,
                     "message": f"{fname} is available",
-                    "length": length,
+                    "size": info["size"],
+                    "piece_size": info["piece_size"],
+                    "pieces": info["pieces"],
+                    "root": info["root"],
                 },
             }
-            binary_reply = json.dumps(reply).encode("utf-8", "replace")
-
-            response_length = (len(binary_reply)).to_bytes(8, "big")
-            client_socket.sendall(response_length + binary_reply)
-
-            with open(found_file_path, "rb") as file:
-                offset = 0
-                try:
-                    while offset < length:
-                        data = file.read(1024)
-                        offset += len(data)
-                        client_socket.sendall(data)
-                except ConnectionResetError:
-                    self.log("Connection closed by peer.")
-                    return False
-                except Exception as e:
-                    self.log(f"Error sending file: {e}")
-                    reply = {
-                        "header": "download",
-                        "type": 1,
-                        "payload": {
-                            "success": False,
-                            "message": f"{e}",
-                            "length": length,
-                        },
-                    }
-                    client_socket.sendall(json.dumps(reply).encode("utf-8", "replace"))
-                    return False
-        return True
+        return reply
 
-    def init_hostname(self, client_socket: socket.socket, hostname: str):       
-        """Send the client's hostname to the server and receive the client's address.
+    def resolve_name(self, fname, root=None):
+        """Find the repository file to send for a peer's request: the file
+        with the requested name, or another file with the same content if
+        the peer gives the Merkle root of the content it wants.
 
         Args:
-            client_socket (socket.socket): the client' socket
-            hostname (str): the client's hostname
+            fname (str): the requested file's name
+            root (str): Merkle root of the requested content, None for any content
 
         Returns:
-            tuple[str, int]: the client's address (hostname, port)
-        """
-        self.hostname = hostname
-        self.send_hostname(client_socket)
-        data = json.loads(client_socket.recv(1024).decode("utf-8", "replace"))
-        if not data:
-            return None
-
-        if data["payload"]["success"] is False:
-            self.log(data["payload"]["message"])
-            return None
-        address = data["payload"]["address"]
-        address = (address[0], int(address[1]))
-        return address
-
-    def handle_fetch_sources(self, data):
-        """Handle the fetch response from the server.
-
-        Args:
-            data (obj): response from the server
+            str: the name of the file to send
         """
-        sources_data = data["payload"]
-        fname = sources_data["fname"]
-        if not sources_data["success"]:
-            self.log("No other clients with the file found!")
-            return
-        address = sources_data["available_clients"][0]["address"]
-        address = (address[0], int(address[1]))
-
-        target_socket = self.p2p_connect(address)
-        if target_socket:
-            fetch_status = self.download_file(target_socket, fname)
-            if fetch_status is True:
-                self.log("Fetch successfully!")
-            else:
-                self.log("Fetch failed!")
-                if os.path.isfile(os.path.join(self.path, fname)):
-                    os.remove(os.path.join(self.path, fname))
-            target_socket.close()
-        else:
-            self.log("Fetch failed!")
-
-    def handle_discover_sources(self, data):
-        """Handle the discover response from the server.
+        if root is None:
+            return fname
+        info = self.get_file_pieces(fname, hash_missing=False)
+        if info is not None and info["root"] == root:
+            return fname
+        try:
+            names = self.metadata_store().find(root)
+        except sqlite3.Error as e:
+            self.log(f"Error reading the metadata database: {e}")
+            return fname
+        for name in names:
+            info = self.get_file_pieces(name, hash_missing=False)
+            if info is not None and info["root"] == root:
+                return name
+        return fname
 
-        Args:
-            data (obj): response from the server
-        """
-        sources_data = data["payload"]
-        self.discovery_array = sources_data["fname"][0]
-        self.discover_status = True 
-        if not sources_data["success"]:
-            self.log("Can not file fetch lists!")
-            return 
-        
-        
-    def quit(self, client_socket: socket.socket):       
-        """Quit the client.
+    def state_path(self, *parts):
+        """Get a path inside the hidden state folder of the repository,
+        creating the parent folders if needed.
 
         Args:
-            client_socket (socket): the client' socket
-        """
-        self.stop_threads = True
-        client_socket.close()
-        if hasattr(self, "listener_socket"):
-            self.listener_socket.close()
-        print("Client connection closed. Exiting.")
-        sys.exit(0)
+            parts (str): path components below the state folder
 
-    def send_hostname(self, client_socket: socket.socket):      
-        """Send the client's hostname to the server.
-
-        Args:
-            client_socket (socket.socket): the client' socket
+        Returns:
+            str: the full path
         """
-        command = {
-            "header": "sethost",
-            "type": 0,
-            "payload": {
-                "hostname": self.hostname,
-            },
-        }
-        request = json.dumps(command)
-        client_socket.sendall(request.encode("utf-8", "replace"))
+        path = os.path.join(self.repository_folder, STATE_FOLDER, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
 
-    def p2p_connect(self, target_address):
-        """Connect to a peer.
+    def load_journal(self, file_name):
+        """Load the progress journal of a partial download.
 
         Args:
-            target_address (tuple[str, int]): the peer's address (hostname, port)
+            file_name (str): the file's name on the server
 
         Returns:
-            socket: the socket connected to the peer
+            dict: the journal ({"fname", "size", "offset", "root", "piece_size"}), or None if there is none
         """
+        journal_path = self.state_path("partial", file_name + JOURNAL_SUFFIX)
         try:
-            target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            target_socket.connect(target_address)
-            return target_socket
-        except Exception as e:
-            self.log(f"Error connecting to {target_address}: {e}")
+            with open(journal_path, "r") as journal_file:
+                journal = json.load(journal_file)
+            return journal if journal.get("fname") == file_name else None
+        except (OSError, ValueError):
             return None
 
-    def download_file(self, target_socket: socket.socket, file_name):
-        """Download a file from a peer.
+    def save_journal(self, file, file_name, size, offset, root, piece_size=PIECE_SIZE):
+        """Flush a partial download to disk and record the offset verified.
 
         Args:
-            target_socket (socket.socket): the peer's socket
-            file_name (str): the file's name on the peer
-
-        Returns:
-            bool: True if the file was downloaded successfully, False otherwise
+            file (file): the open ``.part`` file
+            file_name (str): the file's name on the server
+            size (int): the full size of the file
+            offset (int): number of verified bytes at the start of the ``.part`` file
+            root (str): Merkle root of the file being downloaded
+            piece_size (int): number of bytes in each piece of the file
         """
-        data = {
-            "header": "download",
-            "type": 0,
-            "payload": {
-                "fname": file_name,
-            },
-        }
-        target_socket.sendall(json.dumps(data).encode("utf-8", "replace"))
-
-        response_length = int.from_bytes(target_socket.recv(8), "big")
-        recved_data = target_socket.recv(response_length).decode("utf-8", "replace")
-
-        data = json.loads(recved_data)
-        fname = file_name
-        if os.path.isfile(os.path.join(self.repository_folder, fname)):
-            fname = fname.split(".")[0] + "_copy." + fname.split(".")[1]
-        length = data["payload"]["length"]
-        if data["payload"]["success"] is False:
-            self.log(data["payload"]["message"])
-            return False
-
-        self.log(f"Downloading file from {target_socket.getpeername()}...")
-        with open(os.path.join(self.repository_folder, fname), "wb") as file:
-            try:
-                offset = 0
-                while offset < length:
-                    recved = target_socket.recv(1024)
-
-                    if not recved:
-                        self.log("Connection closed by peer.")
-                        return False
-
-                    file.write(recved)
-                    offset += 1024
-                    self.log(f"Received {offset} bytes of data...")
+        file.flush()
+        os.fsync(file.fileno())
+        journal_path = self.state_path("partial", file_name + JOURNAL_SUFFIX)
+        with open(journal_path + ".tmp", "w") as journal_file:
+            json.dump(
+                {
+                    "fname": file_name,
+                    "size": size,
+                    "offset": offset,
+                    "root": root,
+                    "piece_size": piece_size,
+                },
+                journal_file,
+            )
+        os.replace(journal_path + ".tmp", journal_path)
 
-                self.log("Download completed!")
-                self.log(f"Publish file {fname} to server")
-                self.publish(self.client_socket, self.repository_folder, file_name)
+    def remove_journal(self, file_name):
+        """Remove the progress journal of a finished download.
 
-            except ConnectionResetError:
-                self.log("Connection closed by peer.")
-                return False
-            except Exception as e:
-                self.log(f"Error receiving file: {e}")
-                return False
-        return True
+        Args:
+            file_name (str): the file's name on the server
+        """
+        journal_path = self.state_path("partial", file_name + JOURNAL_SUFFIX)
+        if os.path.isfile(journal_path):
+            os.remove(journal_path)
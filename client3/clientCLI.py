@@ -0,0 +1,262 @@
+"""Headless command line client, without the GUI toolkit.
+
+Every command but ``stats`` connects to the server with the given hostname.
+``serve`` publishes the repository, keeps sharing it and reads commands from
+the standard input, one per line, the same as the command box of the GUI; at
+the end of the input it keeps serving until it is interrupted or the server
+closes the connection. The other commands exit once they are done, without
+publishing or hashing the repository. ``stats`` prints the transfer
+statistics saved by ``fetch --stats`` or ``stats dump``. Logs go to the
+standard error, results to the standard output.
+
+Usage:
+    python clientCLI.py [--server HOST:PORT] [--hostname NAME] [--repository DIR] [--peer-server thread|asyncio] [--quiet]
+                        serve | publish PATH [NAME] | fetch [-p PRIORITY] [--stats FILE] NAME... | discover
+    python clientCLI.py [...] fetch --stdout NAME | player -
+    python clientCLI.py stats [--transfers] [--direction upload|download] [--peer PEER] FILE
+"""
+import argparse
+import json
+import os
+import shlex
+import signal
+import socket
+import sys
+import threading
+import time
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", default="localhost:8888", help="address of the server, HOST:PORT")
+    parser.add_argument("--hostname", default=socket.gethostname(), help="hostname of the client on the server")
+    parser.add_argument(
+        "--repository",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "repository"),
+        help="folder of the shared files",
+    )
+    parser.add_argument(
+        "--peer-server",
+        choices=["thread", "asyncio"],
+        default="thread",
+        help="serve the other clients with a thread per connection or with one asyncio event loop",
+    )
+    parser.add_argument("--quiet", action="store_true", help="do not print the logs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("serve", help="share the repository and read commands from the standard input")
+    publish = commands.add_parser("publish", help="copy a file into the repository and publish it")
+    publish.add_argument("path", help="path to the file")
+    publish.add_argument("name", nargs="?", help="name of the file in the repository, the file's name by default")
+    fetch = commands.add_parser("fetch", help="download files and wait for the downloads to end")
+    fetch.add_argument("names", nargs="+", help="names of the files on the server")
+    fetch.add_argument("-p", "--priority", type=int, default=0, help="priority of the download jobs")
+    fetch.add_argument("--timeout", type=float, help="seconds to wait for the downloads, no limit by default")
+    fetch.add_argument("--stats", metavar="FILE", help="write the transfer statistics as JSON to FILE, - for stdout")
+    fetch.add_argument(
+        "--stdout", action="store_true", help="also write the file to the standard output while it downloads"
+    )
+    commands.add_parser("discover", help="list the files shared by the other clients")
+    stats = commands.add_parser("stats", help="print the transfer statistics saved by fetch --stats or stats dump")
+    stats.add_argument("file", help="the saved statistics, - for the standard input")
+    stats.add_argument("--transfers", action="store_true", help="list the transfers instead of their totals")
+    stats.add_argument("--direction", choices=["upload", "download"], help="list only the uploads or downloads")
+    stats.add_argument("--peer", help="list only the transfers with HOST or HOST:PORT")
+    args = parser.parse_args(argv)
+    if args.command == "fetch" and args.stdout and (len(args.names) > 1 or args.stats == "-"):
+        parser.error("--stdout takes one file name, and the statistics cannot go to the standard output too")
+    return args
+
+
+def connect(args):
+    """Connect a client to the server, and publish its repository for serve.
+
+    Args:
+        args (argparse.Namespace): the command line arguments
+
+    Returns:
+        FileClient: the client, or None if it could not connect
+    """
+    # Imported here so that --help does not load the client
+    from client import FileClient
+
+    if args.quiet:
+        log = lambda message: None
+    else:
+        log = lambda message: print(message, file=sys.stderr, flush=True)
+    client = FileClient(log_callback=log, peer_server_mode=args.peer_server)
+    host, _, port = args.server.rpartition(":")
+    client.server_host = host or "localhost"
+    client.server_port = int(port)
+    os.makedirs(args.repository, exist_ok=True)
+    client.repository_folder = args.repository
+    client_address = client.connect_to_server(args.hostname)
+    if not client_address:
+        print(f"Could not connect to the server {args.server}.", file=sys.stderr)
+        return None
+    client.start(client_address)
+    if args.command == "serve":
+        # Hashes the repository, the one-shot commands do not share it
+        client.connect_publish(client.client_socket)
+    return client
+
+
+def wait_fetch(requests, timeout=None):
+    """Wait for the server's answers to fetch requests and for the download
+    jobs they queued to end.
+
+    Args:
+        requests (list[FetchRequest]): the pending fetches, see FileClient.fetch
+        timeout (float): seconds to wait, None for no limit
+
+    Returns:
+        dict: the result of each fetch by file name, the job's state, "up to date"
+            if the file is already in the repository, "not found" or "timeout"
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    results = {}
+    for request in requests:
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        results[request.fname] = request.state() if request.wait(remaining) else "timeout"
+    return results
+
+
+def stream_fetch(client, name):
+    """Fetch a file and write its content to the standard output while it downloads.
+
+    Args:
+        client (FileClient): the client
+        name (str): the file's name on the server
+
+    Returns:
+        int: the exit status, 0 if the whole file was written
+    """
+    stream = client.stream(name)
+    try:
+        for chunk in stream:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+    except BrokenPipeError:
+        # The reader stopped early, the download goes on until the client closes
+        return 1
+    print(f"{name}: {stream.state}", file=sys.stderr)
+    return 0 if stream.state in ("done", "up to date") else 1
+
+
+def write_stats(client, path):
+    """Write the measurements of the client's transfers as JSON.
+
+    Args:
+        client (FileClient): the client
+        path (str): the file's path, - for the standard output
+    """
+    _, output = client.run_command("stats", {"dump": path})
+    if path == "-":
+        print(output)
+
+
+def show_stats(args):
+    """Print saved transfer statistics, see TransferStats.report.
+
+    Args:
+        args (argparse.Namespace): the command line arguments
+
+    Returns:
+        int: the exit status
+    """
+    from client import filter_transfers
+
+    try:
+        if args.file == "-":
+            report = json.load(sys.stdin)
+        else:
+            with open(args.file) as file:
+                report = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Could not read the statistics in {args.file}: {e}", file=sys.stderr)
+        return 1
+    if args.transfers or args.direction or args.peer:
+        print(json.dumps(filter_transfers(report["transfers"], args.direction, args.peer), indent=2))
+    else:
+        print(json.dumps(report["summary"], indent=2))
+    return 0
+
+
+def serve(client):
+    """Share the repository and run the commands read from the standard
+    input, then keep serving until the client is interrupted or the server
+    closes the connection.
+
+    Args:
+        client (FileClient): the client
+    """
+    from client import parse_command
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    client.watch_repository()
+    try:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            try:
+                command, arguments = parse_command(shlex.split(line))
+            except ValueError as e:
+                print(e, flush=True)
+                continue
+            if command == "quit":
+                return
+            _, output = client.run_command(command, arguments)
+            if output is not None:
+                print(output)
+            sys.stdout.flush()
+        while client.server_connected and not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "stats":
+        return show_stats(args)
+    client = connect(args)
+    if client is None:
+        return 1
+    status = 0
+    try:
+        if args.command == "serve":
+            serve(client)
+        elif args.command == "publish":
+            name = args.name or os.path.basename(args.path)
+            status = 0 if client.publish(client.client_socket, args.path, name) else 1
+        elif args.command == "fetch" and args.stdout:
+            status = stream_fetch(client, args.names[0])
+            if args.stats:
+                write_stats(client, args.stats)
+        elif args.command == "fetch":
+            if len(args.names) > 1:
+                requests = client.fetch_many(client.client_socket, args.names, args.priority)
+            else:
+                requests = [client.fetch(client.client_socket, args.names[0], args.priority)]
+            if all(requests):
+                results = wait_fetch(requests, args.timeout)
+            else:
+                results = {name: "not found" for name in args.names}
+            for name, result in results.items():
+                print(f"{name}: {result}")
+            status = 0 if all(result in ("done", "up to date") for result in results.values()) else 1
+            if args.stats:
+                write_stats(client, args.stats)
+        elif args.command == "discover":
+            names = client.catalog(client.client_socket)
+            if names is None:
+                status = 1
+            for name in names or []:
+                print(name)
+    finally:
+        client.close(client.client_socket)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,14 @@
+import argparse
 import os
 import shlex
 import PySimpleGUI as sg
 import threading
 
-from client import FileClient
+from client import FileClient, parse_command
 
 class FileClientGUI:
-    def __init__(self):     
-        self.client = FileClient(log_callback=self.log)
+    def __init__(self, peer_server_mode="thread"):     
+        self.client = FileClient(log_callback=self.log, peer_server_mode=peer_server_mode)
 
         self.layout = [
             [sg.Text("File client GUI", font=("Helvetica", 16)), sg.Text("My Repository", key="-REPO_TEXT-", font=("Helvetica", 16), pad=(440, 0), visible=False)],
@@ -38,15 +39,26 @@ class FileClientGUI:
                 self.publish(values["-FILE_PATH-"], values["-FILE_NAME-"])
                 
             elif event == "-COMMAND_BUTTON-":
-                command_parts = shlex.split(values["-COMMAND-"])
-                if command_parts[0] == "publish":
-                    self.publish(command_parts[1], command_parts[2])
-                elif command_parts[0] == "fetch":
-                    self.fetch(command_parts[1])
-                elif command_parts[0] == "discover":
+                try:
+                    command, arguments = parse_command(shlex.split(values["-COMMAND-"]))
+                except ValueError as e:
+                    self.log(str(e))
+                    continue
+                if command == "quit":
+                    self.quit_client()
+                    break
+                elif command == "publish":
+                    self.publish(arguments["path"], arguments["name"])
+                elif command == "fetch" and len(arguments["names"]) > 1:
+                    self.fetch_many(arguments["names"], arguments["priority"])
+                elif command == "fetch":
+                    self.fetch(arguments["names"][0], arguments["priority"])
+                elif command == "discover":
                     self.discover()
                 else:
-                    self.log("Not a valid command.")
+                    _, output = self.client.run_command(command, arguments)
+                    if output is not None:
+                        self.log(output)
 
     def connect(self, hostname):        
         if hostname:
@@ -79,9 +91,10 @@ class FileClientGUI:
                     else:
                         self.client.connect_publish(self.client.client_socket)
                         result = ""
-                        for file_name in os.listdir(self.client.repository_folder):
+                        for file_name in self.client.repository_index.names():
                             result += f"{file_name}\n"
                         result = result.rstrip("\n")
+                    self.client.watch_repository()
                     if result != "":
                         self.window["-REPO-"].update(disabled=False)
                         self.window["-REPO-"].print(result.rstrip("\n"))
@@ -113,12 +126,12 @@ class FileClientGUI:
         except Exception as e:
             self.log(f"Error publishing file: {e}")
 
-    def fetch(self, file_name):
+    def fetch(self, file_name, priority=0):
         if not file_name:
             self.log("Error fetching file: File name cannot be blank!")
             return
         try:
-            fetch_status = self.client.fetch(self.client.client_socket, file_name)
+            fetch_status = self.client.fetch(self.client.client_socket, file_name, priority)
             if fetch_status:
                 self.window["-COMMAND-"].update("")
                 self.window["-REPO-"].update(disabled=False)
@@ -127,6 +140,14 @@ class FileClientGUI:
         except Exception as e:
             self.log(f"Error fetching file: {e}")
 
+    def fetch_many(self, file_names, priority=0):
+        try:
+            fetch_status = self.client.fetch_many(self.client.client_socket, file_names, priority)
+            if fetch_status:
+                self.window["-COMMAND-"].update("")
+        except Exception as e:
+            self.log(f"Error fetching files: {e}")
+
     def quit_client(self):      
         self.client.quit(self.client.client_socket)
         self.window.close()
@@ -138,21 +159,26 @@ class FileClientGUI:
         
     def discover(self):
         try:
-            discover_status = self.client.discover(self.client.client_socket)
-            if discover_status:
-                while not self.client.discover_status:
-                    pass
+            catalog = self.client.catalog(self.client.client_socket)
+            if catalog is not None:
                 self.window["-FILE_PATH-"].update("")
                 self.window["-FILE_NAME-"].update("")
                 self.window["-COMMAND-"].update("")
                 message1 = "All existed file name: "
-                message2 = ', '.join(self.client.discovery_array)
+                message2 = ', '.join(catalog)
                 message = message1 + message2
                 self.window["-OUTPUT-"].update(disabled=False)
                 self.window["-OUTPUT-"].print(message)
                 self.window["-OUTPUT-"].update(disabled=True)
-                self.client.discover_status = False
         except Exception as e:
             self.log(f"Error publishing file: {e}")
 if __name__ == "__main__":
-    gui = FileClientGUI()
+    parser = argparse.ArgumentParser(description="File client GUI")
+    parser.add_argument(
+        "--peer-server",
+        choices=["thread", "asyncio"],
+        default="thread",
+        help="serve the other clients with a thread per connection or with one asyncio event loop",
+    )
+    args = parser.parse_args()
+    gui = FileClientGUI(peer_server_mode=args.peer_server)
@@ -3,14 +3,140 @@ import select
 import socket
 import sys
 import threading
+import time
 from typing import Any
 
+PUBLISH_LOG_NAMES = 10  # File names listed in the log for a publish, larger ones only log their count
+LISTEN_BACKLOG = 5  # Connections waiting to be accepted by the server socket
+CATALOG_BATCH_DELAY = 0.1  # Seconds the catalog changes for a client are gathered before they are sent
+
+
+def recv_exact(sock, size):
+    """Receive exactly size bytes from a socket
+
+    Args:
+        sock (socket): The socket to read from
+        size (int): Number of bytes to read
+
+    Returns:
+        bytes: The received bytes, or None if the connection was closed early
+    """
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock, message):
+    """Send a JSON message prefixed with its length as an 8-byte big-endian integer
+
+    Args:
+        sock (socket): The socket to write to
+        message (obj): The message to send
+    """
+    data = json.dumps(message).encode("utf-8", "replace")
+    sock.sendall(len(data).to_bytes(8, "big") + data)
+
+
+def recv_message(sock):
+    """Receive a JSON message sent with send_message
+
+    Args:
+        sock (socket): The socket to read from
+
+    Returns:
+        obj: The message, or None if the connection was closed
+    """
+    header = recv_exact(sock, 8)
+    if header is None:
+        return None
+    data = recv_exact(sock, int.from_bytes(header, "big"))
+    if data is None:
+        return None
+    return json.loads(data.decode("utf-8", "replace"))
+
+
+class CatalogNotifier(threading.Thread):
+    """Send the catalog changes to one client from its own thread, so a
+    slow client does not hold up the server. The changes queued while the
+    thread waits or sends are merged into the next notification, the last
+    change of a name winning."""
+
+    def __init__(self, server, client_address):
+        super().__init__(daemon=True)
+        self.server = server
+        self.client_address = client_address
+        self.published = set()
+        self.removed = set()
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def add(self, published=(), removed=()):
+        """Queue catalog changes.
+
+        Args:
+            published (list[str]): file names published or updated by another client
+            removed (list[str]): file names another client does not share anymore
+        """
+        with self.condition:
+            self.removed.difference_update(published)
+            self.published.update(published)
+            self.published.difference_update(removed)
+            self.removed.update(removed)
+            self.condition.notify()
+
+    def close(self):
+        """Stop sending, the queued changes are dropped."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.published or self.removed or self.closed):
+                    self.condition.wait()
+                if self.closed:
+                    return
+            # Gather the rest of a burst, e.g. a client publishing its repository
+            time.sleep(CATALOG_BATCH_DELAY)
+            with self.condition:
+                if self.closed:
+                    return
+                published, removed = sorted(self.published), sorted(self.removed)
+                self.published, self.removed = set(), set()
+            notification = {
+                "header": "catalog",
+                "type": 0,
+                "payload": {
+                    "success": True,
+                    "message": "Shared files changed",
+                    "published": published,
+                    "removed": removed,
+                },
+            }
+            try:
+                self.server.send(self.client_address, notification)
+            except (OSError, KeyError) as e:
+                self.server.log(f"Error notifying client {self.client_address}: {e}")
+                return
+
 
 class ServerLogic:
-    def __init__(self, host, port, log_callback=None, log_request_callback=None):       
+    def __init__(self, host, port, log_callback=None, log_request_callback=None, backlog=LISTEN_BACKLOG,
+                 max_clients=None):
         self.host = host
         self.port = port
-        # clients -> {client_address: {"hostname": hostname, "files": [dictionary of files]}}
+        self.backlog = backlog
+        self.max_clients = max_clients  # Clients connected at the same time, None for no limit
+        # clients -> {client_address: {"hostname": hostname, "files": [dictionary of files],
+        #             "meta": {file name: {"size": int, "root": Merkle root}},
+        #             "roots": {Merkle root: {file names}},
+        #             "send_lock": lock of the socket, "notifier": CatalogNotifier}}
         self.clients = (
             {}
         )  
@@ -41,6 +167,19 @@ class ServerLogic:
         else:
             print(message)
 
+    def send(self, client_address, message):
+        """Send a message to a connected client, one message at a time on its
+        socket, as its requests are answered and its notifications sent from
+        different threads
+
+        Args:
+            client_address (tuple[str, int]): The client's address
+            message (obj): The message to send
+        """
+        data = self.clients[client_address]
+        with data["send_lock"]:
+            send_message(data["client_socket"], message)
+
     def start(self):        
         """Start the server in a separate thread"""
         server_thread = threading.Thread(target=self.run_server, daemon=True)
@@ -56,7 +195,7 @@ class ServerLogic:
                 server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 server_socket.bind((self.host, self.port))
-                server_socket.listen(5)
+                server_socket.listen(self.backlog)
 
                 self.is_running = True
                 self.log(f"Server listening on {self.host}:{self.port}")
@@ -64,6 +203,10 @@ class ServerLogic:
         while self.is_running:
             try:
                 client_socket, client_address = server_socket.accept()
+                if self.max_clients is not None and len(self.clients) >= self.max_clients and self.is_running:
+                    self.log(f"Connection from {client_address} refused, {self.max_clients} clients connected")
+                    client_socket.close()
+                    continue
                 threading.Thread(
                     target=self.handle_client,
                     daemon=True,
@@ -75,6 +218,7 @@ class ServerLogic:
                     break
                 else:
                     self.log(f"Error accepting connection: {e}")
+        server_socket.close()
 
     def handle_client(self, client_socket, client_address):
         """Handle a client connection
@@ -83,27 +227,32 @@ class ServerLogic:
             client_socket (socket): The client' socket
             client_address (tuple[str, int]): The client's address
         """
+        notifier = CatalogNotifier(self, client_address)
         with self.lock:
             self.clients[client_address] = {
                 "client_socket": client_socket,
                 "hostname": None,
                 "status": "online",
-                "files": [],
+                "files": set(),
+                "meta": {},
+                "roots": {},
+                "send_lock": threading.Lock(),
+                "notifier": notifier,
             }
+        notifier.start()
 
         if self.is_running:
             self.log(f"New connection from {client_address}")
 
         while self.clients[client_address]["status"] == "online" and self.is_running:
             try:
-                data = client_socket.recv(1024).decode("utf-8", "replace")
-                if not data:
-                    break
-
                 try:
-                    data = json.loads(data)
-                except Exception as e:
+                    data = recv_message(client_socket)
+                except ValueError as e:
                     self.log(f"Error receiving command: {e}")
+                    continue
+                if data is None:
+                    break
 
                 self.process_command(client_socket, client_address, data)
 
@@ -117,9 +266,12 @@ class ServerLogic:
                 self.log(f"Error handling client {client_address}: {e}")
                 break
 
+        notifier.close()
         with self.lock:
             if client_address in self.clients:
-                del self.clients[client_address]
+                removed = self.clients.pop(client_address)["files"]
+                if removed and self.is_running:
+                    self.notify_catalog(client_address, removed=removed)
             if client_socket:
                 client_socket.close()
             if self.is_running:
@@ -139,14 +291,27 @@ class ServerLogic:
                     f">>> Client {client_address}: {command['header'].upper()}\n---\n"
                 )
                 self.publish(
+                    client_socket,
                     client_address,
                     command["payload"]["fname"],
+                    command["payload"].get("meta"),
+                    command["payload"].get("batch"),
                 )
+            elif command["header"] == "unpublish":
+                self.log_request(
+                    f">>> Client {client_address}: {command['header'].upper()}\n---\n"
+                )
+                self.unpublish(client_address, command["payload"]["fname"])
             elif command["header"] == "fetch":
                 self.log_request(
                     f">>> Client {client_address}: {command['header'].upper()}\n---\n"
                 )
-                self.fetch(client_socket, client_address, command["payload"]["fname"])
+                self.fetch(
+                    client_socket,
+                    client_address,
+                    command["payload"]["fname"],
+                    command["payload"].get("root"),
+                )
             elif command["header"] == "sethost":
                 self.log_request(
                     f">>> Client {client_address}: {command['header'].upper()}\n---\n"
@@ -168,92 +333,219 @@ class ServerLogic:
                 )
 
     def process_server_command(self, command):
-        """Process a command received from the server console
+        """Process a command received from the server console or the admin socket
 
         Args:
             command (str): The command to process
+
+        Returns:
+            str: The command's output, also logged
         """
         with self.lock:
             if self.is_running:
                 command_parts = command.split()
                 self.log(f"\nServer$ {command}")
 
-                if not command:
-                    self.log("Server command cannot be blank!")
-                elif command_parts[0] == "discover":
-                    self.server_discover(command_parts[1])
-                elif command_parts[0] == "ping":
-                    self.server_ping(command_parts[1])
+                if not command_parts:
+                    output = "Server command cannot be blank!"
+                elif command_parts[0] == "discover" and len(command_parts) > 1:
+                    return self.server_discover(command_parts[1])
+                elif command_parts[0] == "ping" and len(command_parts) > 1:
+                    return self.server_ping(command_parts[1])
                 elif command_parts[0] == "shutdown":
-                    self.shutdown()
+                    self.shutdown(exit=False)
+                    return "Server stopped."
                 else:
-                    self.log(f"Unknown server command: {command}")
+                    output = f"Unknown server command: {command}"
             else:
-                self.log("Start the server before sending commands!")
+                output = "Start the server before sending commands!"
+            self.log(output)
+            return output
 
-    def publish(self, client_address, fname):
+    def publish(self, client_socket, client_address, fname, meta=None, batch=None):
         """Handle publish request from client
 
         Args:
+            client_socket (socket): The client' socket
             client_address (tuple[str, int]): The client's address
-            fname (str): file name published from client to server 
+            fname (list[str]): file names published from client to server
+            meta (dict): size and Merkle root of each published file
+            batch (int): sequence number of the batch of a streamed publish,
+                acknowledged once it is recorded
         """
         if client_address in self.clients:
-            self.clients[client_address]["files"].extend(fname)
+            self.clients[client_address]["files"].update(fname)
+            for file, file_meta in (meta or {}).items():
+                self.index_root(client_address, file, file_meta)
+            self.notify_catalog(client_address, published=fname)
+            if len(fname) > PUBLISH_LOG_NAMES:
+                self.log(f"{len(fname)} files published by {client_address}")
+            else:
+                file_names_str = ', '.join([f'"{file}"' for file in fname])
+                self.log(
+                    f"Files {file_names_str} published by {client_address}"
+                )
+        else:
+            self.log(f"Unknown client {client_address}")
+
+        if batch is not None:
+            response_data = {
+                "header": "publish",
+                "type": 1,
+                "payload": {
+                    "success": client_address in self.clients,
+                    "message": f"Batch {batch} of {len(fname)} files published",
+                    "batch": batch,
+                },
+            }
+            if client_address in self.clients:
+                self.send(client_address, response_data)
+            else:
+                send_message(client_socket, response_data)
+
+    def unpublish(self, client_address, fname):
+        """Handle unpublish request from client
+
+        Args:
+            client_address (tuple[str, int]): The client's address
+            fname (list[str]): file names removed from the client's repository
+        """
+        if client_address in self.clients:
+            self.clients[client_address]["files"].difference_update(fname)
+            for file in fname:
+                self.index_root(client_address, file, None)
+            self.notify_catalog(client_address, removed=fname)
             file_names_str = ', '.join([f'"{file}"' for file in fname])
             self.log(
-                f"Files {file_names_str} published by {client_address}"
+                f"Files {file_names_str} unpublished by {client_address}"
             )
         else:
             self.log(f"Unknown client {client_address}")
 
-    def fetch(self, client_socket, requesting_client, fname):
+    def notify_catalog(self, client_address, published=(), removed=()):
+        """Tell the other clients that a client published or removed files,
+        so they update their cached catalog and fetch results. The changes
+        are only queued here, see CatalogNotifier.
+
+        Args:
+            client_address (tuple[str, int]): The address of the client whose files changed
+            published (list[str]): file names published or updated by the client
+            removed (list[str]): file names the client does not share anymore
+        """
+        for addr, data in self.clients.items():
+            if addr == client_address or data["hostname"] is None:
+                continue
+            data["notifier"].add(published, removed)
+
+    def index_root(self, client_address, fname, meta):
+        """Record the metadata of a client's file, indexed by its Merkle root
+
+        Args:
+            client_address (tuple[str, int]): The client's address
+            fname (str): The file's name
+            meta (dict): size and Merkle root of the file, None if the file was removed
+        """
+        data = self.clients[client_address]
+        old = data["meta"].pop(fname, None) or {}
+        names = data["roots"].get(old.get("root"))
+        if names is not None:
+            names.discard(fname)
+            if not names:
+                del data["roots"][old["root"]]
+        if meta is not None:
+            data["meta"][fname] = meta
+            if meta.get("root") is not None:
+                data["roots"].setdefault(meta["root"], set()).add(fname)
+
+    def fetch(self, client_socket, requesting_client, fname, root=None):
         """Handle fetch request from client
 
         Args:
             client_socket (socket): The client' socket
             requesting_client (tuple[str, int]): Client's address
-            fname (str): Requested file name from client
+            fname (str | list[str]): Requested file name from client, or a list
+                of names to look up in one batch
+            root (str): Merkle root of the requested content, see fetch_sources
         """
-        found_client: list[tuple[tuple[str, int], Any]] = [
-            (addr, data)
-            for addr, data in self.clients.items()
-            if any(file == fname for file in data["files"])
-            and addr != requesting_client
-        ]
-
-        if len(found_client) > 0:
+        if isinstance(fname, list):
+            payloads = [self.fetch_sources(requesting_client, name) for name in fname]
+            found = sum(1 for payload in payloads if payload["success"])
             response_data = {
                 "header": "fetch",
                 "type": 1,
                 "payload": {
-                    "success": True,
-                    "message": f"File '{fname}' found",
+                    "success": found > 0,
+                    "message": f"{found} of {len(fname)} files found",
                     "fname": fname,
-                    "available_clients": [
-                        {
-                            "hostname": data["hostname"],
-                            "address": addr,
-                        }
-                        for (addr, data) in found_client
-                    ],
+                    "files": payloads,
                 },
             }
-            response = json.dumps(response_data)
-            client_socket.send(response.encode("utf-8", "replace"))
         else:
             response_data = {
                 "header": "fetch",
                 "type": 1,
-                "payload": {
-                    "success": False,
-                    "message": f"File '{fname}' not found",
-                    "fname": fname,
-                    "available_clients": [],
-                },
+                "payload": self.fetch_sources(requesting_client, fname, root),
+            }
+        self.send(requesting_client, response_data)
+
+    def fetch_sources(self, requesting_client, fname, root=None):
+        """Find the clients holding a file. Clients holding the same content
+        under other names are found by its Merkle root.
+
+        Args:
+            requesting_client (tuple[str, int]): Client's address
+            fname (str): Requested file name from client
+            root (str): Merkle root of the requested content, None for the
+                content published under fname by the first client holding it
+
+        Returns:
+            dict: The payload of the fetch response for the file
+        """
+        if root is None:
+            root = next(
+                (
+                    data["meta"][fname]["root"]
+                    for addr, data in self.clients.items()
+                    if addr != requesting_client and (data["meta"].get(fname) or {}).get("root")
+                ),
+                None,
+            )
+
+        found_client: list[tuple[tuple[str, int], Any, dict]] = []
+        for addr, data in self.clients.items():
+            if addr == requesting_client:
+                continue
+            names = data["roots"].get(root) if root is not None else None
+            if names:
+                meta = data["meta"][fname if fname in names else next(iter(names))]
+            elif fname in data["files"]:
+                meta = data["meta"].get(fname) or {}
+            else:
+                continue
+            found_client.append((addr, data, meta))
+
+        if len(found_client) > 0:
+            return {
+                "success": True,
+                "message": f"File '{fname}' found",
+                "fname": fname,
+                "root": root,
+                "available_clients": [
+                    {
+                        "hostname": data["hostname"],
+                        "address": addr,
+                        "size": meta.get("size"),
+                        "root": meta.get("root"),
+                    }
+                    for addr, data, meta in found_client
+                ],
             }
-            response = json.dumps(response_data)
-            client_socket.send(response.encode("utf-8", "replace"))
+        return {
+            "success": False,
+            "message": f"File '{fname}' not found",
+            "fname": fname,
+            "available_clients": [],
+        }
 
     def set_hostname(self, client_socket, client_address, hostname: str):
         """Set the hostname for a client
@@ -265,19 +557,17 @@ class ServerLogic:
         """
         if client_address in self.clients:
             if " " in hostname:
-                response = json.dumps(
-                    {
-                        "header": "sethost",
-                        "type": 1,
-                        "payload": {
-                            "success": False,
-                            "message": "Hostname cannot contain spaces",
-                            "hostname": hostname,
-                            "address": client_address,
-                        },
-                    }
-                )
-                client_socket.send(response.encode("utf-8", "replace"))
+                response_data = {
+                    "header": "sethost",
+                    "type": 1,
+                    "payload": {
+                        "success": False,
+                        "message": "Hostname cannot contain spaces",
+                        "hostname": hostname,
+                        "address": client_address,
+                    },
+                }
+                self.send(client_address, response_data)
             else:
                 if not any(
                     data["hostname"] == hostname
@@ -296,9 +586,8 @@ class ServerLogic:
                             "address": client_address,
                         },
                     }
-                    response = json.dumps(response_data)
                     self.log(response_data["payload"]["message"])
-                    client_socket.send(response.encode("utf-8", "replace"))
+                    self.send(client_address, response_data)
                 else:
                     response_data = {
                         "header": "sethost",
@@ -310,9 +599,8 @@ class ServerLogic:
                             "address": client_address,
                         },
                     }
-                    response = json.dumps(response_data)
                     self.log(response_data["payload"]["message"])
-                    client_socket.send(response.encode("utf-8", "replace"))
+                    self.send(client_address, response_data)
         else:
             response_data = {
                 "header": "sethost",
@@ -324,15 +612,17 @@ class ServerLogic:
                     "address": client_address,
                 },
             }
-            response = json.dumps(response_data)
             self.log(response_data["payload"]["message"])
-            client_socket.send(response.encode("utf-8", "replace"))
+            send_message(client_socket, response_data)
 
     def server_discover(self, hostname):
         """Discover published files with the given hostname
 
         Args:
             hostname (str): The hostname to search for
+
+        Returns:
+            str: The files, also logged
         """
         found_client = None
         for addr, data in self.clients.items():
@@ -346,7 +636,7 @@ class ServerLogic:
         ]
         
         if found_files:
-            found_files = found_files[0]
+            found_files = sorted(found_files[0])
         else:
             found_files = []
 
@@ -361,12 +651,16 @@ class ServerLogic:
             response = f"No hosts found with hostname '{hostname}'"
 
         self.log(response)
+        return response
 
     def server_ping(self, hostname):
         """Ping a client with the given hostname
 
         Args:
             hostname (str): The hostname to ping
+
+        Returns:
+            str: The client's status, also logged
         """
         found_client = None
         for addr, data in self.clients.items():
@@ -377,9 +671,10 @@ class ServerLogic:
         if found_client:
             self.log(f"Pinging {hostname}...")
             response_data = self.send_ping(addr)
-            self.log(response_data)
         else:
-            self.log(f"Unknown client '{hostname}'")
+            response_data = f"Unknown client '{hostname}'"
+        self.log(response_data)
+        return response_data
 
     def send_ping(self, client_address):
         """Send a ping request to a client
@@ -395,7 +690,7 @@ class ServerLogic:
             try:
                 client_socket.connect(client_address)
                 ping_message = {"header": "ping", "type": 0}
-                client_socket.send(json.dumps(ping_message).encode("utf-8", "replace"))
+                send_message(client_socket, ping_message)
 
                 ready, _, _ = select.select([client_socket], [], [], 8.0)
 
@@ -422,14 +717,10 @@ class ServerLogic:
         """
         client_address = client_socket.getpeername()
         client_file = self.clients[client_address]["files"]
-        all_file_names = []
         seen_files = set()
-
         for client_info in self.clients.values():
-            for file_name in client_info["files"]:
-                if file_name not in seen_files and file_name not in client_file:
-                    all_file_names.append(file_name)
-                    seen_files.add(file_name)
+            seen_files.update(client_info["files"])
+        all_file_names = sorted(seen_files - client_file)
         response_data = {
             "header": "discover",
             "type": 1,
@@ -439,11 +730,14 @@ class ServerLogic:
                 "fname": [all_file_names],
             },
         }
-        response = json.dumps(response_data)
-        client_socket.send(response.encode("utf-8", "replace"))
+        self.send(client_address, response_data)
     
-    def shutdown(self):
-        """Shutdown the server"""
+    def shutdown(self, exit=True):
+        """Shutdown the server
+
+        Args:
+            exit (bool): Whether to exit the calling thread afterwards
+        """
         self.log("Shutting down the server...")
         self.is_running = False
         try:
@@ -455,7 +749,8 @@ class ServerLogic:
         except Exception as e:
             if self.is_running:
                 self.log(f"Error shutdown the server: {e}")
-        sys.exit(0)
+        if exit:
+            sys.exit(0)
 
 
 # if __name__ == "__main__":
@@ -0,0 +1,226 @@
+"""Headless server daemon, without the GUI toolkit.
+
+The server is configured by an INI file, see serverd.conf. The commands of
+the GUI's console (discover <hostname>, ping <hostname>, shutdown) are taken
+on a local Unix socket, one per connection, and their output is sent back.
+SIGINT and SIGTERM stop the server too.
+
+Usage:
+    python serverd.py [--config FILE] [--host HOST] [--port PORT]    run the server
+    python serverd.py [--config FILE] ctl COMMAND...                   send a command to a running server
+"""
+import argparse
+import configparser
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+
+from server import LISTEN_BACKLOG, ServerLogic
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "serverd.conf")
+DEFAULTS = {
+    "server": {"host": "0.0.0.0", "port": "8888", "backlog": str(LISTEN_BACKLOG), "max_clients": "0"},
+    "paths": {"admin_socket": "serverd.sock", "pid_file": "", "log_file": "", "request_log_file": ""},
+}
+ADMIN_TIMEOUT = 30  # Seconds an admin connection may take to send its command
+ADMIN_MAX_COMMAND = 4096  # Bytes of an admin command
+
+
+def load_config(path):
+    """Read the daemon's configuration, with the defaults for missing options.
+
+    Args:
+        path (str): path to the INI file, it may not exist
+
+    Returns:
+        configparser.ConfigParser: the configuration, with the relative paths
+            made relative to the file's folder
+    """
+    config = configparser.ConfigParser()
+    config.read_dict(DEFAULTS)
+    config.read(path)
+    folder = os.path.dirname(os.path.abspath(path))
+    for option, value in config["paths"].items():
+        if value:
+            config["paths"][option] = os.path.join(folder, os.path.expanduser(value))
+    return config
+
+
+def make_logger(name, path):
+    """Create a logger writing to a file, or to the standard error.
+
+    Args:
+        name (str): the logger's name
+        path (str): the log file's path, empty for the standard error
+
+    Returns:
+        logging.Logger: the logger
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(path) if path else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    logger.addHandler(handler)
+    return logger
+
+
+class AdminServer:
+    """Unix socket server running the console commands of a ServerLogic."""
+
+    def __init__(self, server, path, on_shutdown):
+        self.server = server
+        self.path = path
+        self.on_shutdown = on_shutdown  # Called after the shutdown command
+        self.sock = None
+
+    def start(self):
+        """Listen on the admin socket in a separate thread."""
+        if os.path.exists(self.path):
+            # Left behind by a daemon that did not stop cleanly
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """Accept the admin connections until the socket is closed."""
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        """Run the command of an admin connection and send its output back.
+
+        Args:
+            connection (socket.socket): the admin connection
+        """
+        with connection:
+            try:
+                connection.settimeout(ADMIN_TIMEOUT)
+                command = b""
+                while b"\n" not in command and len(command) < ADMIN_MAX_COMMAND:
+                    chunk = connection.recv(ADMIN_MAX_COMMAND)
+                    if not chunk:
+                        break
+                    command += chunk
+                command = command.split(b"\n", 1)[0].decode("utf-8", "replace").strip()
+                output = self.server.process_server_command(command)
+                connection.sendall((output + "\n").encode("utf-8"))
+            except OSError:
+                return
+        if command.split()[:1] == ["shutdown"]:
+            self.on_shutdown()
+
+    def close(self):
+        """Stop listening and remove the admin socket."""
+        if self.sock is not None:
+            self.sock.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+def send_command(path, command):
+    """Send a console command to a running daemon.
+
+    Args:
+        path (str): the admin socket's path
+        command (str): the command
+
+    Returns:
+        str: the command's output
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((command + "\n").encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)
+        output = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            output += chunk
+    return output.decode("utf-8", "replace")
+
+
+def run(config):
+    """Run the server until it is shut down or the process is signalled.
+
+    Args:
+        config (configparser.ConfigParser): the configuration
+
+    Returns:
+        int: the exit status
+    """
+    paths = config["paths"]
+    log = make_logger("serverd", paths["log_file"])
+    request_log = make_logger("serverd.requests", paths["request_log_file"])
+    request_log.propagate = False
+    server = ServerLogic(
+        config["server"]["host"],
+        config["server"].getint("port"),
+        log_callback=log.info,
+        log_request_callback=request_log.info,
+        backlog=config["server"].getint("backlog"),
+        max_clients=config["server"].getint("max_clients") or None,
+    )
+
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopped.set())
+    if paths["pid_file"]:
+        with open(paths["pid_file"], "w") as file:
+            file.write(f"{os.getpid()}\n")
+    admin = None
+    try:
+        server.start()
+        if paths["admin_socket"] and hasattr(socket, "AF_UNIX"):
+            admin = AdminServer(server, paths["admin_socket"], stopped.set)
+            admin.start()
+            log.info(f"Admin socket listening on {paths['admin_socket']}")
+        while not stopped.wait(1):
+            pass
+    finally:
+        if admin is not None:
+            admin.close()
+        if server.is_running:
+            server.shutdown(exit=False)
+        if paths["pid_file"] and os.path.exists(paths["pid_file"]):
+            os.remove(paths["pid_file"])
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default=DEFAULT_CONFIG, help="INI configuration file")
+    parser.add_argument("--host", help="address to listen on, overrides the configuration")
+    parser.add_argument("--port", type=int, help="port to listen on, overrides the configuration")
+    parser.add_argument("ctl", nargs="*", metavar="ctl COMMAND", help="send a console command to a running server")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    if args.host:
+        config["server"]["host"] = args.host
+    if args.port:
+        config["server"]["port"] = str(args.port)
+    if not args.ctl:
+        return run(config)
+    if args.ctl[0] != "ctl" or len(args.ctl) < 2:
+        parser.error("the only command is: ctl COMMAND...")
+    try:
+        print(send_command(config["paths"]["admin_socket"], " ".join(args.ctl[1:])), end="")
+    except OSError as e:
+        print(f"Could not reach the server on {config['paths']['admin_socket']}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())